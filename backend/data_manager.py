@@ -5,7 +5,8 @@ import os
 import json
 from datetime import datetime
 import pickle
-import numpy as np
+
+from .frame_store import CODEC_PNG, FRAME_STORE_SUFFIX, FrameStore, FrameStoreWriter
 
 
 class DataManager:
@@ -88,37 +89,50 @@ class DataManager:
         with open(index_file, 'w', encoding='utf-8') as f:
             json.dump(index, f, indent=2, ensure_ascii=False)
             
-    def save_raw_frames(self, video_filename, frames, sampling_rate=30):
+    def save_raw_frames(self, video_filename, frames, sampling_rate=30, fps=None):
         """
         保存原始帧数据（可选功能）
-        用于需要逐帧处理的训练场景
+        用于需要逐帧处理的训练场景，采样的帧以无损PNG写入一个帧存储文件（支持随机访问）
         
         Args:
             video_filename: 视频文件名
             frames: 帧数据列表
             sampling_rate: 采样率（每隔多少帧保存一次）
+            fps: 视频帧率，提供时时间戳为秒，否则为帧序号
+            
+        Returns:
+            str: 帧存储文件路径
         """
         base_name = os.path.splitext(os.path.basename(video_filename))[0]
-        frame_dir = os.path.join(self.raw_data_dir, base_name)
-        os.makedirs(frame_dir, exist_ok=True)
+        store_path = os.path.join(self.raw_data_dir, base_name + FRAME_STORE_SUFFIX)
         
-        # 保存采样的帧
-        for i, frame in enumerate(frames):
-            if i % sampling_rate == 0:
-                frame_path = os.path.join(frame_dir, f"frame_{i:06d}.npy")
-                np.save(frame_path, frame)
-                
-        # 保存帧信息
+        # 帧信息写入帧存储的索引
         frame_info = {
             'total_frames': len(frames),
-            'saved_frames': len(frames) // sampling_rate,
+            'saved_frames': (len(frames) + sampling_rate - 1) // sampling_rate,
             'sampling_rate': sampling_rate,
-            'shape': frames[0].shape if frames else None
+            'shape': list(frames[0].shape) if len(frames) else None
         }
         
-        info_path = os.path.join(frame_dir, 'frame_info.json')
-        with open(info_path, 'w') as f:
-            json.dump(frame_info, f, indent=2)
+        # 保存采样的帧
+        with FrameStoreWriter(store_path, codec=CODEC_PNG, meta=frame_info) as writer:
+            for i, frame in enumerate(frames):
+                if i % sampling_rate == 0:
+                    writer.append(frame, i / fps if fps else i)
+        return store_path
+    
+    def load_raw_frames(self, video_filename):
+        """
+        打开保存的原始帧（内存映射，按需解码）
+        
+        Returns:
+            FrameStore: 不存在时返回None；meta属性为保存时的帧信息
+        """
+        base_name = os.path.splitext(os.path.basename(video_filename))[0]
+        store_path = os.path.join(self.raw_data_dir, base_name + FRAME_STORE_SUFFIX)
+        if not os.path.exists(store_path):
+            return None
+        return FrameStore(store_path)
             
     def get_recording_history(self):
         """获取录制历史"""
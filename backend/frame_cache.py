@@ -0,0 +1,186 @@
+"""
+视频帧缓存 - 缓存get_video_frames抽取的帧，同一视频的后续请求无需重新解码
+- 缓存键包含文件大小、修改时间、内容指纹（首尾各1MB的SHA-256）和抽帧参数，同一路径的文件被覆盖后不会命中旧帧
+- 磁盘预算内按最近使用（文件修改时间）淘汰，多个进程共用同一缓存目录也能正确淘汰
+- 每个条目是一个帧存储文件（backend/frame_store.py，默认为不压缩的原始像素，命中与未命中时模型得到完全相同的像素），
+  先写临时文件再原子重命名，进程崩溃不会留下半个缓存条目
+- 命中时以内存映射方式打开，不把整段帧读入内存: 原始像素直接映射为数组，不解码、不复制；
+  压缩编码只解码实际用到的帧。内存映射随返回的对象释放
+"""
+import hashlib
+import os
+import tempfile
+import threading
+
+try:
+    from .frame_store import CODEC_RAW, CODECS, FRAME_STORE_SUFFIX, FrameStore, FrameStoreError, write_frame_store
+except ImportError:
+    from frame_store import CODEC_RAW, CODECS, FRAME_STORE_SUFFIX, FrameStore, FrameStoreError, write_frame_store
+
+
+# 默认缓存目录和磁盘预算
+DEFAULT_CACHE_DIR = '.cache'
+DEFAULT_MAX_BYTES = 4 * 1024 ** 3
+
+# 内容指纹读取的首尾字节数
+FINGERPRINT_BYTES = 1024 * 1024
+
+# 缓存帧的编码 - 默认不压缩（与.npy缓存同样大小，命中时直接内存映射）；
+# PNG体积更小但每次命中都要解码，JPEG有损、命中时的像素与重新解码的不同，均需显式选择
+CACHE_CODEC = CODEC_RAW
+CACHE_JPEG_QUALITY = 95
+
+
+def video_fingerprint(video_path, sample_bytes=FINGERPRINT_BYTES):
+    """
+    视频文件的内容指纹 - 文件大小和首尾各sample_bytes字节的SHA-256（不读取整个文件）
+
+    Returns:
+        tuple: (文件大小, 修改时间（纳秒）, 指纹)
+    """
+    stat = os.stat(video_path)
+    digest = hashlib.sha256(str(stat.st_size).encode('utf-8'))
+    with open(video_path, 'rb') as f:
+        digest.update(f.read(sample_bytes))
+        if stat.st_size > sample_bytes:
+            f.seek(max(sample_bytes, stat.st_size - sample_bytes))
+            digest.update(f.read(sample_bytes))
+    return stat.st_size, stat.st_mtime_ns, digest.hexdigest()
+
+
+class FrameCache:
+    """磁盘帧缓存（线程安全，可多进程共用同一目录）"""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, codec=CACHE_CODEC):
+        """
+        Args:
+            cache_dir: 缓存目录
+            max_bytes: 磁盘预算（字节），0表示不限制
+            codec: 帧编码，"raw"（不压缩，默认）、"png"（无损压缩）或 "jpeg"（有损）
+        """
+        if codec not in CODECS:
+            raise ValueError(f"不支持的缓存帧编码: {codec}")
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.codec = codec
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def make_key(self, video_path, **sampling_params):
+        """
+        由视频文件状态、内容指纹和抽帧参数构造缓存键
+
+        Args:
+            video_path: 视频文件路径
+            **sampling_params: 影响抽帧结果的参数（如num_frames）
+        """
+        size, mtime_ns, fingerprint = video_fingerprint(video_path)
+        # 帧编码也是键的一部分，有损编码的旧条目不会被当作无损条目命中
+        sampling_params = dict(sampling_params, cache_codec=self.codec)
+        params = ",".join(f"{name}={value}" for name, value in sorted(sampling_params.items()))
+        return hashlib.sha256(f"{size}:{mtime_ns}:{fingerprint}:{params}".encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + FRAME_STORE_SUFFIX)
+
+    def get(self, key):
+        """
+        读取缓存的帧
+
+        Returns:
+            tuple: (FrameStore（内存映射，按需解码，用法与数组相同）, 时间戳数组)；未命中或条目损坏返回None
+
+        返回的FrameStore归调用方所有: 对象释放时关闭内存映射，也可调用close()或用with提前关闭
+        """
+        path = self._path(key)
+        try:
+            frames = FrameStore(path)
+        except (FrameStoreError, OSError):
+            # 文件不存在或文件头、索引损坏都视为未命中
+            return None
+        # 更新修改时间作为最近使用时间（LRU淘汰依据）
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return frames, frames.timestamps
+
+    def put(self, key, frames, timestamps):
+        """写入缓存（原子写入），超出磁盘预算时淘汰最久未使用的条目"""
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp_', suffix=FRAME_STORE_SUFFIX, dir=self.cache_dir)
+        os.close(fd)
+        try:
+            write_frame_store(tmp_path, frames, timestamps, codec=self.codec, quality=CACHE_JPEG_QUALITY)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        self.evict()
+
+    def _entries(self):
+        """缓存条目: [(最近使用时间, 字节数, 键), ...]"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(FRAME_STORE_SUFFIX) or name.startswith('.tmp_'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name[:-len(FRAME_STORE_SUFFIX)]))
+        return entries
+
+    def evict(self):
+        """按最近使用时间淘汰条目直到不超过磁盘预算"""
+        if not self.max_bytes:
+            return
+        with self._lock:
+            entries = sorted(self._entries())
+            total_bytes = sum(size for _, size, _ in entries)
+            for _, size, key in entries:
+                if total_bytes <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(self._path(key))
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
+                print(f"帧缓存淘汰: {key[:12]} ({size / 1024 ** 2:.1f} MB)")
+
+    def get_stats(self):
+        """缓存统计: 条目数和占用字节数"""
+        entries = self._entries()
+        return {
+            "entries": len(entries),
+            "total_bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes,
+        }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_frame_cache(cache_dir=DEFAULT_CACHE_DIR, max_bytes=None):
+    """
+    获取缓存目录对应的帧缓存（同一目录共用一个实例）
+
+    Args:
+        max_bytes: 磁盘预算，None时使用环境变量VLM_FRAME_CACHE_MB或默认值
+
+    帧编码默认不压缩，可用环境变量VLM_FRAME_CACHE_CODEC选择png（省磁盘）或jpeg（有损）
+    """
+    with _caches_lock:
+        cache = _caches.get(cache_dir)
+        if cache is None:
+            if max_bytes is None:
+                env_mb = os.environ.get('VLM_FRAME_CACHE_MB')
+                max_bytes = int(float(env_mb) * 1024 ** 2) if env_mb else DEFAULT_MAX_BYTES
+            codec = os.environ.get('VLM_FRAME_CACHE_CODEC', CACHE_CODEC)
+            cache = _caches[cache_dir] = FrameCache(cache_dir, max_bytes, codec)
+        elif max_bytes is not None:
+            cache.max_bytes = max_bytes
+        return cache
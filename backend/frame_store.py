@@ -0,0 +1,223 @@
+"""
+帧存储格式 - 一个文件保存一段视频的若干帧，每帧单独编码（JPEG、PNG或不压缩的原始像素），支持随机访问
+
+文件布局:
+    文件头 (24字节): 魔数 b"VLMFRM01" + 索引偏移(uint64) + 索引长度(uint64)，小端
+    帧数据: 各帧编码后的数据依次拼接
+    索引: UTF-8 JSON {"codec": ..., "frames": [[偏移, 长度, 时间戳, [高, 宽, 通道]], ...], "meta": {...}}
+
+写入时帧数据边压缩边追加（录制时内存占用与帧数无关），关闭时写入索引并回填文件头，
+未正常关闭的文件没有有效文件头，读取时报错而不会返回残缺数据。
+读取时以内存映射方式打开，读取任意一帧只解码该帧；原始像素编码的帧直接映射为数组，不解码、不复制
+"""
+import io
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+from PIL import Image
+
+
+MAGIC = b"VLMFRM01"
+HEADER = struct.Struct("<8sQQ")
+
+CODEC_JPEG = "jpeg"  # 有损，体积小、解码快
+CODEC_PNG = "png"    # 无损，用于训练用的原始帧
+CODEC_RAW = "raw"    # 无损、不压缩，读取时直接内存映射，用于模型输入帧缓存（各帧尺寸须相同）
+CODECS = (CODEC_JPEG, CODEC_PNG, CODEC_RAW)
+DEFAULT_JPEG_QUALITY = 95
+
+FRAME_STORE_SUFFIX = ".frames"
+
+
+class FrameStoreError(ValueError):
+    """帧存储文件损坏或不完整"""
+
+
+class FrameStoreWriter:
+    """帧存储写入器 - 逐帧追加，close时写入索引（可用作上下文管理器）"""
+
+    def __init__(self, path, codec=CODEC_JPEG, quality=DEFAULT_JPEG_QUALITY, meta=None):
+        """
+        Args:
+            path: 输出文件路径
+            codec: "jpeg"、"png" 或 "raw"
+            quality: JPEG质量
+            meta: 写入索引的附加信息（需可JSON序列化）
+        """
+        if codec not in CODECS:
+            raise ValueError(f"不支持的帧编码: {codec}")
+        self.path = path
+        self.codec = codec
+        self.quality = quality
+        self.meta = dict(meta or {})
+        self._entries = []
+        self._file = open(path, 'wb')
+        # 文件头在close时回填，此前魔数为空，读取方不会把未完成的文件当作有效文件
+        self._file.write(HEADER.pack(b"\0" * len(MAGIC), 0, 0))
+
+    def append(self, frame, timestamp=None):
+        """
+        追加一帧
+
+        Args:
+            frame: (高, 宽, 3) 或 (高, 宽) 的uint8数组，或PIL图像
+            timestamp: 时间戳（秒），None时使用帧序号
+        """
+        array = np.asarray(frame)
+        if self.codec == CODEC_RAW:
+            # 原始像素依次拼接，读取时整段映射为 (帧数, 高, 宽, 通道) 数组
+            if self._entries and list(array.shape) != self._entries[0][3]:
+                raise ValueError(f"原始像素编码要求各帧尺寸相同: {array.shape} != {tuple(self._entries[0][3])}")
+            data = memoryview(np.ascontiguousarray(array, dtype=np.uint8)).cast('B')
+        else:
+            buffer = io.BytesIO()
+            image = Image.fromarray(array)
+            if self.codec == CODEC_JPEG:
+                image.save(buffer, format='JPEG', quality=self.quality)
+            else:
+                image.save(buffer, format='PNG', compress_level=1)
+            data = buffer.getbuffer()
+        offset = self._file.tell()
+        self._file.write(data)
+        self._entries.append([
+            offset, len(data), float(len(self._entries) if timestamp is None else timestamp), list(array.shape),
+        ])
+
+    def close(self):
+        """写入索引并回填文件头"""
+        if self._file.closed:
+            return
+        index = json.dumps({"codec": self.codec, "frames": self._entries, "meta": self.meta}).encode('utf-8')
+        index_offset = self._file.tell()
+        self._file.write(index)
+        self._file.flush()
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, index_offset, len(index)))
+        self._file.close()
+
+    def abort(self):
+        """放弃写入并删除文件"""
+        self._file.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_frame_store(path, frames, timestamps=None, codec=CODEC_JPEG, quality=DEFAULT_JPEG_QUALITY, meta=None):
+    """
+    一次写入全部帧
+
+    Args:
+        frames: 帧数组或帧列表
+        timestamps: 各帧时间戳（秒），可为 (帧数, 2) 的[开始, 结束]数组（取开始时间）
+    """
+    with FrameStoreWriter(path, codec, quality, meta) as writer:
+        for i, frame in enumerate(frames):
+            timestamp = None if timestamps is None else float(np.ravel(timestamps[i])[0])
+            writer.append(frame, timestamp)
+
+
+class FrameStore:
+    """
+    帧存储读取器 - 内存映射打开，按需解码
+
+    行为类似 (帧数, 高, 宽, 通道) 的数组: 支持len、下标、迭代和shape，np.array(store)解码全部帧；
+    原始像素编码时下标和np.asarray(store)返回内存映射数组（只读，不复制，关闭后仍可使用）
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                raise FrameStoreError(f"帧存储文件不完整: {path}")
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_offset, index_length = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or index_offset + index_length > size:
+            self._mmap.close()
+            raise FrameStoreError(f"帧存储文件不完整或格式不符: {path}")
+        try:
+            index = json.loads(self._mmap[index_offset:index_offset + index_length])
+            self.codec = index["codec"]
+            self.meta = index.get("meta", {})
+            self._entries = index["frames"]
+            self.timestamps = np.array([entry[2] for entry in self._entries])
+            self._frames = self._map_raw_frames() if self.codec == CODEC_RAW else None
+        except (ValueError, KeyError, TypeError, IndexError) as e:
+            self._mmap.close()
+            raise FrameStoreError(f"帧存储索引损坏: {path}") from e
+
+    def _map_raw_frames(self):
+        """把原始像素编码的帧数据映射为 (帧数, 高, 宽, 通道) 的只读数组"""
+        if not self._entries:
+            return np.zeros((0,), np.uint8)
+        first, length, _, shape = self._entries[0]
+        for i, (offset, size, _, frame_shape) in enumerate(self._entries):
+            if offset != first + i * length or size != length or frame_shape != shape:
+                raise ValueError("原始像素帧不连续或尺寸不一致")
+        if length != int(np.prod(shape)):
+            raise ValueError("原始像素帧长度与尺寸不符")
+        return np.memmap(self.path, dtype=np.uint8, mode='r', offset=first, shape=(len(self._entries), *shape))
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def shape(self):
+        """(帧数, 高, 宽, 通道)，以第一帧为准"""
+        if not self._entries:
+            return (0,)
+        return (len(self._entries), *self._entries[0][3])
+
+    def frame_bytes(self, i):
+        """第i帧的压缩数据（内存映射切片，不复制）"""
+        offset, length = self._entries[i][0], self._entries[i][1]
+        return memoryview(self._mmap)[offset:offset + length]
+
+    def __getitem__(self, i):
+        if self._frames is not None:
+            return self._frames[i]
+        if isinstance(i, slice):
+            return np.stack([self[j] for j in range(*i.indices(len(self)))])
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"帧序号超出范围: {i}")
+        offset, length = self._entries[i][0], self._entries[i][1]
+        with Image.open(io.BytesIO(self._mmap[offset:offset + length])) as image:
+            return np.asarray(image)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __array__(self, dtype=None, copy=None):
+        if self._frames is not None:
+            frames = np.array(self._frames) if copy else self._frames
+        else:
+            frames = np.stack(list(self)) if self._entries else np.zeros((0,), np.uint8)
+        return frames.astype(dtype) if dtype is not None else frames
+
+    def close(self):
+        # 原始像素的映射数组可能仍被调用方引用，随数组释放
+        self._frames = None
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,330 @@
+"""
+长视频分段摘要（map-reduce） - 按时间窗口切分视频，各分段并发生成描述，再对分段描述做一次汇总
+- map: 每个时间窗口单独抽帧（分段像素预算为整个视频预算的一部分，单次prefill不会过大），
+  远程模式同时提交所有分段请求，由服务器把并发到达的分段合并为批次生成；本地模式按max_batch_size组批生成
+- reduce: 带时间范围的分段描述和最终问题组成纯文本提示词，只生成一次
+- 分段描述按(视频内容指纹, 时间窗口, 分段提示词, 像素预算, 模型)缓存在磁盘上，
+  同一视频换一个最终问题时只执行reduce
+"""
+import concurrent.futures
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+try:
+    from .frame_cache import DEFAULT_CACHE_DIR, video_fingerprint
+    from .video_utils import FRAME_FACTOR, sample_video_frames
+    from .vlm_protocol import RETRYABLE_ERRORS, build_text_request, build_video_frames_request
+except ImportError:
+    from frame_cache import DEFAULT_CACHE_DIR, video_fingerprint
+    from video_utils import FRAME_FACTOR, sample_video_frames
+    from vlm_protocol import RETRYABLE_ERRORS, build_text_request, build_video_frames_request
+
+
+DEFAULT_SEGMENT_SECONDS = 60.0
+
+# 每个分段的像素预算 = 整个视频的像素预算 / SEGMENT_PIXELS_DIVISOR
+# （服务器组批时一批分段的视觉token数与一个完整视频相当）
+SEGMENT_PIXELS_DIVISOR = 4
+
+SEGMENT_PROMPT = "请详细描述这段视频中发生的事件、出现的人物和物体，以及场景的变化"
+REDUCE_PROMPT = (
+    "下面是一段视频按时间顺序的分段描述：\n{segments}\n\n"
+    "请根据以上描述回答问题：{question}"
+)
+
+# 服务器繁忙时的重试次数和单次最长等待（毫秒）
+MAX_BUSY_RETRIES = 5
+MAX_RETRY_DELAY_MS = 30000
+
+
+def video_duration(video_path):
+    """视频时长（秒）"""
+    from decord import VideoReader, cpu
+
+    vr = VideoReader(video_path, ctx=cpu(0))
+    return len(vr) / vr.get_avg_fps()
+
+
+def split_windows(duration, segment_seconds=DEFAULT_SEGMENT_SECONDS):
+    """
+    把视频切分为等长时间窗口，末尾不足四分之一窗口的部分并入前一个窗口
+
+    Returns:
+        list: [(开始秒, 结束秒), ...]
+    """
+    if duration <= segment_seconds:
+        return [(0.0, float(duration))]
+    bounds = list(np.arange(0, duration, segment_seconds)) + [duration]
+    if len(bounds) > 2 and bounds[-1] - bounds[-2] < segment_seconds / 4:
+        del bounds[-2]
+    return [(round(float(start), 3), round(float(end), 3)) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def format_time(seconds):
+    """秒数格式化为 MM:SS 或 H:MM:SS"""
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
+
+
+def build_reduce_prompt(segments, question):
+    """由分段描述和最终问题构造汇总提示词"""
+    lines = [
+        f"[{format_time(segment['start'])}-{format_time(segment['end'])}] {segment['caption']}"
+        for segment in segments
+    ]
+    return REDUCE_PROMPT.format(segments="\n".join(lines), question=question)
+
+
+class SegmentCache:
+    """分段描述缓存 - 每个条目一个JSON文件（先写临时文件再原子重命名）"""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = os.path.join(cache_dir, 'segments')
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(fingerprint, start, end, **params):
+        """
+        Args:
+            fingerprint: video_fingerprint的返回值
+            start, end: 时间窗口（秒）
+            **params: 影响描述结果的参数（分段提示词、像素预算、模型）
+        """
+        params = ",".join(f"{name}={value}" for name, value in sorted(params.items()))
+        return hashlib.sha256(f"{fingerprint}:{start}:{end}:{params}".encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def put(self, key, record):
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp_', suffix='.json', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(record, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+
+class RemoteSegmentRunner:
+    """通过VLM服务器执行分段描述和汇总（分段请求同时在途，由服务器组批）"""
+
+    def __init__(self, connection):
+        """
+        Args:
+            connection: 已就绪的VLMConnection（服务器需接受帧序列视频和纯文本请求）
+        """
+        metadata = connection.metadata or {}
+        if not metadata.get("video_frames") or not metadata.get("text"):
+            raise RuntimeError("服务器不支持帧序列视频或纯文本请求，无法分段摘要")
+        self.connection = connection
+        self.frame_budget = metadata["video_frames"]
+        self.model_id = f"{metadata.get('backend')}:{metadata.get('model_path')}"
+
+    def caption(self, segments, prompt):
+        """
+        Args:
+            segments: [(PIL图像列表, 时间戳, 抽帧帧率), ...]
+
+        Returns:
+            list: 各分段的描述
+        """
+        requests = [
+            build_video_frames_request(frames, timestamps, fps, prompt) for frames, timestamps, fps in segments
+        ]
+        futures = [self._submit(request, payload) for request, payload in requests]
+        return [self._result(future, request, payload) for future, (request, payload) in zip(futures, requests)]
+
+    def reduce(self, prompt):
+        request = build_text_request(prompt)
+        return self._result(self._submit(request), request)
+
+    def _submit(self, request, payload=None):
+        return self.connection.submit(self.connection.request(dict(request), payload))
+
+    def _result(self, future, request, payload=None):
+        """等待响应，服务器繁忙时按retry_after_ms退避后重新提交"""
+        for attempt in range(MAX_BUSY_RETRIES + 1):
+            response = future.result()
+            if response.get("error_code") not in RETRYABLE_ERRORS or attempt == MAX_BUSY_RETRIES:
+                break
+            time.sleep(min(response.get("retry_after_ms") or 1000, MAX_RETRY_DELAY_MS) / 1000)
+            future = self._submit(request, payload)
+        if "error" in response:
+            raise RuntimeError(f"服务器错误: {response['error']}")
+        if "error" in response.get("stats", {}):
+            raise RuntimeError(f"推理失败: {response['result']}")
+        return response["result"]
+
+
+class LocalSegmentRunner:
+    """在本进程中用已加载的模型执行分段描述（按max_batch_size组批生成）和汇总"""
+
+    def __init__(self, model, processor, model_path="", total_pixels=20480 * 28 * 28, min_pixels=16 * 28 * 28,
+                 max_batch_size=4, max_new_tokens=2048):
+        self.model = model
+        self.processor = processor
+        self.frame_budget = {"total_pixels": total_pixels, "min_pixels": min_pixels}
+        self.model_id = f"local:{model_path}"
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_new_tokens = max_new_tokens
+
+    def caption(self, segments, prompt):
+        import torch
+
+        results = []
+        for offset in range(0, len(segments), self.max_batch_size):
+            batch = segments[offset:offset + self.max_batch_size]
+            videos, fps_inputs = [], []
+            for frames, _, fps in batch:
+                # 帧已按像素预算缩放到28的倍数，帧数补齐到FRAME_FACTOR的倍数（重复最后一帧）
+                video = torch.from_numpy(np.stack([np.asarray(frame) for frame in frames])).permute(0, 3, 1, 2)
+                if len(video) % FRAME_FACTOR:
+                    video = torch.cat([video, video[-1:].expand(FRAME_FACTOR - len(video) % FRAME_FACTOR, -1, -1, -1)])
+                videos.append(video.float())
+                fps_inputs.append(fps)
+            texts = [self._chat_text([{"type": "text", "text": prompt}, {"type": "video"}])] * len(batch)
+            # 批量生成需要左侧padding，保证各序列的生成起点对齐；处理器与其他推理共用，用完恢复原设置
+            tokenizer = self.processor.tokenizer
+            padding_side = tokenizer.padding_side
+            tokenizer.padding_side = "left"
+            try:
+                inputs = self.processor(text=texts, videos=videos, fps=fps_inputs, padding=True, return_tensors="pt")
+            finally:
+                tokenizer.padding_side = padding_side
+            results.extend(self._generate(inputs))
+        return results
+
+    def reduce(self, prompt):
+        inputs = self.processor(text=[self._chat_text([{"type": "text", "text": prompt}])], return_tensors="pt")
+        return self._generate(inputs)[0]
+
+    def _chat_text(self, content):
+        messages = [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": content},
+        ]
+        return self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+    def _generate(self, inputs):
+        import torch
+
+        inputs = inputs.to(self.model.device)
+        with torch.no_grad():
+            output_ids = self.model.generate(**inputs, max_new_tokens=self.max_new_tokens)
+        generated_ids = [out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, output_ids)]
+        output_text = self.processor.batch_decode(
+            generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True
+        )
+        return [text.strip() for text in output_text]
+
+
+class VideoSummarizer:
+    """长视频分段摘要"""
+
+    def __init__(self, runner, segment_seconds=DEFAULT_SEGMENT_SECONDS, segment_prompt=SEGMENT_PROMPT,
+                 cache_dir=DEFAULT_CACHE_DIR, workers=4):
+        """
+        Args:
+            runner: RemoteSegmentRunner或LocalSegmentRunner
+            segment_seconds: 时间窗口长度（秒）
+            segment_prompt: 分段描述提示词
+            cache_dir: 帧缓存和分段描述缓存的目录
+            workers: 并行抽帧的线程数（decord解码时释放GIL）
+        """
+        self.runner = runner
+        self.segment_seconds = segment_seconds
+        self.segment_prompt = segment_prompt
+        self.cache_dir = cache_dir
+        self.workers = max(1, workers)
+        self.segment_cache = SegmentCache(cache_dir)
+        budget = runner.frame_budget
+        self.segment_pixels = budget["total_pixels"] // SEGMENT_PIXELS_DIVISOR
+        self.min_pixels = budget["min_pixels"]
+
+    def caption_segments(self, video_path):
+        """
+        各时间窗口的描述（缓存命中的分段不抽帧、不推理）
+
+        Returns:
+            tuple: ([{"start", "end", "caption", "cached"}, ...], 统计信息)
+        """
+        stats = {}
+        fingerprint = video_fingerprint(video_path)
+        windows = split_windows(video_duration(video_path), self.segment_seconds)
+        keys = [
+            self.segment_cache.make_key(
+                fingerprint, start, end,
+                prompt=self.segment_prompt, pixels=self.segment_pixels, min_pixels=self.min_pixels,
+                model=self.runner.model_id,
+            )
+            for start, end in windows
+        ]
+        segments = []
+        missing = []
+        for (start, end), key in zip(windows, keys):
+            record = self.segment_cache.get(key)
+            segments.append({
+                "start": start, "end": end,
+                "caption": record["caption"] if record is not None else None,
+                "cached": record is not None,
+            })
+            if record is None:
+                missing.append(len(segments) - 1)
+
+        if missing:
+            sample_start = time.time()
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+                inputs = list(pool.map(
+                    lambda i: sample_video_frames(
+                        video_path, self.segment_pixels, self.min_pixels, cache_dir=self.cache_dir,
+                        start=segments[i]["start"], end=segments[i]["end"],
+                    ),
+                    missing,
+                ))
+            stats["sample_ms"] = (time.time() - sample_start) * 1000
+
+            map_start = time.time()
+            captions = self.runner.caption(inputs, self.segment_prompt)
+            stats["map_ms"] = (time.time() - map_start) * 1000
+            for i, caption in zip(missing, captions):
+                segments[i]["caption"] = caption
+                self.segment_cache.put(keys[i], {
+                    "start": segments[i]["start"], "end": segments[i]["end"], "caption": caption,
+                })
+
+        stats.update(num_segments=len(segments), cached_segments=len(segments) - len(missing))
+        return segments, stats
+
+    def summarize(self, video_path, question):
+        """
+        分段描述后汇总回答问题
+
+        Returns:
+            tuple: (回答, 分段描述列表, 统计信息)
+        """
+        segments, stats = self.caption_segments(video_path)
+        reduce_start = time.time()
+        answer = self.runner.reduce(build_reduce_prompt(segments, question))
+        stats["reduce_ms"] = (time.time() - reduce_start) * 1000
+        print(f"分段摘要: {stats['num_segments']} 个分段（缓存命中 {stats['cached_segments']} 个）, "
+              + " ".join(f"{name}={stats[name]:.0f}ms" for name in ("sample_ms", "map_ms", "reduce_ms") if name in stats))
+        return answer, segments, stats
@@ -2,42 +2,66 @@
 视频处理工具 - 基于Qwen2.5-VL cookbook的视频帧提取和处理
 参考: /home/hyp/research/multimodal_demo/Qwen2.5-VL/cookbooks/video_understanding.ipynb
 """
-import os
 import math
-import hashlib
+import time
 import numpy as np
 from PIL import Image
 import decord
 from decord import VideoReader, cpu
 
+try:
+    from .frame_cache import get_frame_cache
+except ImportError:
+    from frame_cache import get_frame_cache
 
-def get_video_frames(video_path, num_frames=64, cache_dir='.cache'):
+
+# 抽帧和缩放规则 - 与qwen_vl_utils解码视频文件时一致，客户端抽帧的结果与服务器端相同
+IMAGE_FACTOR = 28
+FRAME_FACTOR = 2
+VIDEO_FPS = 2.0
+FPS_MIN_FRAMES = 4
+FPS_MAX_FRAMES = 768
+VIDEO_MAX_PIXELS = 768 * 28 * 28
+
+# 场景检测 - 按SCAN_FPS扫描缩小解码的帧，计算颜色直方图和灰度差分签名
+SCAN_FPS = 4.0
+SIGNATURE_WIDTH = 64
+SIGNATURE_HEIGHT = 36
+SIGNATURE_BATCH = 256
+HIST_BINS = 16
+SCENE_CUT_THRESHOLD = 0.15  # 相邻扫描帧直方图距离超过该值视为场景切换
+CHANGE_PER_KEYFRAME = 0.5   # 自上一关键帧起累计变化量超过该值时再取一帧
+
+
+def get_video_frames(video_path, num_frames=64, cache_dir='.cache', max_cache_bytes=None,
+                     start=None, end=None, total_pixels=None, min_pixels=None):
     """
-    提取视频关键帧 - 完全按照cookbook实现
+    提取视频关键帧 - 按照cookbook实现，抽取的帧写入磁盘帧缓存
     
     Args:
         video_path: 视频文件路径
         num_frames: 要提取的帧数
         cache_dir: 缓存目录
+        max_cache_bytes: 缓存磁盘预算（字节），None时使用默认值
+        start: 时间窗口起点（秒），None表示从头开始
+        end: 时间窗口终点（秒），None表示到结尾
+        total_pixels: 视频像素预算，指定时在解码时直接缩放到预算尺寸（缓存的也是缩放后的帧），None时为原始分辨率
+        min_pixels: 每帧最小像素数（与total_pixels一起使用）
         
     Returns:
-        tuple: (video_file_path, frames, timestamps)
+        tuple: (video_file_path, frames, timestamps)，命中缓存时frames为FrameStore（按需解码，用法与数组相同）
     """
-    os.makedirs(cache_dir, exist_ok=True)
-
-    # 生成视频hash用于缓存
-    video_hash = hashlib.md5(video_path.encode('utf-8')).hexdigest()
     video_file_path = video_path
+    cache = get_frame_cache(cache_dir, max_cache_bytes)
 
-    # 缓存文件路径
-    frames_cache_file = os.path.join(cache_dir, f'{video_hash}_{num_frames}_frames.npy')
-    timestamps_cache_file = os.path.join(cache_dir, f'{video_hash}_{num_frames}_timestamps.npy')
-
-    # 检查缓存
-    if os.path.exists(frames_cache_file) and os.path.exists(timestamps_cache_file):
+    # 缓存键包含文件大小、修改时间、内容指纹和抽帧参数
+    window = {} if start is None and end is None else {"start": start, "end": end}
+    budget = {} if total_pixels is None else {"total_pixels": total_pixels, "min_pixels": min_pixels}
+    cache_key = cache.make_key(video_path, num_frames=num_frames, sampling='linspace', **window, **budget)
+    cached = cache.get(cache_key)
+    if cached is not None:
         print(f"Loading cached frames for {video_path}")
-        frames = np.load(frames_cache_file)
-        timestamps = np.load(timestamps_cache_file)
+        frames, timestamps = cached
         return video_file_path, frames, timestamps
 
     # 使用decord读取视频 - 按照cookbook
@@ -47,22 +71,330 @@ def get_video_frames(video_path, num_frames=64, cache_dir='.cache'):
     
     print(f"Video has {total_frames} total frames")
 
-    # 等间隔采样帧
-    indices = np.linspace(0, total_frames - 1, num=num_frames, dtype=int)
+    # 等间隔采样帧（指定时间窗口时只在窗口内采样）
+    first, last = window_frame_range(total_frames, vr.get_avg_fps(), start, end)
+    indices = np.linspace(first, last, num=num_frames, dtype=int)
+    if budget:
+        vr = budget_video_reader(video_file_path, vr, len(indices), total_pixels, min_pixels)
     frames = vr.get_batch(indices).asnumpy()
     
     # 获取时间戳
     timestamps = np.array([vr.get_frame_timestamp(idx) for idx in indices])
 
     # 保存缓存
-    np.save(frames_cache_file, frames)
-    np.save(timestamps_cache_file, timestamps)
+    cache.put(cache_key, frames, timestamps)
     
     print(f"Extracted frames shape: {frames.shape}")
     
     return video_file_path, frames, timestamps
 
 
+def frame_signatures(video_path, indices, batch_size=SIGNATURE_BATCH):
+    """
+    计算帧签名 - 解码时直接缩小到SIGNATURE_WIDTH x SIGNATURE_HEIGHT，按批向量化计算
+    
+    Returns:
+        tuple: (颜色直方图 (帧数, 3 * HIST_BINS)，每个通道归一化, 灰度缩略图 (帧数, 高, 宽) float32)
+    """
+    vr = VideoReader(video_path, ctx=cpu(0), width=SIGNATURE_WIDTH, height=SIGNATURE_HEIGHT)
+    hists, thumbs = [], []
+    for offset in range(0, len(indices), batch_size):
+        batch = vr.get_batch(indices[offset:offset + batch_size]).asnumpy()
+        n = len(batch)
+        # 各通道量化为HIST_BINS级，一次bincount得到整批的直方图
+        codes = (batch >> (8 - int(math.log2(HIST_BINS)))).reshape(n, -1, 3).astype(np.int64)
+        codes += np.arange(3) * HIST_BINS + (np.arange(n) * 3 * HIST_BINS)[:, None, None]
+        hist = np.bincount(codes.ravel(), minlength=n * 3 * HIST_BINS).reshape(n, 3 * HIST_BINS)
+        hists.append(hist.astype(np.float32) / codes.shape[1])
+        thumbs.append(batch.mean(axis=3, dtype=np.float32))
+    return np.concatenate(hists), np.concatenate(thumbs)
+
+
+def scene_scores(hists, thumbs):
+    """
+    相邻帧的变化程度（第一帧为0）
+    
+    Returns:
+        tuple: (直方图距离，范围[0, 1]，反映画面内容变化, 平均灰度差分，范围[0, 1]，反映运动)
+    
+    直方图距离为各通道一维EMD（累积直方图之差）的平均，渐变（整体变亮、淡入淡出）只移动相邻的直方图区间，
+    距离小，不会被误判为场景切换
+    """
+    hist_dist = np.zeros(len(hists), np.float32)
+    pixel_diff = np.zeros(len(hists), np.float32)
+    if len(hists) > 1:
+        cdf = np.cumsum(hists.reshape(len(hists), 3, HIST_BINS), axis=2)
+        hist_dist[1:] = np.abs(np.diff(cdf, axis=0)).sum(axis=2).mean(axis=1) / (HIST_BINS - 1)
+        pixel_diff[1:] = np.abs(np.diff(thumbs, axis=0)).mean(axis=(1, 2)) / 255
+    return hist_dist, pixel_diff
+
+
+def select_keyframes(hist_dist, pixel_diff, max_frames, min_frames=FPS_MIN_FRAMES,
+                     cut_threshold=SCENE_CUT_THRESHOLD, change_per_keyframe=CHANGE_PER_KEYFRAME):
+    """
+    按场景切换和累计变化量选取关键帧
+    
+    每个场景的首帧必选，场景内累计变化每超过change_per_keyframe再取一帧：静止画面只取少量帧，
+    变化多的画面取更多帧；超过max_frames时增大变化阈值，场景切换仍超出时保留最明显的切换
+    
+    Returns:
+        numpy.ndarray: 选中帧在扫描序列中的位置（升序，个数为FRAME_FACTOR的倍数；
+            扫描帧数不足FRAME_FACTOR时重复最后一帧补齐）
+    """
+    n = len(hist_dist)
+    if n < FRAME_FACTOR:
+        # 时间窗口极短时扫描帧不够一组，全部选中并重复最后一帧
+        return np.pad(np.arange(n), (0, FRAME_FACTOR - n), mode='edge')
+    max_frames = max(FRAME_FACTOR, min(max_frames, n // FRAME_FACTOR * FRAME_FACTOR or FRAME_FACTOR))
+    cuts = np.flatnonzero(hist_dist >= cut_threshold)
+    change = np.cumsum(hist_dist + pixel_diff)
+    
+    def pick(delta):
+        levels = np.floor(change / delta)
+        return np.union1d(np.concatenate([[0], cuts]), np.flatnonzero(np.diff(levels) > 0) + 1)
+    
+    picks = pick(change_per_keyframe)
+    if len(picks) > max_frames:
+        if len(cuts) >= max_frames:
+            strongest = cuts[np.argsort(hist_dist[cuts])[::-1][:max_frames - 1]]
+            picks = np.union1d([0], strongest)
+        else:
+            # 二分查找使关键帧数不超过max_frames的最小变化阈值
+            low, high = change_per_keyframe, max(change_per_keyframe, float(change[-1])) + 1
+            for _ in range(30):
+                middle = (low + high) / 2
+                if len(pick(middle)) > max_frames:
+                    low = middle
+                else:
+                    high = middle
+            picks = pick(high)
+    
+    if len(picks) < min(min_frames, max_frames):
+        picks = np.union1d(picks, np.linspace(0, n - 1, min(min_frames, max_frames), dtype=int))
+    if len(picks) % FRAME_FACTOR:
+        if len(picks) < max_frames and len(picks) < n:
+            # 在最大间隔中点补一帧
+            gaps = np.diff(np.append(picks, n))
+            largest = int(np.argmax(gaps))
+            picks = np.union1d(picks, [picks[largest] + gaps[largest] // 2])
+        else:
+            # 去掉变化最小的一帧（保留首帧）
+            weakest = 1 + int(np.argmin(hist_dist[picks[1:]] + pixel_diff[picks[1:]]))
+            picks = np.delete(picks, weakest)
+    return picks
+
+
+def get_keyframes(video_path, max_frames=64, cache_dir='.cache', max_cache_bytes=None, min_frames=FPS_MIN_FRAMES,
+                  scan_fps=SCAN_FPS, start=None, end=None, total_pixels=None, min_pixels=None):
+    """
+    场景感知的关键帧抽取 - 以scan_fps扫描（比等间隔抽帧更密，短暂事件不易漏掉），
+    按场景切换和画面变化选取不超过max_frames个关键帧，静止视频只取少量帧
+    
+    Args:
+        video_path: 视频文件路径
+        max_frames: 关键帧数上限
+        cache_dir: 缓存目录
+        max_cache_bytes: 缓存磁盘预算（字节），None时使用默认值
+        min_frames: 关键帧数下限
+        scan_fps: 扫描帧率
+        start: 时间窗口起点（秒），None表示从头开始
+        end: 时间窗口终点（秒），None表示到结尾
+        total_pixels: 视频像素预算，指定时按选出的关键帧数在解码时缩放到预算尺寸
+        min_pixels: 每帧最小像素数（与total_pixels一起使用）
+        
+    Returns:
+        tuple: (video_file_path, frames, timestamps)，同get_video_frames（关键帧时间间隔不均匀）
+    """
+    cache = get_frame_cache(cache_dir, max_cache_bytes)
+    window = {} if start is None and end is None else {"start": start, "end": end}
+    budget = {} if total_pixels is None else {"total_pixels": total_pixels, "min_pixels": min_pixels}
+    cache_key = cache.make_key(
+        video_path, num_frames=max_frames, min_frames=min_frames, scan_fps=scan_fps, sampling='scene',
+        cut_threshold=SCENE_CUT_THRESHOLD, change_per_keyframe=CHANGE_PER_KEYFRAME, **window, **budget,
+    )
+    cached = cache.get(cache_key)
+    if cached is not None:
+        print(f"Loading cached keyframes for {video_path}")
+        frames, timestamps = cached
+        return video_path, frames, timestamps
+    
+    vr = VideoReader(video_path, ctx=cpu(0))
+    video_fps = vr.get_avg_fps()
+    first, last = window_frame_range(len(vr), video_fps, start, end)
+    step = max(1, int(round(video_fps / scan_fps)))
+    scan_indices = np.arange(first, last + 1, step)
+    
+    scan_start = time.time()
+    hist_dist, pixel_diff = scene_scores(*frame_signatures(video_path, scan_indices))
+    picks = select_keyframes(hist_dist, pixel_diff, max_frames, min_frames)
+    indices = scan_indices[picks]
+    cuts = int((hist_dist >= SCENE_CUT_THRESHOLD).sum())
+    print(f"场景检测: 扫描 {len(scan_indices)} 帧 ({(time.time() - scan_start) * 1000:.0f}ms), "
+          f"场景切换 {cuts} 处, 选取 {len(indices)} 个关键帧")
+    
+    if budget:
+        vr = budget_video_reader(video_path, vr, len(indices), total_pixels, min_pixels)
+    frames = vr.get_batch(indices).asnumpy()
+    timestamps = np.array([vr.get_frame_timestamp(idx) for idx in indices])
+    cache.put(cache_key, frames, timestamps)
+    return video_path, frames, timestamps
+
+
+def budget_video_reader(video_path, vr, nframes, total_pixels, min_pixels):
+    """
+    按视频像素预算在解码时缩放的VideoReader - 帧在解码器中直接缩小，不会解码出一整批原始分辨率的帧
+    
+    Args:
+        vr: 已打开的原始分辨率VideoReader（用于读取原始尺寸）
+        nframes: 要解码的帧数（预算按帧数分摊）
+        
+    Returns:
+        VideoReader: 原始尺寸已符合预算时返回vr本身
+    """
+    height, width = vr[0].shape[:2]
+    resized_height, resized_width = budget_frame_size(height, width, nframes, total_pixels, min_pixels)
+    if (resized_height, resized_width) == (height, width):
+        return vr
+    return VideoReader(video_path, ctx=cpu(0), width=resized_width, height=resized_height)
+
+
+def window_frame_range(total_frames, video_fps, start=None, end=None):
+    """
+    时间窗口对应的帧序号范围
+    
+    Returns:
+        tuple: (首帧序号, 末帧序号)，均在[0, total_frames - 1]内
+    """
+    first = 0 if start is None else min(int(start * video_fps), total_frames - 1)
+    last = total_frames - 1 if end is None else min(math.ceil(end * video_fps), total_frames) - 1
+    return first, max(first, last)
+
+
+def smart_resize(height, width, min_pixels, max_pixels, factor=IMAGE_FACTOR):
+    """
+    缩放尺寸 - 宽高为factor的倍数，像素数在[min_pixels, max_pixels]内，尽量保持宽高比
+    
+    Returns:
+        tuple: (高, 宽)
+    """
+    h_bar = max(factor, round(height / factor) * factor)
+    w_bar = max(factor, round(width / factor) * factor)
+    if h_bar * w_bar > max_pixels:
+        beta = math.sqrt((height * width) / max_pixels)
+        h_bar = max(factor, math.floor(height / beta / factor) * factor)
+        w_bar = max(factor, math.floor(width / beta / factor) * factor)
+    elif h_bar * w_bar < min_pixels:
+        beta = math.sqrt(min_pixels / (height * width))
+        h_bar = math.ceil(height * beta / factor) * factor
+        w_bar = math.ceil(width * beta / factor) * factor
+    return h_bar, w_bar
+
+
+def budget_frame_size(height, width, nframes, total_pixels, min_pixels):
+    """
+    按视频像素预算计算每帧缩放尺寸 - 总预算按帧数分摊（每FRAME_FACTOR帧合并为一组视觉token）
+    
+    Returns:
+        tuple: (高, 宽)
+    """
+    max_pixels = max(min(VIDEO_MAX_PIXELS, total_pixels / nframes * FRAME_FACTOR), int(min_pixels * 1.05))
+    return smart_resize(height, width, min_pixels, max_pixels)
+
+
+def estimate_video_tokens(nframes, height, width, total_pixels, min_pixels):
+    """
+    估算视频输入的视觉token数（帧数补齐到FRAME_FACTOR的倍数、按像素预算缩放后，每FRAME_FACTOR帧、
+    每28x28像素一个token），在送入模型前用于报告和预算控制
+    """
+    nframes = -(-nframes // FRAME_FACTOR) * FRAME_FACTOR
+    resized_height, resized_width = budget_frame_size(height, width, nframes, total_pixels, min_pixels)
+    return int(nframes / FRAME_FACTOR * resized_height / IMAGE_FACTOR * resized_width / IMAGE_FACTOR)
+
+
+def frames_to_video_input(frames, timestamps, total_pixels, min_pixels):
+    """
+    把已提取的帧转换为处理器的视频输入（与process_vision_info解码视频文件的输出格式一致）
+    
+    Args:
+        frames: (帧数, 高, 宽, 3) 的uint8数组
+        timestamps: 各帧时间戳（秒），可为 (帧数, 2) 的[开始, 结束]数组
+        
+    Returns:
+        tuple: ((帧数, 3, 高, 宽) 的float张量, 抽帧帧率)
+    """
+    import torch
+    from torchvision.transforms import InterpolationMode
+    from torchvision.transforms.functional import resize
+    
+    # 帧数补齐到FRAME_FACTOR的倍数（重复最后一帧）
+    video = torch.from_numpy(np.array(frames)).permute(0, 3, 1, 2)
+    if len(video) % FRAME_FACTOR:
+        padding = FRAME_FACTOR - len(video) % FRAME_FACTOR
+        video = torch.cat([video, video[-1:].expand(padding, -1, -1, -1)])
+    
+    nframes, _, height, width = video.shape
+    resized_height, resized_width = budget_frame_size(height, width, nframes, total_pixels, min_pixels)
+    video = resize(
+        video, [resized_height, resized_width], interpolation=InterpolationMode.BICUBIC, antialias=True
+    ).float()
+    
+    starts = [float(np.ravel(t)[0]) for t in timestamps]
+    if len(starts) > 1 and starts[-1] > starts[0]:
+        sample_fps = (len(starts) - 1) / (starts[-1] - starts[0])
+    else:
+        sample_fps = VIDEO_FPS
+    return video, sample_fps
+
+
+def sample_video_frames(video_path, total_pixels, min_pixels, fps=VIDEO_FPS, cache_dir='.cache',
+                        start=None, end=None, adaptive=False):
+    """
+    按服务器声明的像素预算在本地抽帧并缩放，用于以帧序列代替视频文件上传
+    
+    Args:
+        video_path: 视频文件路径
+        total_pixels: 整个视频（或时间窗口）的像素预算
+        min_pixels: 每帧最小像素数
+        fps: 抽帧帧率
+        cache_dir: 帧缓存目录
+        start: 时间窗口起点（秒），None表示从头开始
+        end: 时间窗口终点（秒），None表示到结尾
+        adaptive: 为True时按场景变化选取关键帧（帧数不超过按fps计算的帧数）
+        
+    Returns:
+        tuple: (缩放后的PIL图像列表, 各帧时间戳（秒）, 实际抽帧帧率)
+    """
+    vr = VideoReader(video_path, ctx=cpu(0))
+    video_fps = vr.get_avg_fps()
+    first, last = window_frame_range(len(vr), video_fps, start, end)
+    total_frames = last - first + 1
+    del vr
+    
+    # 帧数: 按fps抽帧，限制在[FPS_MIN_FRAMES, FPS_MAX_FRAMES]内并取FRAME_FACTOR的倍数
+    max_frames = max(FRAME_FACTOR, min(FPS_MAX_FRAMES, total_frames) // FRAME_FACTOR * FRAME_FACTOR)
+    nframes = min(max(total_frames / video_fps * fps, FPS_MIN_FRAMES), max_frames)
+    nframes = max(FRAME_FACTOR, int(nframes // FRAME_FACTOR) * FRAME_FACTOR)
+    # 解码时直接缩放到预算尺寸，帧缓存中保存的也是缩放后的帧
+    budget = {"total_pixels": total_pixels, "min_pixels": min_pixels}
+    if adaptive:
+        _, frames, timestamps = get_keyframes(video_path, nframes, cache_dir, start=start, end=end, **budget)
+        nframes = len(frames)
+        starts = [float(np.ravel(t)[0]) for t in timestamps]
+        # 关键帧间隔不均匀，以平均帧率作为时间位置编码的帧率
+        sample_fps = (nframes - 1) / (starts[-1] - starts[0]) if starts[-1] > starts[0] else fps
+    else:
+        _, frames, timestamps = get_video_frames(video_path, nframes, cache_dir, start=start, end=end, **budget)
+        sample_fps = nframes / max(total_frames, 1e-6) * video_fps
+    
+    height, width = frames.shape[1:3]
+    print(f"预计视频token数: {estimate_video_tokens(nframes, height, width, total_pixels, min_pixels)} ({nframes}帧)")
+    resized_height, resized_width = budget_frame_size(height, width, nframes, total_pixels, min_pixels)
+    images = [Image.fromarray(frame) for frame in frames]
+    if (resized_height, resized_width) != (height, width):
+        images = [image.resize((resized_width, resized_height), Image.BICUBIC) for image in images]
+    return images, [float(np.ravel(t)[0]) for t in timestamps], sample_fps
+
+
 def create_image_grid(images, num_columns=8):
     """
     创建图像网格显示 - 按照cookbook实现
@@ -96,9 +428,11 @@ def create_image_grid(images, num_columns=8):
 
 def inference_video_with_frames(model, processor, video_path, prompt, 
                                max_new_tokens=2048, num_frames=64,
-                               total_pixels=20480 * 28 * 28, min_pixels=16 * 28 * 28):
+                               total_pixels=20480 * 28 * 28, min_pixels=16 * 28 * 28,
+                               adaptive=False, cache_dir='.cache', **generate_kwargs):
     """
-    使用提取的帧进行视频推理 - 完全按照cookbook实现
+    使用提取的帧进行视频推理 - 按照cookbook实现，已提取（或缓存）的帧直接作为处理器的视频输入，
+    视频只解码一次，重复运行同一视频时完全跳过解码
     
     Args:
         model: Qwen2.5-VL模型
@@ -106,15 +440,27 @@ def inference_video_with_frames(model, processor, video_path, prompt,
         video_path: 视频文件路径
         prompt: 提示词
         max_new_tokens: 最大生成token数
-        num_frames: 提取帧数
+        num_frames: 提取帧数（adaptive为True时为关键帧数上限）
         total_pixels: 总像素数配置
         min_pixels: 最小像素数配置
+        adaptive: 为True时按场景变化选取关键帧，静止视频使用更少的帧和视觉token
+        cache_dir: 帧缓存目录
+        **generate_kwargs: 传给model.generate的其他参数（如stopping_criteria）
         
     Returns:
         str: 模型输出文本
     """
-    # Step 1: 提取视频帧 - 按照cookbook
-    video_file_path, frames, timestamps = get_video_frames(video_path, num_frames)
+    # Step 1: 提取视频帧（命中缓存时不解码视频）
+    decode_start = time.time()
+    if adaptive:
+        video_file_path, frames, timestamps = get_keyframes(video_path, num_frames, cache_dir)
+    else:
+        video_file_path, frames, timestamps = get_video_frames(video_path, num_frames, cache_dir)
+    decode_time = time.time() - decode_start
+    
+    # 送入模型前报告视觉token数
+    num_video_tokens = estimate_video_tokens(len(frames), *frames.shape[1:3], total_pixels, min_pixels)
+    print(f"num of video tokens: {num_video_tokens} ({len(frames)} frames)")
     
     # Step 2: 构建消息格式 - 完全按照cookbook
     messages = [
@@ -126,31 +472,35 @@ def inference_video_with_frames(model, processor, video_path, prompt,
         },
     ]
     
-    # Step 3: 处理消息 - 按照cookbook
-    from qwen_vl_utils import process_vision_info
+    # Step 3: 直接使用已提取的帧 - 按像素预算缩放，不再由process_vision_info重新解码视频
+    resize_start = time.time()
     text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    image_inputs, video_inputs, video_kwargs = process_vision_info([messages], return_video_kwargs=True)
-    fps_inputs = video_kwargs['fps']
+    video_input, sample_fps = frames_to_video_input(frames, timestamps, total_pixels, min_pixels)
+    resize_time = time.time() - resize_start
     
-    print(f"video input: {video_inputs[0].shape}")
-    num_frames_processed, _, resized_height, resized_width = video_inputs[0].shape
-    num_video_tokens = int(num_frames_processed / 2 * resized_height / 28 * resized_width / 28)
-    print(f"num of video tokens: {num_video_tokens}")
+    print(f"video input: {video_input.shape}")
     
     # Step 4: 准备输入
+    preprocess_start = time.time()
     inputs = processor(
         text=[text], 
-        images=image_inputs, 
-        videos=video_inputs, 
-        fps=fps_inputs, 
+        images=None, 
+        videos=[video_input], 
+        fps=[sample_fps], 
         padding=True, 
         return_tensors="pt"
     )
     inputs = inputs.to(model.device)
+    preprocess_time = time.time() - preprocess_start
 
     # Step 5: 生成输出 - 按照cookbook
-    output_ids = model.generate(**inputs, max_new_tokens=max_new_tokens)
+    generate_start = time.time()
+    output_ids = model.generate(**inputs, max_new_tokens=max_new_tokens, **generate_kwargs)
     generated_ids = [output_ids[len(input_ids):] for input_ids, output_ids in zip(inputs.input_ids, output_ids)]
     output_text = processor.batch_decode(generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+    generate_time = time.time() - generate_start
+    
+    print(f"视频推理耗时: 解码={decode_time * 1000:.0f}ms 缩放={resize_time * 1000:.0f}ms "
+          f"预处理={preprocess_time * 1000:.0f}ms 生成={generate_time * 1000:.0f}ms")
     
     return output_text[0]
\ No newline at end of file
@@ -0,0 +1,283 @@
+"""
+VLM持久连接 - 与VLM服务器保持一条长连接，多个请求共用
+后台线程运行独立的事件循环，提供保活、断线自动重连和按request_id分发响应（不依赖PyQt）
+"""
+import asyncio
+import itertools
+import json
+import logging
+import threading
+import time
+
+import websockets
+import websockets.asyncio.client as client
+
+from .vlm_protocol import send_binary_payload, send_file_payload
+
+logger = logging.getLogger(__name__)
+
+
+class VLMConnection:
+    """VLM服务器持久连接管理器"""
+
+    def __init__(self, host="localhost", port=8000, keepalive_s=20, reconnect_delay_s=1,
+                 max_reconnect_delay_s=30, connect_timeout_s=10):
+        """
+        Args:
+            host: 服务器地址
+            port: 服务器端口
+            keepalive_s: websocket ping间隔（秒），超过同样时长未收到pong视为断线
+            reconnect_delay_s: 首次重连等待时间（秒），连续失败时指数增长
+            max_reconnect_delay_s: 重连等待时间上限（秒）
+            connect_timeout_s: 请求等待连接建立的最长时间（秒）
+        """
+        self.uri = f"ws://{host}:{port}"
+        self.keepalive_s = keepalive_s
+        self.reconnect_delay_s = reconnect_delay_s
+        self.max_reconnect_delay_s = max_reconnect_delay_s
+        self.connect_timeout_s = connect_timeout_s
+
+        self.metadata = None
+        self.last_error = None
+        self._websocket = None
+        self._loop = None
+        self._thread = None
+        self._ready = threading.Event()  # 供其他线程等待首次连接
+        self._connected = None           # asyncio.Event，连接可用时置位
+        self._stopping = None            # asyncio.Event，stop()时置位
+        self._send_lock = None           # 同一请求的头帧和负载帧之间不能插入其他帧
+        self._serial_lock = None         # 服务器不支持多路复用时逐个请求
+        self._pending = {}               # request_id -> asyncio.Queue
+        self._cancels = set()            # 发送中的cancel消息任务
+        self._ids = itertools.count(1)
+
+    @property
+    def connected(self):
+        return self._websocket is not None
+
+    @property
+    def multiplex(self):
+        """服务器是否支持同一连接上并发多个请求"""
+        return bool(self.metadata and self.metadata.get("multiplex", False))
+
+    @property
+    def supports_cancel(self):
+        """服务器是否支持cancel消息"""
+        return bool(self.metadata and self.metadata.get("cancel", False))
+
+    def start(self):
+        """启动后台事件循环线程并开始连接"""
+        if self._thread is not None:
+            return
+        self._loop = asyncio.new_event_loop()
+        self._connected = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._send_lock = asyncio.Lock()
+        self._serial_lock = asyncio.Lock()
+        self._thread = threading.Thread(target=self._thread_main, name="vlm-connection", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """关闭连接并停止后台线程"""
+        if self._thread is None:
+            return
+        self._loop.call_soon_threadsafe(self._stopping.set)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def wait_ready(self, timeout=None):
+        """
+        阻塞等待首次连接成功
+
+        Returns:
+            dict: 服务器元数据
+        """
+        if not self._ready.wait(timeout if timeout is not None else self.connect_timeout_s):
+            raise ConnectionError(f"连接服务器超时: {self.uri} ({self.last_error})")
+        return self.metadata
+
+    def submit(self, coro):
+        """
+        在连接的事件循环中执行协程（供其他线程调用）
+
+        Returns:
+            concurrent.futures.Future: 调用其cancel()会取消协程，进行中的请求随即通知服务器取消
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def run(self, coro, timeout=None):
+        """在连接的事件循环中执行协程并阻塞等待结果（供其他线程调用）"""
+        return self.submit(coro).result(timeout)
+
+    def _thread_main(self):
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._run())
+        finally:
+            self._loop.close()
+
+    async def _run(self):
+        """连接循环 - 断线后按指数退避重连，直到stop()"""
+        stop_task = asyncio.ensure_future(self._stopping.wait())
+        delay = self.reconnect_delay_s
+
+        while not self._stopping.is_set():
+            try:
+                async with client.connect(
+                    self.uri,
+                    ping_interval=self.keepalive_s,
+                    ping_timeout=self.keepalive_s,
+                    compression=None,
+                    max_size=None,
+                ) as websocket:
+                    metadata = json.loads(await websocket.recv())
+                    if metadata.get("status") == "busy":
+                        # 服务器连接数已满，按建议时间退避后重连
+                        delay = min(max(delay, metadata.get("retry_after_ms", 0) / 1000), self.max_reconnect_delay_s)
+                        raise ConnectionError(metadata.get("error", "服务器繁忙"))
+                    self.metadata = metadata
+                    self._websocket = websocket
+                    self.last_error = None
+                    self._connected.set()
+                    self._ready.set()
+                    delay = self.reconnect_delay_s
+                    logger.info(f"已连接VLM服务器: {self.uri}")
+
+                    reader = asyncio.ensure_future(self._read_loop(websocket))
+                    await asyncio.wait({reader, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+                    reader.cancel()
+            except (OSError, ValueError, websockets.WebSocketException, asyncio.TimeoutError) as e:
+                self.last_error = e
+                logger.warning(f"VLM服务器连接失败: {e}")
+            finally:
+                self._websocket = None
+                self._connected.clear()
+                self._fail_pending(ConnectionError(f"与VLM服务器的连接已断开: {self.last_error or '连接关闭'}"))
+
+            if self._stopping.is_set():
+                break
+            try:
+                await asyncio.wait_for(self._stopping.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            delay = min(delay * 2, self.max_reconnect_delay_s)
+
+        stop_task.cancel()
+
+    async def _read_loop(self, websocket):
+        """读取服务器消息并按request_id分发给等待中的请求"""
+        try:
+            async for message in websocket:
+                if not isinstance(message, str):
+                    logger.warning(f"忽略服务器二进制消息: {len(message)} 字节")
+                    continue
+                response = json.loads(message)
+                request_id = response.get("request_id")
+                if request_id is None and self._pending:
+                    # 不支持多路复用的服务器不回传request_id，此时只有一个请求在等待
+                    request_id = next(iter(self._pending))
+                queue = self._pending.get(request_id)
+                if queue is None:
+                    if response.get("type") == "cancelled":
+                        # 已放弃的请求的取消确认
+                        continue
+                    logger.warning(f"丢弃无人等待的响应: {request_id}")
+                    continue
+                queue.put_nowait(response)
+        except websockets.ConnectionClosed as e:
+            self.last_error = e
+
+    def _fail_pending(self, error):
+        for queue in self._pending.values():
+            queue.put_nowait(error)
+
+    async def _wait_connected(self):
+        try:
+            await asyncio.wait_for(self._connected.wait(), self.connect_timeout_s)
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"VLM服务器不可用: {self.uri} ({self.last_error})")
+        return self._websocket
+
+    async def request(self, request, payload=None, file_path=None, on_delta=None):
+        """
+        发送一个请求并等待其最终响应（需在连接的事件循环中调用，可并发调用）
+
+        Args:
+            request: 请求字典（自动添加request_id）
+            payload: 头帧之后发送的内存二进制负载
+            file_path: 头帧之后分块发送的文件
+            on_delta: 流式文本增量回调
+
+        Returns:
+            dict: 最终响应（final消息或错误），client_timing字段为客户端测得的
+                upload_ms（发送头帧和负载）、first_delta_ms（首个文本增量）和rtt_ms（发送到收到最终响应）
+
+        调用方取消等待时向服务器发送cancel消息，服务器随即停止该请求的生成
+        """
+        await self._wait_connected()
+        if not self.multiplex:
+            async with self._serial_lock:
+                return await self._request(request, payload, file_path, on_delta)
+        return await self._request(request, payload, file_path, on_delta)
+
+    async def _request(self, request, payload, file_path, on_delta):
+        websocket = await self._wait_connected()
+        request_id = str(next(self._ids))
+        queue = asyncio.Queue()
+        self._pending[request_id] = queue
+        client_timing = {}
+        send_start = time.time()
+        # 发送放在独立任务中，取消等待时也会把头帧和负载帧发完，避免服务器端协议失步
+        send = asyncio.ensure_future(
+            self._send_request(websocket, dict(request, request_id=request_id), payload, file_path)
+        )
+        try:
+            await asyncio.shield(send)
+            client_timing["upload_ms"] = (time.time() - send_start) * 1000
+
+            while True:
+                response = await queue.get()
+                if isinstance(response, Exception):
+                    raise response
+                if response.get("type") == "delta":
+                    if "first_delta_ms" not in client_timing:
+                        client_timing["first_delta_ms"] = (time.time() - send_start) * 1000
+                    if on_delta is not None:
+                        on_delta(response["text"])
+                    continue
+                client_timing["rtt_ms"] = (time.time() - send_start) * 1000
+                response["client_timing"] = client_timing
+                return response
+        except asyncio.CancelledError:
+            if self.supports_cancel:
+                task = asyncio.ensure_future(self._send_cancel(websocket, request_id, send))
+                self._cancels.add(task)
+                task.add_done_callback(self._cancels.discard)
+            raise
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def _send_request(self, websocket, request, payload, file_path):
+        """发送头帧和负载帧（持有发送锁，帧之间不插入其他请求的帧）"""
+        async with self._send_lock:
+            await websocket.send(json.dumps(request))
+            if payload is not None:
+                await send_binary_payload(websocket, payload)
+            elif file_path is not None:
+                await send_file_payload(websocket, file_path)
+
+    async def _send_cancel(self, websocket, request_id, send):
+        """请求发送完毕后通知服务器取消该请求"""
+        try:
+            await send
+            async with self._send_lock:
+                await websocket.send(json.dumps({"type": "cancel", "request_id": request_id}))
+            logger.info(f"已取消请求: {request_id}")
+        except (OSError, websockets.WebSocketException) as e:
+            # 连接已断开，服务器会随连接一起取消该请求
+            logger.debug(f"发送取消消息失败: {e}")
+
+    async def probe_media(self, sha256):
+        """询问服务器媒体存储中是否已有该文件"""
+        status = await self.request({"type": "media_probe", "sha256": sha256})
+        return bool(status.get("present"))
@@ -5,6 +5,7 @@ VLM处理器 - 基于Qwen2.5-VL官方代码的视觉语言模型处理模块
 """
 import os
 import tempfile
+import threading
 from PyQt5.QtCore import QObject, QThread, pyqtSignal
 import cv2
 import numpy as np
@@ -60,6 +61,7 @@ class VLMWorker(QThread):
         self.processing_type = "image"  # "image" 或 "video"
         self.video_path = None
         self.prompt = None
+        self._stop_event = threading.Event()
         
     def set_image_messages(self, messages):
         """设置图像处理消息"""
@@ -72,6 +74,20 @@ class VLMWorker(QThread):
         self.prompt = prompt
         self.processing_type = "video"
     
+    def stop(self):
+        """请求停止 - generate在下一个decode步结束，线程随后正常退出（可在任意线程调用）"""
+        self._stop_event.set()
+    
+    def _stopping_criteria(self):
+        """每生成一步检查停止标志的停止条件"""
+        from transformers import StoppingCriteriaList
+        stop_event = self._stop_event
+        
+        def should_stop(input_ids, scores, **kwargs):
+            return torch.full((input_ids.shape[0],), stop_event.is_set(), dtype=torch.bool, device=input_ids.device)
+        
+        return StoppingCriteriaList([should_stop])
+    
     def run(self):
         """执行VLM推理"""
         try:
@@ -84,9 +100,11 @@ class VLMWorker(QThread):
                     self.model, 
                     self.processor, 
                     self.video_path, 
-                    self.prompt
+                    self.prompt,
+                    stopping_criteria=self._stopping_criteria(),
                 )
-                self.text_ready.emit(result)
+                if not self._stop_event.is_set():
+                    self.text_ready.emit(result)
                 
             elif self.processing_type == "image" and self.messages:
                 # 处理图像 - 按照官方代码
@@ -108,9 +126,13 @@ class VLMWorker(QThread):
                     return_tensors="pt"
                 )
                 inputs = inputs.to(self.model.device)
+                if self._stop_event.is_set():
+                    return
                 
                 # 生成回复
-                generated_ids = self.model.generate(**inputs, max_new_tokens=512)
+                generated_ids = self.model.generate(
+                    **inputs, max_new_tokens=512, stopping_criteria=self._stopping_criteria()
+                )
                 generated_ids_trimmed = [
                     out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
                 ]
@@ -120,12 +142,14 @@ class VLMWorker(QThread):
                     clean_up_tokenization_spaces=False
                 )
                 
-                self.text_ready.emit(output_text[0])
+                if not self._stop_event.is_set():
+                    self.text_ready.emit(output_text[0])
             else:
                 self.error_occurred.emit("没有有效的输入数据")
             
         except Exception as e:
-            self.error_occurred.emit(f"VLM处理错误: {str(e)}")
+            if not self._stop_event.is_set():
+                self.error_occurred.emit(f"VLM处理错误: {str(e)}")
 
 
 class VLMProcessor(QObject):
@@ -230,9 +254,7 @@ class VLMProcessor(QObject):
         ]
         
         # 停止之前的处理
-        if self.worker and self.worker.isRunning():
-            self.worker.terminate()
-            self.worker.wait()
+        self.stop_processing()
         
         # 创建新的工作线程，使用图像处理模式
         self.worker = VLMWorker(self.model, self.processor)
@@ -279,9 +301,7 @@ class VLMProcessor(QObject):
             return
         
         # 停止之前的处理
-        if self.worker and self.worker.isRunning():
-            self.worker.terminate()
-            self.worker.wait()
+        self.stop_processing()
         
         # 创建新的工作线程，使用视频处理模式
         self.worker = VLMWorker(self.model, self.processor)
@@ -310,7 +330,7 @@ class VLMProcessor(QObject):
         return self.worker and self.worker.isRunning()
     
     def stop_processing(self):
-        """停止当前处理"""
+        """停止当前处理 - 协作式停止，等待generate在下一个decode步结束（不在CUDA调用中途终止线程）"""
         if self.worker and self.worker.isRunning():
-            self.worker.terminate()
+            self.worker.stop()
             self.worker.wait()
\ No newline at end of file
@@ -0,0 +1,273 @@
+"""
+VLM websocket协议 - 客户端与服务器共用的协议常量和二进制负载收发
+协议协商: 服务器在连接元数据的protocols字段中声明支持的传输方式，客户端择优使用
+
+二进制传输格式:
+    1. JSON头帧，payload字段声明负载长度和类型
+       {"type": "image", "prompt": "...", "payload": {"length": 12345, "media_type": "image/png"}}
+    2. 若干个二进制帧，按顺序拼接后共length字节
+
+视频文件按BINARY_CHUNK_SIZE分块读取发送，服务器边收边写入磁盘，两端内存占用都与视频长度无关
+
+内容寻址: 服务器声明media_store时，客户端先发送media_probe询问是否已有该文件的SHA-256，
+命中则请求中只携带media_sha256，不再上传
+
+多路复用: 服务器声明multiplex时，请求可携带request_id，客户端在同一连接上连续发送多个请求，
+服务器的delta、final、error和media_status消息都带回对应的request_id，响应按完成顺序返回
+（同一请求的头帧和负载帧之间不能插入其他请求的帧）
+
+取消: 服务器声明cancel时，客户端可发送 {"type": "cancel", "request_id": "..."} 放弃进行中的请求，
+服务器停止该请求的生成（排队中的直接跳过）并回复 {"type": "cancelled", "request_id": "..."}；
+cancel必须在该请求的负载帧发送完毕之后发送
+
+帧序列视频: 服务器声明video_frames（视频像素预算）时，客户端可在本地抽帧并缩放到预算内，
+以JPEG帧序列代替整个视频文件上传；请求的frames字段给出各帧字节数、时间戳（秒）和抽帧帧率，
+负载为各帧JPEG数据按顺序拼接
+    {"type": "video", "prompt": "...", "frames": {"lengths": [...], "timestamps": [...], "fps": 2.0},
+     "payload": {"length": 123456, "media_type": "video/x-jpeg-frames"}}
+
+准入控制: 请求可携带deadline_ms（从服务器收到请求起允许的最长等待，毫秒），服务器过载或预计无法
+在截止时间前开始执行时立即回复带error_code和retry_after_ms的错误；连接元数据的load字段为当前负载
+"""
+import base64
+import hashlib
+import io
+import os
+
+# 传输方式
+PROTOCOL_JSON = "json"      # 媒体数据base64编码后放在JSON中（旧协议）
+PROTOCOL_BINARY = "binary"  # JSON头帧 + 原始二进制帧
+
+SUPPORTED_PROTOCOLS = [PROTOCOL_BINARY, PROTOCOL_JSON]
+
+# 二进制负载分帧大小
+BINARY_CHUNK_SIZE = 1024 * 1024
+
+# 帧序列视频的媒体类型、JPEG质量和最大帧数
+FRAMES_MEDIA_TYPE = "video/x-jpeg-frames"
+FRAMES_JPEG_QUALITY = 90
+MAX_VIDEO_FRAMES = 768
+
+# 错误码
+ERROR_MEDIA_MISSING = "media_missing"  # 请求引用的media_sha256不在服务器媒体存储中
+ERROR_OVERLOADED = "overloaded"            # 服务器在途请求已满，按retry_after_ms退避后重试
+ERROR_CLIENT_LIMIT = "client_limit"        # 本客户端在途请求已达上限
+ERROR_DEADLINE_EXCEEDED = "deadline_exceeded"  # 无法在请求的deadline_ms内开始执行
+
+# 可在retry_after_ms后重试的错误
+RETRYABLE_ERRORS = (ERROR_OVERLOADED, ERROR_CLIENT_LIMIT)
+
+# 文件哈希缓存: (路径, 大小, 修改时间) -> sha256
+_file_hash_cache = {}
+
+
+def choose_protocol(metadata):
+    """根据服务器元数据选择传输方式，旧服务器未声明时使用JSON"""
+    server_protocols = metadata.get("protocols", [PROTOCOL_JSON])
+    for protocol in SUPPORTED_PROTOCOLS:
+        if protocol in server_protocols:
+            return protocol
+    return PROTOCOL_JSON
+
+
+def file_sha256(file_path, chunk_size=BINARY_CHUNK_SIZE):
+    """分块计算文件SHA-256，文件未变化时复用上次结果"""
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime)
+    if key in _file_hash_cache:
+        return _file_hash_cache[key]
+
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+
+    _file_hash_cache[key] = digest.hexdigest()
+    return _file_hash_cache[key]
+
+
+def build_image_request(image, prompt, protocol):
+    """
+    构建图像请求 - 图像编码为PNG，二进制协议作为负载帧发送，JSON协议base64编码后放在请求中
+
+    Returns:
+        tuple: (请求字典, 负载或None)
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+
+    request = {
+        "type": "image",
+        "prompt": prompt
+    }
+    if protocol == PROTOCOL_BINARY:
+        payload = buffer.getbuffer()
+        request["payload"] = {"length": len(payload), "media_type": "image/png"}
+        return request, payload
+    request["image_data"] = base64.b64encode(buffer.getvalue()).decode('utf-8')
+    return request, None
+
+
+def build_video_request(video_path, prompt, protocol, max_upload_bytes=0):
+    """
+    构建视频请求 - 二进制协议在头帧之后分块发送文件，JSON协议base64编码整个文件
+
+    Args:
+        max_upload_bytes: 服务器声明的上传上限，0表示不限制
+
+    Returns:
+        tuple: (请求字典, 需要作为负载发送的文件路径或None)
+    """
+    if not os.path.exists(video_path):
+        raise ValueError(f"视频文件不存在: {video_path}")
+
+    request = {
+        "type": "video",
+        "video_filename": os.path.basename(video_path),
+        "prompt": prompt
+    }
+    if protocol == PROTOCOL_BINARY:
+        video_size = os.path.getsize(video_path)
+        if max_upload_bytes and video_size > max_upload_bytes:
+            raise ValueError(
+                f"视频文件 {video_size / 1024 ** 2:.1f} MB 超过服务器上限 {max_upload_bytes / 1024 ** 2:.0f} MB"
+            )
+        request["payload"] = {"length": video_size, "media_type": "video"}
+        return request, video_path
+
+    with open(video_path, 'rb') as f:
+        request["video_data"] = base64.b64encode(f.read()).decode('utf-8')
+    return request, None
+
+
+def build_video_frames_request(frames, timestamps, fps, prompt, video_filename="",
+                               quality=FRAMES_JPEG_QUALITY):
+    """
+    构建帧序列视频请求（仅二进制协议） - 各帧编码为JPEG后拼接为一个负载
+
+    Args:
+        frames: 已缩放的PIL图像列表
+        timestamps: 各帧时间戳（秒）
+        fps: 抽帧帧率
+
+    Returns:
+        tuple: (请求字典, 负载)
+    """
+    if not frames:
+        raise ValueError("帧序列为空")
+    payload = bytearray()
+    lengths = []
+    for frame in frames:
+        buffer = io.BytesIO()
+        frame.convert("RGB").save(buffer, format='JPEG', quality=quality)
+        lengths.append(buffer.tell())
+        payload += buffer.getbuffer()
+
+    request = {
+        "type": "video",
+        "video_filename": video_filename,
+        "prompt": prompt,
+        "frames": {"lengths": lengths, "timestamps": [float(t) for t in timestamps], "fps": float(fps)},
+        "payload": {"length": len(payload), "media_type": FRAMES_MEDIA_TYPE},
+    }
+    return request, payload
+
+
+def build_text_request(prompt):
+    """构建纯文本请求（服务器元数据中text为True时可用）"""
+    return {"type": "text", "prompt": prompt}
+
+
+def split_video_frames(payload, frames_info):
+    """
+    按frames字段中的各帧字节数切分帧序列负载
+
+    Returns:
+        list: 各帧JPEG数据（memoryview切片，不复制数据）
+
+    Raises:
+        ValueError: 帧数超出上限或各帧字节数与负载长度不符
+    """
+    lengths = [int(length) for length in frames_info["lengths"]]
+    if not lengths or len(lengths) > MAX_VIDEO_FRAMES:
+        raise ValueError(f"帧数 {len(lengths)} 不在 1~{MAX_VIDEO_FRAMES} 范围内")
+    if sum(lengths) != len(payload) or min(lengths) <= 0:
+        raise ValueError("帧序列各帧字节数与负载长度不符")
+    view = memoryview(payload)
+    chunks = []
+    offset = 0
+    for length in lengths:
+        chunks.append(view[offset:offset + length])
+        offset += length
+    return chunks
+
+
+def video_frames_fps(frames_info):
+    """帧序列的抽帧帧率: 优先使用fps字段，否则由首尾时间戳推算"""
+    fps = frames_info.get("fps")
+    if fps:
+        return float(fps)
+    timestamps = frames_info.get("timestamps") or []
+    if len(timestamps) > 1 and timestamps[-1] > timestamps[0]:
+        return (len(timestamps) - 1) / (timestamps[-1] - timestamps[0])
+    return 2.0
+
+
+async def send_binary_payload(websocket, data, chunk_size=BINARY_CHUNK_SIZE):
+    """按chunk_size分帧发送二进制负载（memoryview切片，不复制数据）"""
+    view = memoryview(data)
+    for offset in range(0, len(view), chunk_size):
+        await websocket.send(view[offset:offset + chunk_size])
+
+
+async def send_file_payload(websocket, file_path, chunk_size=BINARY_CHUNK_SIZE):
+    """
+    分块读取文件并逐帧发送，内存占用与文件大小无关
+
+    Returns:
+        int: 发送的字节数
+    """
+    sent = 0
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            await websocket.send(chunk)
+            sent += len(chunk)
+    return sent
+
+
+async def iter_binary_payload(websocket, length):
+    """逐帧接收length字节的二进制负载（异步生成器）"""
+    received = 0
+    while received < length:
+        frame = await websocket.recv()
+        if not isinstance(frame, (bytes, bytearray)):
+            raise ValueError("期望二进制负载帧，收到文本帧")
+        if received + len(frame) > length:
+            raise ValueError(f"二进制负载超出声明长度: {length}")
+        received += len(frame)
+        yield frame
+
+
+async def receive_binary_payload(websocket, length):
+    """
+    接收length字节的二进制负载到内存
+
+    Returns:
+        bytes或bytearray: 单帧负载直接返回帧数据，多帧负载拼接到预分配缓冲区
+    """
+    buffer = None
+    received = 0
+    async for frame in iter_binary_payload(websocket, length):
+        if len(frame) == length:
+            return frame
+        if buffer is None:
+            buffer = bytearray(length)
+        buffer[received:received + len(frame)] = frame
+        received += len(frame)
+    return buffer if buffer is not None else b""
@@ -1,33 +1,54 @@
 """
 VLM远程处理器 - 基于现有VLMProcessor修改为客户端模式
-连接到远程VLM服务器进行推理
+通过一条持久连接（VLMConnection）向远程VLM服务器发送推理请求
 """
 import os
-import json
-import base64
-import io
 import asyncio
+import concurrent.futures
+import hashlib
 import logging
+import time
+import uuid
 from PyQt5.QtCore import QObject, QThread, pyqtSignal
 from PIL import Image
-import websockets.asyncio.client as client
+
+from .vlm_connection import VLMConnection
+from .vlm_protocol import (
+    ERROR_MEDIA_MISSING, PROTOCOL_BINARY, RETRYABLE_ERRORS, build_image_request, build_video_frames_request,
+    build_video_request, choose_protocol, file_sha256
+)
+
+# 本地抽帧依赖decord，未安装时上传整个视频文件
+try:
+    from .video_utils import sample_video_frames
+except ImportError:
+    sample_video_frames = None
 
 logger = logging.getLogger(__name__)
 
+# 服务器繁忙时的重试次数和单次最长等待（毫秒）
+MAX_BUSY_RETRIES = 3
+MAX_RETRY_DELAY_MS = 10000
+
 
 class VLMRemoteWorker(QThread):
     """VLM远程处理工作线程 - 替代原有的VLMWorker"""
     text_ready = pyqtSignal(str)
+    text_delta = pyqtSignal(str)
     error_occurred = pyqtSignal(str)
     
-    def __init__(self, host="localhost", port=8000):
+    def __init__(self, connection, stream=True, follow_up=None, client_frames=True):
         super().__init__()
-        self.host = host
-        self.port = port
+        self.connection = connection
+        self.stream = stream
+        self.follow_up = follow_up  # 媒体标识 -> 会话ID前缀（同一媒体追问时）或None，服务器据此复用前缀KV缓存
+        self.client_frames = client_frames  # 服务器支持时在本地抽帧，只上传缩放后的帧序列
         self.messages = None
         self.processing_type = "image"  # "image" 或 "video"
         self.video_path = None
         self.prompt = None
+        self._future = None      # 在连接事件循环中执行的请求
+        self._cancelled = False
         
     def set_image_messages(self, messages):
         """设置图像处理消息"""
@@ -43,100 +64,199 @@ class VLMRemoteWorker(QThread):
     def run(self):
         """执行远程VLM推理"""
         try:
-            # 运行异步任务
-            asyncio.run(self._process_async())
+            # 在持久连接的事件循环中执行
+            self._future = self.connection.submit(self._process_async())
+            if self._cancelled:
+                self._future.cancel()
+            self._future.result()
+        except concurrent.futures.CancelledError:
+            logger.info("远程VLM请求已取消")
         except Exception as e:
             self.error_occurred.emit(f"远程VLM处理错误: {str(e)}")
     
+    def cancel(self):
+        """取消请求 - 服务器停止生成，本线程不再发射结果或错误信号（可在任意线程调用）"""
+        self._cancelled = True
+        future = self._future
+        if future is not None:
+            future.cancel()
+    
     async def _process_async(self):
         """异步处理方法"""
         try:
-            # 连接到服务器
-            uri = f"ws://{self.host}:{self.port}"
-            async with client.connect(uri) as websocket:
-                # 接收服务器元数据
-                metadata_msg = await websocket.recv()
-                metadata = json.loads(metadata_msg)
-                print(f"连接到VLM服务器: {metadata}")
+            # 复用持久连接建立时收到的服务器元数据
+            metadata = self.connection.metadata or {}
+            
+            # 协商传输方式 - 服务器支持时使用二进制帧传输媒体数据
+            protocol = choose_protocol(metadata)
+            payload = None
+            video_file_path = None
+            upload_request = None  # 媒体存储命中时保留的完整上传请求（服务器已淘汰时重试用）
+            client_timing = {}     # 客户端各阶段耗时（毫秒）
+            image = None
+            
+            frame_budget = metadata.get("video_frames")
+            if (self.processing_type == "video" and self.client_frames and frame_budget
+                    and protocol == PROTOCOL_BINARY and sample_video_frames is not None):
+                # 帧序列视频 - 按服务器的像素预算在本地抽帧缩放，上传量与视频文件大小无关
+                encode_start = time.time()
+                frames, timestamps, fps = await asyncio.to_thread(
+                    sample_video_frames, self.video_path, frame_budget["total_pixels"], frame_budget["min_pixels"]
+                )
+                request, payload = await asyncio.to_thread(
+                    build_video_frames_request, frames, timestamps, fps, self.prompt, os.path.basename(self.video_path)
+                )
+                client_timing["encode_ms"] = (time.time() - encode_start) * 1000
+                print(f"本地抽帧: {len(frames)} 帧 {frames[0].width}x{frames[0].height}, "
+                      f"上传 {len(payload) / 1024 ** 2:.1f} MB"
+                      f"（视频文件 {os.path.getsize(self.video_path) / 1024 ** 2:.1f} MB）")
                 
-                if self.processing_type == "video":
-                    # 视频处理 - 读取本地视频文件并传输到服务器
-                    import os
-                    if not os.path.exists(self.video_path):
-                        raise ValueError(f"视频文件不存在: {self.video_path}")
-                    
-                    # 读取视频文件内容并编码为base64
-                    with open(self.video_path, 'rb') as f:
-                        video_data = base64.b64encode(f.read()).decode('utf-8')
-                    
-                    # 获取文件名
-                    video_filename = os.path.basename(self.video_path)
-                    
-                    request = {
-                        "type": "video",
-                        "video_data": video_data,
-                        "video_filename": video_filename,
-                        "prompt": self.prompt
-                    }
-                    
-                elif self.processing_type == "image" and self.messages:
-                    # 图像处理 - 从messages中提取图像和文本
-                    image = None
-                    prompt = ""
-                    
-                    for message in self.messages:
-                        if message["role"] == "user":
-                            for content in message["content"]:
-                                if content["type"] == "text":
-                                    prompt = content["text"]
-                                elif content["type"] == "image":
-                                    image = content["image"]
-                    
-                    if image is None:
-                        raise ValueError("未找到图像数据")
-                    
-                    # 将PIL图像编码为base64
-                    buffer = io.BytesIO()
-                    image.save(buffer, format='PNG')
-                    image_data = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                    
-                    request = {
-                        "type": "image",
-                        "image_data": image_data,
-                        "prompt": prompt
-                    }
-                else:
-                    raise ValueError("没有有效的输入数据")
+            elif self.processing_type == "video":
+                # 视频处理 - 二进制协议下发送时分块读取文件，不把整个视频读入内存
+                encode_start = time.time()
+                request, video_file_path = build_video_request(
+                    self.video_path, self.prompt, protocol, metadata.get("max_upload_bytes", 0)
+                )
+                if video_file_path is None:
+                    client_timing["encode_ms"] = (time.time() - encode_start) * 1000
                 
-                # 发送请求
-                await websocket.send(json.dumps(request))
+                # 服务器有媒体存储时先按内容哈希询问，已有则无需上传
+                if video_file_path is not None and metadata.get("media_store"):
+                    hash_start = time.time()
+                    media_sha256 = await asyncio.to_thread(file_sha256, video_file_path)
+                    client_timing["hash_ms"] = (time.time() - hash_start) * 1000
+                    request["media_sha256"] = media_sha256
+                    probe_start = time.time()
+                    present = await self.connection.probe_media(media_sha256)
+                    client_timing["probe_ms"] = (time.time() - probe_start) * 1000
+                    if present:
+                        print(f"服务器已有该视频，跳过上传: {media_sha256[:12]}")
+                        upload_request = dict(request)
+                        del request["payload"]
+                        video_file_path = None
                 
-                # 接收响应
-                response_msg = await websocket.recv()
-                response = json.loads(response_msg)
+            elif self.processing_type == "image" and self.messages:
+                # 图像处理 - 从messages中提取图像和文本
+                image = None
+                prompt = ""
                 
-                if "error" in response:
-                    raise RuntimeError(f"服务器错误: {response['error']}")
+                for message in self.messages:
+                    if message["role"] == "user":
+                        for content in message["content"]:
+                            if content["type"] == "text":
+                                prompt = content["text"]
+                            elif content["type"] == "image":
+                                image = content["image"]
                 
-                # 发射结果信号
-                self.text_ready.emit(response["result"])
+                if image is None:
+                    raise ValueError("未找到图像数据")
                 
+                encode_start = time.time()
+                request, payload = build_image_request(image, prompt, protocol)
+                client_timing["encode_ms"] = (time.time() - encode_start) * 1000
+            else:
+                raise ValueError("没有有效的输入数据")
+            
+            # 服务器支持时请求流式输出
+            stream = self.stream and metadata.get("streaming", False)
+            if stream:
+                request["stream"] = True
+            
+            # 追问且服务器支持会话时携带会话ID（图像和视频各自一个会话）；
+            # 其余请求不带会话ID，可参与服务器的组批和结果缓存。
+            # 服务器不支持会话时不计算媒体标识，图像哈希在线程池中计算，不占用界面线程和连接事件循环
+            if self.follow_up is not None and metadata.get("sessions", False):
+                media_key = await asyncio.to_thread(self._media_key, image)
+                session_id = self.follow_up(media_key) if media_key is not None else None
+                if session_id:
+                    request["session_id"] = f"{session_id}-{self.processing_type}"
+            
+            response = await self.connection.request(
+                request, payload, video_file_path, on_delta=self.text_delta.emit
+            )
+            
+            # 服务器过载时按其建议的retry_after_ms退避重试
+            for _ in range(MAX_BUSY_RETRIES):
+                if response.get("error_code") not in RETRYABLE_ERRORS:
+                    break
+                delay_ms = min(response.get("retry_after_ms") or 1000, MAX_RETRY_DELAY_MS)
+                print(f"服务器繁忙（{response['error']}），{delay_ms / 1000:.1f}秒后重试")
+                await asyncio.sleep(delay_ms / 1000)
+                response = await self.connection.request(
+                    request, payload, video_file_path, on_delta=self.text_delta.emit
+                )
+            
+            if response.get("error_code") == ERROR_MEDIA_MISSING and upload_request is not None:
+                # 询问后服务器已淘汰该视频，重新上传
+                print("服务器媒体存储已淘汰该视频，重新上传")
+                if stream:
+                    upload_request["stream"] = True
+                if "session_id" in request:
+                    upload_request["session_id"] = request["session_id"]
+                response = await self.connection.request(
+                    upload_request, file_path=self.video_path, on_delta=self.text_delta.emit
+                )
+            
+            if "error" in response:
+                raise RuntimeError(f"服务器错误: {response['error']}")
+            
+            # 客户端耗时（编码、上传、往返）与服务器分阶段耗时一起记录
+            client_timing.update(response.get("client_timing", {}))
+            print(f"客户端耗时: {self._format_timing(client_timing)}")
+            if response.get("timing"):
+                print(f"服务器分阶段耗时: {self._format_timing(response['timing'])}")
+            stats = response.get("stats", {})
+            if stats:
+                print(f"服务器统计: {stats}")
+            
+            # 发射结果信号
+            self.text_ready.emit(response["result"])
+            
         except Exception as e:
             self.error_occurred.emit(f"远程连接错误: {str(e)}")
-
+    
+    def _media_key(self, image):
+        """
+        判断追问用的媒体标识: 图像为内容哈希，视频为路径、大小和修改时间
+        
+        Returns:
+            tuple: 媒体标识；无法确定时返回None
+        """
+        if self.processing_type == "image":
+            if not isinstance(image, Image.Image):
+                return None
+            return ("image", image.size, hashlib.sha256(image.tobytes()).hexdigest())
+        try:
+            stat = os.stat(self.video_path)
+        except OSError:
+            return None
+        return ("video", os.path.abspath(self.video_path), stat.st_size, stat.st_mtime_ns)
+    
+    @staticmethod
+    def _format_timing(timing):
+        """格式化耗时字典: stage=12ms ..."""
+        return " ".join(f"{stage.removesuffix('_ms')}={ms:.0f}ms" for stage, ms in timing.items() if ms is not None)
+    
 
 class VLMRemoteProcessor(QObject):
     """VLM远程处理器主类 - 替代原有的VLMProcessor"""
     
     text_generated = pyqtSignal(str)
+    text_delta = pyqtSignal(str)  # 流式输出的文本增量
     error_occurred = pyqtSignal(str)
     model_loaded = pyqtSignal()
     loading_progress = pyqtSignal(str)
     
-    def __init__(self, server_host="localhost", server_port=8000):
+    def __init__(self, server_host="localhost", server_port=8000, stream=True, client_frames=True):
         super().__init__()
         self.server_host = server_host
         self.server_port = server_port
+        self.stream = stream
+        self.client_frames = client_frames
+        self.session_id = uuid.uuid4().hex  # 本处理器的会话ID，对同一媒体追问时复用服务器端前缀缓存
+        self._last_media = None  # 上一次请求的媒体标识，用于判断是否为追问
+        # 持久连接 - 所有请求共用，断线后自动重连
+        self.connection = VLMConnection(server_host, server_port)
         self.worker = None
         self.is_model_loaded = False
         
@@ -145,8 +265,10 @@ class VLMRemoteProcessor(QObject):
         try:
             self.loading_progress.emit("连接到远程VLM服务器...")
             
-            # 测试连接
-            asyncio.run(self._test_connection())
+            # 建立持久连接并等待服务器元数据
+            self.connection.start()
+            metadata = self.connection.wait_ready()
+            print(f"服务器信息: {metadata}")
             
             self.is_model_loaded = True
             self.model_loaded.emit()
@@ -158,13 +280,33 @@ class VLMRemoteProcessor(QObject):
             print(error_msg)
             self.error_occurred.emit(error_msg)
     
-    async def _test_connection(self):
-        """测试连接"""
-        uri = f"ws://{self.server_host}:{self.server_port}"
-        async with client.connect(uri) as websocket:
-            metadata_msg = await websocket.recv()
-            metadata = json.loads(metadata_msg)
-            print(f"服务器信息: {metadata}")
+    def close(self):
+        """关闭与服务器的持久连接"""
+        self.stop_processing()
+        self.connection.stop()
+        self.is_model_loaded = False
+    
+    def _follow_up_session(self, media_key):
+        """
+        对同一媒体的追问返回会话ID，换了媒体时返回None
+        
+        首次提问不使用会话，可参与服务器的组批和结果缓存；会话从第一次追问开始，之后的追问复用前缀KV缓存
+        
+        由工作线程在服务器支持会话时调用（新请求开始前会等待上一个工作线程退出，不会并发调用）
+        """
+        follow_up = media_key == self._last_media
+        self._last_media = media_key
+        return self.session_id if follow_up else None
+    
+    def is_busy(self):
+        """检查是否正在处理"""
+        return self.worker is not None and self.worker.isRunning()
+    
+    def stop_processing(self):
+        """取消当前请求并等待工作线程退出（服务器在下一个decode步停止生成）"""
+        if self.worker and self.worker.isRunning():
+            self.worker.cancel()
+            self.worker.wait()
     
     def process_image(self, messages):
         """处理图像 - 通过远程服务器"""
@@ -172,14 +314,13 @@ class VLMRemoteProcessor(QObject):
             self.error_occurred.emit("远程服务器未连接")
             return
         
-        # 停止之前的工作线程
-        if self.worker and self.worker.isRunning():
-            self.worker.quit()
-            self.worker.wait()
+        # 取消之前的请求，服务器释放GPU给新请求
+        self.stop_processing()
         
-        # 创建新的远程工作线程
-        self.worker = VLMRemoteWorker(self.server_host, self.server_port)
+        # 创建新的远程工作线程（图像内容相同，即同一张图片连续提问时视为追问）
+        self.worker = VLMRemoteWorker(self.connection, stream=self.stream, follow_up=self._follow_up_session)
         self.worker.text_ready.connect(self.text_generated.emit)
+        self.worker.text_delta.connect(self.text_delta.emit)
         self.worker.error_occurred.connect(self.error_occurred.emit)
         
         # 设置图像处理任务
@@ -192,14 +333,14 @@ class VLMRemoteProcessor(QObject):
             self.error_occurred.emit("远程服务器未连接")
             return
         
-        # 停止之前的工作线程
-        if self.worker and self.worker.isRunning():
-            self.worker.quit()
-            self.worker.wait()
+        # 取消之前的请求，服务器释放GPU给新请求
+        self.stop_processing()
         
-        # 创建新的远程工作线程
-        self.worker = VLMRemoteWorker(self.server_host, self.server_port)
+        # 创建新的远程工作线程（同一视频文件，即路径、大小和修改时间都相同时连续提问视为追问）
+        self.worker = VLMRemoteWorker(self.connection, stream=self.stream, follow_up=self._follow_up_session,
+                                      client_frames=self.client_frames)
         self.worker.text_ready.connect(self.text_generated.emit)
+        self.worker.text_delta.connect(self.text_delta.emit)
         self.worker.error_occurred.connect(self.error_occurred.emit)
         
         # 设置视频处理任务
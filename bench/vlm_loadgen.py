@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+"""
+VLM服务器压测工具 - 模拟多个客户端按VLMRemoteWorker的协议发送图像/视频请求
+统计延迟分位数、首字节时间、吞吐量和错误率，输出表格和JSON，便于比较协议和调度改动前后的性能
+
+用法（在项目根目录）:
+    python -m bench.vlm_loadgen --port 8000 --concurrency 8 --duration 60
+    python -m bench.vlm_loadgen --mode open --rate 4 --video-ratio 0.2 --video demo.mp4 --json result.json
+
+服务器可用 --backend stub 启动，在没有GPU的机器上压测网络、排队和组批
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import time
+
+import websockets
+import websockets.asyncio.client as client
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.vlm_protocol import (
+    ERROR_DEADLINE_EXCEEDED, ERROR_MEDIA_MISSING, PROTOCOL_BINARY, PROTOCOL_JSON, RETRYABLE_ERRORS,
+    build_image_request, build_video_request, choose_protocol, file_sha256, send_binary_payload, send_file_payload
+)
+
+
+class BenchConnection:
+    """压测客户端连接 - 与VLMConnection相同的请求格式，在调用方的事件循环中运行"""
+
+    def __init__(self, uri, protocol="auto"):
+        self.uri = uri
+        self.requested_protocol = protocol
+        self.protocol = None
+        self.metadata = None
+        self._websocket = None
+        self._reader = None
+        self._pending = {}
+        self._ids = itertools.count(1)
+        self._send_lock = asyncio.Lock()
+        self._serial_lock = asyncio.Lock()
+
+    async def connect(self):
+        self._websocket = await client.connect(self.uri, compression=None, max_size=None)
+        self.metadata = json.loads(await self._websocket.recv())
+        self.protocol = choose_protocol(self.metadata) if self.requested_protocol == "auto" else self.requested_protocol
+        self._reader = asyncio.ensure_future(self._read_loop())
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        if self._websocket is not None:
+            await self._websocket.close()
+
+    async def _read_loop(self):
+        try:
+            async for message in self._websocket:
+                response = json.loads(message)
+                request_id = response.get("request_id")
+                if request_id is None and self._pending:
+                    request_id = next(iter(self._pending))
+                queue = self._pending.get(request_id)
+                if queue is not None:
+                    queue.put_nowait(response)
+        except websockets.ConnectionClosed as e:
+            error = ConnectionError(f"连接已断开: {e}")
+        else:
+            error = ConnectionError("连接已关闭")
+        for queue in self._pending.values():
+            queue.put_nowait(error)
+
+    async def request(self, request, payload=None, file_path=None, on_first_message=None):
+        """发送请求并等待最终响应，收到该请求的第一条消息（delta或final）时调用on_first_message"""
+        if self.metadata.get("multiplex"):
+            return await self._request(request, payload, file_path, on_first_message)
+        async with self._serial_lock:
+            return await self._request(request, payload, file_path, on_first_message)
+
+    async def _request(self, request, payload, file_path, on_first_message):
+        request_id = str(next(self._ids))
+        queue = asyncio.Queue()
+        self._pending[request_id] = queue
+        try:
+            async with self._send_lock:
+                await self._websocket.send(json.dumps(dict(request, request_id=request_id)))
+                if payload is not None:
+                    await send_binary_payload(self._websocket, payload)
+                elif file_path is not None:
+                    await send_file_payload(self._websocket, file_path)
+            first = True
+            while True:
+                response = await queue.get()
+                if isinstance(response, Exception):
+                    raise response
+                if first and on_first_message is not None:
+                    on_first_message()
+                first = False
+                if response.get("type") == "delta":
+                    continue
+                return response
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def probe_media(self, sha256):
+        status = await self.request({"type": "media_probe", "sha256": sha256})
+        return bool(status.get("present"))
+
+
+class Workload:
+    """请求负载 - 按比例生成图像/视频请求"""
+
+    def __init__(self, args):
+        self.prompt = args.prompt
+        self.video_prompt = args.video_prompt
+        self.video_ratio = args.video_ratio if args.video else 0.0
+        self.videos = args.video or []
+        self.unique_media = args.unique_media
+        self.rng = random.Random(args.seed)
+        self.images = [Image.open(path).convert("RGB") for path in args.image or []]
+        if not self.images:
+            width, height = (int(v) for v in args.image_size.lower().split("x"))
+            self.images = [self._synthetic_image(width, height, args.seed)]
+        self.image_size = self.images[0].size
+        self._counter = itertools.count()
+
+    @staticmethod
+    def _synthetic_image(width, height, seed):
+        """随机噪声图像（PNG不可压缩，上传体积接近真实画面）"""
+        rng = random.Random(seed)
+        return Image.frombytes("RGB", (width, height), rng.randbytes(width * height * 3))
+
+    def next_request(self):
+        """
+        Returns:
+            tuple: (请求类型, 媒体对象, 提示词)
+        """
+        n = next(self._counter)
+        if self.rng.random() < self.video_ratio:
+            return "video", self.videos[n % len(self.videos)], self.video_prompt
+        image = self.images[n % len(self.images)]
+        if self.unique_media:
+            # 改动一个像素，使每个请求的媒体哈希不同（绕过服务器端缓存）
+            image = image.copy()
+            image.putpixel((0, 0), (n % 256, (n // 256) % 256, (n // 65536) % 256))
+        return "image", image, self.prompt
+
+
+async def run_one(connection, kind, media, prompt, stream, scheduled_time, deadline_ms=None):
+    """
+    按VLMRemoteWorker的流程发送一个请求（服务器过载时不重试，拒绝计入rejected）
+
+    Returns:
+        dict: 单个请求的记录
+    """
+    record = {"type": kind, "start": scheduled_time, "ok": False}
+    first_message_time = []
+    metadata = connection.metadata
+
+    def on_first():
+        if not first_message_time:
+            first_message_time.append(time.time())
+
+    try:
+        upload_request = None
+        payload = file_path = None
+        if kind == "video":
+            request, file_path = build_video_request(
+                media, prompt, connection.protocol, metadata.get("max_upload_bytes", 0)
+            )
+            if file_path is not None and metadata.get("media_store"):
+                request["media_sha256"] = await asyncio.to_thread(file_sha256, file_path)
+                if await connection.probe_media(request["media_sha256"]):
+                    upload_request = dict(request)
+                    del request["payload"]
+                    file_path = None
+        else:
+            request, payload = build_image_request(media, prompt, connection.protocol)
+            record["upload_bytes"] = len(payload) if payload is not None else len(request["image_data"])
+        if stream and metadata.get("streaming"):
+            request["stream"] = True
+        if deadline_ms:
+            request["deadline_ms"] = deadline_ms
+
+        response = await connection.request(request, payload, file_path, on_first_message=on_first)
+        if response.get("error_code") == ERROR_MEDIA_MISSING and upload_request is not None:
+            upload_request["stream"] = request.get("stream", False)
+            response = await connection.request(upload_request, file_path=media, on_first_message=on_first)
+
+        end = time.time()
+        record["latency_ms"] = (end - scheduled_time) * 1000
+        if first_message_time:
+            record["ttfb_ms"] = (first_message_time[0] - scheduled_time) * 1000
+        if response.get("error_code") in RETRYABLE_ERRORS + (ERROR_DEADLINE_EXCEEDED,):
+            record["error"] = response["error_code"]
+            record["rejected"] = True
+        elif "error" in response or response.get("stats", {}).get("error"):
+            record["error"] = response.get("error") or response["stats"]["error"]
+        else:
+            record["ok"] = True
+            stats = response.get("stats", {})
+            record["output_tokens"] = stats.get("output_tokens", 0)
+            record["server_ms"] = response.get("processing_time_ms")
+    except Exception as e:
+        record["latency_ms"] = (time.time() - scheduled_time) * 1000
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["end"] = time.time()
+    return record
+
+
+async def run_closed_loop(connections, workload, args, records):
+    """闭环: 每个客户端收到响应后（加上思考时间）再发送下一个请求"""
+    deadline = time.time() + args.duration if args.duration else None
+    issued = itertools.count()
+
+    async def client_loop(connection):
+        while True:
+            if deadline is not None and time.time() >= deadline:
+                return
+            if args.requests and next(issued) >= args.requests:
+                return
+            kind, media, prompt = workload.next_request()
+            records.append(await run_one(
+                connection, kind, media, prompt, args.stream, time.time(), args.deadline_ms
+            ))
+            if args.think_ms:
+                await asyncio.sleep(args.think_ms / 1000)
+
+    await asyncio.gather(*(client_loop(c) for c in connections))
+
+
+async def run_open_loop(connections, workload, args, records):
+    """
+    开环: 按泊松过程以目标速率发出请求，不等待前一个请求完成
+    延迟从计划发出时刻算起，服务器跟不上时排队时间计入延迟（避免协调遗漏）
+    """
+    rng = random.Random(args.seed + 1)
+    start = time.time()
+    deadline = start + args.duration if args.duration else None
+    tasks = []
+    next_time = start
+    for n in itertools.count():
+        if args.requests and n >= args.requests:
+            break
+        if deadline is not None and next_time >= deadline:
+            break
+        await asyncio.sleep(max(0.0, next_time - time.time()))
+        kind, media, prompt = workload.next_request()
+        connection = connections[n % len(connections)]
+        task = asyncio.ensure_future(
+            run_one(connection, kind, media, prompt, args.stream, next_time, args.deadline_ms)
+        )
+        task.add_done_callback(lambda t: records.append(t.result()))
+        tasks.append(task)
+        next_time += rng.expovariate(args.rate)
+    if tasks:
+        await asyncio.wait(tasks)
+
+
+def percentile(values, q):
+    """线性插值分位数（q取0-100）"""
+    if not values:
+        return None
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100
+    lower = int(pos)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (pos - lower)
+
+
+def summarize(records, wall_time):
+    """按请求类型和总体汇总"""
+    groups = {"all": records}
+    for record in records:
+        groups.setdefault(record["type"], []).append(record)
+
+    summary = {}
+    for name, group in groups.items():
+        ok = [r for r in group if r["ok"]]
+        latencies = [r["latency_ms"] for r in ok]
+        ttfbs = [r["ttfb_ms"] for r in ok if "ttfb_ms" in r]
+        errors = {}
+        for r in group:
+            if not r["ok"]:
+                errors[r["error"]] = errors.get(r["error"], 0) + 1
+        summary[name] = {
+            "requests": len(group),
+            "ok": len(ok),
+            "errors": len(group) - len(ok),
+            "rejected": sum(1 for r in group if r.get("rejected")),
+            "error_rate": (len(group) - len(ok)) / len(group) if group else 0.0,
+            "throughput_rps": len(ok) / wall_time if wall_time > 0 else 0.0,
+            "output_tokens_per_s": sum(r.get("output_tokens", 0) for r in ok) / wall_time if wall_time > 0 else 0.0,
+            "latency_ms": {
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "mean": sum(latencies) / len(latencies) if latencies else None,
+                "max": max(latencies) if latencies else None,
+            },
+            "ttfb_ms": {
+                "p50": percentile(ttfbs, 50),
+                "p95": percentile(ttfbs, 95),
+                "p99": percentile(ttfbs, 99),
+            },
+            "error_messages": errors,
+        }
+    return summary
+
+
+def format_table(summary):
+    """人类可读的结果表格"""
+    def fmt(value):
+        return "-" if value is None else f"{value:.0f}"
+
+    header = (f"{'类型':<6}{'请求':>7}{'错误':>6}{'错误率':>8}{'req/s':>8}{'tok/s':>8}"
+              f"{'p50':>8}{'p95':>8}{'p99':>8}{'ttfb50':>8}{'ttfb95':>8}{'ttfb99':>8}")
+    lines = [header, "-" * len(header)]
+    for name, s in summary.items():
+        lat, ttfb = s["latency_ms"], s["ttfb_ms"]
+        lines.append(
+            f"{name:<6}{s['requests']:>7}{s['errors']:>6}{s['error_rate'] * 100:>7.1f}%"
+            f"{s['throughput_rps']:>8.2f}{s['output_tokens_per_s']:>8.1f}"
+            f"{fmt(lat['p50']):>8}{fmt(lat['p95']):>8}{fmt(lat['p99']):>8}"
+            f"{fmt(ttfb['p50']):>8}{fmt(ttfb['p95']):>8}{fmt(ttfb['p99']):>8}"
+        )
+    lines.append("（延迟和首字节时间单位: 毫秒）")
+    for name, s in summary.items():
+        if name != "all":
+            continue
+        for message, count in s["error_messages"].items():
+            lines.append(f"错误 x{count}: {message}")
+    return "\n".join(lines)
+
+
+async def main_async(args):
+    uri = f"ws://{args.host}:{args.port}"
+    workload = Workload(args)
+    connections = [BenchConnection(uri, args.protocol) for _ in range(args.concurrency)]
+    await asyncio.gather(*(c.connect() for c in connections))
+    metadata = connections[0].metadata
+    print(f"已建立 {len(connections)} 个连接: {uri} (后端: {metadata.get('backend', '-')}, "
+          f"协议: {connections[0].protocol}, 多路复用: {bool(metadata.get('multiplex'))})")
+
+    # 预热请求不计入结果
+    for _ in range(args.warmup):
+        kind, media, prompt = workload.next_request()
+        await run_one(connections[0], kind, media, prompt, args.stream, time.time())
+
+    records = []
+    start = time.time()
+    try:
+        if args.mode == "open":
+            await run_open_loop(connections, workload, args, records)
+        else:
+            await run_closed_loop(connections, workload, args, records)
+    finally:
+        wall_time = time.time() - start
+        await asyncio.gather(*(c.close() for c in connections), return_exceptions=True)
+
+    result = {
+        "config": {
+            "uri": uri,
+            "mode": args.mode,
+            "concurrency": args.concurrency,
+            "rate": args.rate if args.mode == "open" else None,
+            "duration_s": args.duration,
+            "requests": args.requests,
+            "video_ratio": workload.video_ratio,
+            "image_size": list(workload.image_size),
+            "stream": args.stream,
+            "deadline_ms": args.deadline_ms,
+            "protocol": connections[0].protocol,
+            "server": {k: metadata.get(k) for k in ("backend", "device", "model_path", "batching")},
+        },
+        "wall_time_s": wall_time,
+        "summary": summarize(records, wall_time),
+    }
+    if args.raw:
+        result["records"] = records
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="VLM服务器压测工具")
+    parser.add_argument("--host", default="localhost", help="服务器地址")
+    parser.add_argument("--port", type=int, default=8000, help="服务器端口")
+    parser.add_argument("--concurrency", type=int, default=4, help="客户端连接数（闭环模式下即并发请求数）")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed", help="闭环或开环（按目标速率）")
+    parser.add_argument("--rate", type=float, default=1.0, help="开环模式的目标请求速率（请求/秒）")
+    parser.add_argument("--duration", type=float, default=30, help="压测时长（秒），0表示只按--requests结束")
+    parser.add_argument("--requests", type=int, default=0, help="请求总数上限，0表示只按--duration结束")
+    parser.add_argument("--think-ms", type=float, default=0, help="闭环模式下每个客户端两次请求间的间隔（毫秒）")
+    parser.add_argument("--warmup", type=int, default=1, help="预热请求数（不计入结果）")
+    parser.add_argument("--image", action="append", help="图像文件（可重复），默认使用随机噪声图像")
+    parser.add_argument("--image-size", default="640x480", help="随机噪声图像尺寸")
+    parser.add_argument("--video", action="append", help="视频文件（可重复）")
+    parser.add_argument("--video-ratio", type=float, default=0.0, help="视频请求所占比例（0-1）")
+    parser.add_argument("--prompt", default="请描述这个画面的内容", help="图像请求提示词")
+    parser.add_argument("--video-prompt", default="请详细描述这个视频的内容和主要场景", help="视频请求提示词")
+    parser.add_argument("--unique-media", action="store_true", help="每个图像请求使用不同的图像（绕过服务器缓存）")
+    parser.add_argument("--stream", action="store_true", help="请求流式输出（首字节时间为首个delta）")
+    parser.add_argument("--deadline-ms", type=float, default=0,
+                        help="请求携带的截止时间（毫秒），服务器预计无法按时开始时立即拒绝；0表示不设置")
+    parser.add_argument("--protocol", choices=["auto", PROTOCOL_BINARY, PROTOCOL_JSON], default="auto",
+                        help="媒体传输方式，auto按服务器声明选择")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--json", help="结果JSON输出路径，- 表示输出到标准输出")
+    parser.add_argument("--raw", action="store_true", help="JSON中包含每个请求的原始记录")
+    args = parser.parse_args()
+
+    if not args.duration and not args.requests:
+        parser.error("--duration和--requests至少设置一个")
+    if args.video_ratio > 0 and not args.video:
+        parser.error("--video-ratio大于0时需要通过--video指定视频文件")
+
+    result = asyncio.run(main_async(args))
+    print(format_table(result["summary"]))
+    if args.json == "-":
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    elif args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到: {args.json}")
+
+
+if __name__ == "__main__":
+    main()
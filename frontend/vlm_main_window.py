@@ -36,6 +36,7 @@ class VLMMainWindow(QMainWindow):
         
         # 状态变量
         self.is_vlm_processing = False
+        self.vlm_streamed = False  # 当前结果是否已通过流式增量显示
         self.current_video_path = None
         
         self.init_ui()
@@ -380,6 +381,8 @@ class VLMMainWindow(QMainWindow):
         
         # VLM处理器信号
         self.vlm_processor.text_generated.connect(self.on_vlm_text_generated)
+        if hasattr(self.vlm_processor, 'text_delta'):
+            self.vlm_processor.text_delta.connect(self.on_vlm_text_delta)
         self.vlm_processor.error_occurred.connect(self.on_vlm_error)
         self.vlm_processor.model_loaded.connect(self.on_vlm_model_loaded)
         self.vlm_processor.loading_progress.connect(self.on_vlm_loading_progress)
@@ -620,17 +623,31 @@ class VLMMainWindow(QMainWindow):
             if self.input_controller.get_input_type() == "video":
                 self.btn_process_video.setEnabled(True)
         
-        # 显示结果
+        # 显示结果 - 流式模式下内容已随增量显示，只需补充换行
         self.output_text.moveCursor(QTextCursor.End)
-        self.output_text.insertPlainText(f"\n{text}\n")
+        if self.vlm_streamed:
+            self.output_text.insertPlainText("\n")
+            self.vlm_streamed = False
+        else:
+            self.output_text.insertPlainText(f"\n{text}\n")
         
         # 启用朗读按钮
         self.btn_speak_output.setEnabled(True)
         
     
+    def on_vlm_text_delta(self, text):
+        """VLM流式输出增量"""
+        self.output_text.moveCursor(QTextCursor.End)
+        if not self.vlm_streamed:
+            self.vlm_streamed = True
+            self.output_text.insertPlainText("\n")
+        self.output_text.insertPlainText(text)
+        self.output_text.ensureCursorVisible()
+    
     def on_vlm_error(self, error_msg):
         """VLM处理错误"""
         self.is_vlm_processing = False
+        self.vlm_streamed = False
         self.vlm_status_label.setText("VLM状态: 错误")
         
         # 启用相关按钮
@@ -706,6 +723,8 @@ class VLMMainWindow(QMainWindow):
         # 清理资源
         self.input_controller.close_input()
         self.vlm_processor.stop_processing()
+        if hasattr(self.vlm_processor, 'close'):
+            self.vlm_processor.close()
         self.tts_processor.stop_speaking()
         
         event.accept()
\ No newline at end of file
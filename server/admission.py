@@ -0,0 +1,178 @@
+"""
+准入控制 - 有界请求队列、每客户端并发上限和客户端截止时间
+过载时立即拒绝并给出建议重试时间（retry_after_ms），而不是让所有请求一起变慢
+"""
+import threading
+import time
+
+from backend.vlm_protocol import ERROR_CLIENT_LIMIT, ERROR_DEADLINE_EXCEEDED, ERROR_OVERLOADED
+
+
+# 服务时间估计的指数滑动平均系数
+EWMA_ALPHA = 0.2
+
+
+class AdmissionRejected(Exception):
+    """请求未被接纳"""
+
+    def __init__(self, message, error_code, retry_after_ms):
+        super().__init__(message)
+        self.error_code = error_code
+        self.retry_after_ms = retry_after_ms
+
+
+class DeadlineExceededError(Exception):
+    """请求未能在截止时间前开始执行"""
+
+    def __init__(self, message, retry_after_ms=0):
+        super().__init__(message)
+        self.retry_after_ms = retry_after_ms
+
+
+class AdmissionTicket:
+    """已接纳请求的凭证 - 请求结束时交还（被retain时所有持有者都交还后才释放名额）"""
+
+    def __init__(self, client, request_type, deadline):
+        self.client = client
+        self.request_type = request_type
+        self.deadline = deadline  # 绝对时间（time.time()），None表示不限
+        self.admit_time = time.time()
+        self.refs = 1
+
+
+class AdmissionController:
+    """
+    准入控制器（在事件循环线程中调用admit/release）
+
+    - 在途请求（已接纳、尚未完成）超过max_queue时拒绝
+    - 单个客户端在途请求超过max_per_client时拒绝
+    - 按各类型请求的平均服务时间估计开始执行前的等待，估计超过截止时间时拒绝
+    """
+
+    def __init__(self, max_queue=64, max_per_client=8, default_service_ms=None, concurrency=1):
+        """
+        Args:
+            max_queue: 在途请求上限，0表示不限制
+            max_per_client: 每客户端在途请求上限，0表示不限制
+            default_service_ms: 尚无统计时各类型的服务时间估计（毫秒）
+            concurrency: 可同时执行的作业数（模型副本数）
+        """
+        self.max_queue = max_queue
+        self.max_per_client = max_per_client
+        self.concurrency = max(1, concurrency)
+        self._service_ms = dict(default_service_ms or {"image": 1000.0, "video": 10000.0, "text": 2000.0})
+        self._in_flight = {}  # 请求类型 -> 在途数
+        self._per_client = {}
+        self._lock = threading.Lock()
+        self.stats = {"admitted": 0, "rejected": 0, "deadline_exceeded": 0}
+
+    @property
+    def in_flight(self):
+        return sum(self._in_flight.values())
+
+    def estimated_wait_ms(self):
+        """新请求开始执行前的估计等待（在途请求的估计服务时间之和，按副本数分摊）"""
+        with self._lock:
+            total = sum(count * self._service_ms.get(t, 0.0) for t, count in self._in_flight.items())
+        return total / self.concurrency
+
+    def service_ms(self, request_type):
+        with self._lock:
+            return self._service_ms.get(request_type, 0.0)
+
+    def admit(self, client, request_type, deadline_ms=None):
+        """
+        接纳一个请求
+
+        Args:
+            client: 客户端标识（远程地址）
+            request_type: 请求类型
+            deadline_ms: 客户端允许的最长等待（毫秒，从服务器收到请求时计），None表示不限
+
+        Returns:
+            AdmissionTicket
+
+        Raises:
+            AdmissionRejected: 队列已满、客户端超过并发上限或无法在截止时间前开始
+        """
+        now = time.time()
+        wait_ms = self.estimated_wait_ms()
+        service_ms = self.service_ms(request_type)
+
+        if self.max_queue and self.in_flight >= self.max_queue:
+            self._reject()
+            # 大约需要一个在途请求完成才会空出位置
+            raise AdmissionRejected(
+                f"服务器繁忙: 在途请求 {self.in_flight} 已达上限 {self.max_queue}",
+                ERROR_OVERLOADED, wait_ms / max(1, self.in_flight),
+            )
+        if self.max_per_client and self._per_client.get(client, 0) >= self.max_per_client:
+            self._reject()
+            raise AdmissionRejected(
+                f"客户端在途请求已达上限 {self.max_per_client}", ERROR_CLIENT_LIMIT, service_ms,
+            )
+        if deadline_ms is not None and wait_ms > deadline_ms:
+            self._reject()
+            raise AdmissionRejected(
+                f"预计等待 {wait_ms:.0f}ms 超过截止时间 {deadline_ms:.0f}ms",
+                ERROR_DEADLINE_EXCEEDED, wait_ms - deadline_ms,
+            )
+
+        with self._lock:
+            self._in_flight[request_type] = self._in_flight.get(request_type, 0) + 1
+            self._per_client[client] = self._per_client.get(client, 0) + 1
+            self.stats["admitted"] += 1
+        deadline = now + deadline_ms / 1000 if deadline_ms is not None else None
+        return AdmissionTicket(client, request_type, deadline)
+
+    def retain(self, ticket):
+        """
+        增加凭证的持有者（如结果缓存的共享生成），名额保留到所有持有者都release为止
+
+        发起请求的客户端取消或断开后，仍在执行的生成继续计入在途请求
+        """
+        with self._lock:
+            ticket.refs += 1
+
+    def release(self, ticket):
+        """请求结束（完成、失败或取消）"""
+        with self._lock:
+            ticket.refs -= 1
+            if ticket.refs > 0:
+                return
+            self._in_flight[ticket.request_type] -= 1
+            remaining = self._per_client.get(ticket.client, 0) - 1
+            if remaining > 0:
+                self._per_client[ticket.client] = remaining
+            else:
+                self._per_client.pop(ticket.client, None)
+
+    def observe_service(self, request_type, compute_ms, batch_size=1):
+        """记录一次执行的服务时间（批处理时按批次大小摊分）"""
+        with self._lock:
+            sample = compute_ms / max(1, batch_size)
+            previous = self._service_ms.get(request_type)
+            self._service_ms[request_type] = (
+                sample if previous is None else (1 - EWMA_ALPHA) * previous + EWMA_ALPHA * sample
+            )
+
+    def record_deadline_exceeded(self):
+        with self._lock:
+            self.stats["deadline_exceeded"] += 1
+
+    def _reject(self):
+        with self._lock:
+            self.stats["rejected"] += 1
+
+    def get_load(self):
+        """当前负载（在连接元数据中发送给客户端，便于客户端退避）"""
+        wait_ms = self.estimated_wait_ms()
+        with self._lock:
+            return {
+                "in_flight": sum(self._in_flight.values()),
+                "max_queue": self.max_queue,
+                "max_per_client": self.max_per_client,
+                "estimated_wait_ms": wait_ms,
+                "service_ms": dict(self._service_ms),
+                **self.stats,
+            }
@@ -0,0 +1,202 @@
+"""
+推理后端接口 - VLMServer只负责网络、排队和组批，模型相关的预处理和生成由后端实现
+- qwen: Qwen2.5-VL模型（server/qwen_backend.py）
+- stub: 不加载权重的确定性模拟后端，用于在没有GPU的机器上压测服务器（server/stub_backend.py）
+"""
+import base64
+import hashlib
+import io
+import logging
+import os
+import tempfile
+
+from PIL import Image
+
+from backend.vlm_protocol import split_video_frames
+from server.spool import MemorySpool, UploadSpool
+from server.timing import timed
+
+
+logger = logging.getLogger(__name__)
+
+
+class InferenceBackend:
+    """
+    推理后端基类
+
+    process_*方法在GPU工作线程中调用，返回 (结果文本, 统计信息)；
+    内部捕获的错误以错误文本作为结果返回，统计信息中的error字段为异常类名
+    """
+
+    name = ""
+
+    def load(self):
+        """加载模型"""
+
+    @property
+    def device(self):
+        """推理设备描述（服务器元数据中展示）"""
+        return "未加载"
+
+    @property
+    def supports_sessions(self):
+        """是否支持会话前缀缓存（process_image_session和process_video的session_id参数）"""
+        return False
+
+    def get_stats(self):
+        """后端缓存统计（合并到服务器元数据中）"""
+        return {}
+
+    def generation_params(self, request_type):
+        """影响输出的生成参数（结果缓存键的一部分，参数变化时旧结果不再命中）"""
+        return {"backend": self.name}
+
+    def video_frame_budget(self):
+        """
+        客户端抽帧使用的视频像素预算（在连接元数据中声明）
+
+        Returns:
+            dict: {"total_pixels", "min_pixels"}；None表示不接受帧序列视频
+        """
+        return None
+
+    @staticmethod
+    def decode_image(image_data) -> Image.Image:
+        """解码图像（在I/O线程池中调用，不占用GPU线程）
+
+        Args:
+            image_data: base64字符串（JSON协议）或原始字节（二进制协议）
+        """
+        if isinstance(image_data, str):
+            image_bytes = base64.b64decode(image_data)
+        else:
+            image_bytes = image_data
+        image = Image.open(io.BytesIO(image_bytes))
+        image.load()
+        return image
+
+    def prepare_image(self, image_data):
+        """
+        准备图像输入（在I/O线程池中调用）
+
+        Returns:
+            tuple: (图像或原始字节, 视觉缓存键, 像素数, 图像SHA-256)
+        """
+        image_bytes = base64.b64decode(image_data) if isinstance(image_data, str) else image_data
+        image = self.decode_image(image_bytes)
+        return image, None, image.width * image.height, hashlib.sha256(image_bytes).hexdigest()
+
+    def process_image(self, image_data: str, prompt: str, on_text=None):
+        """处理图像推理"""
+        try:
+            image = self.decode_image(image_data)
+        except Exception as e:
+            logger.error(f"图像处理错误: {e}")
+            return f"处理错误: {str(e)}", {"error": type(e).__name__}
+        return self.process_image_batch([(image, prompt)], on_text=on_text)[0]
+
+    def process_image_batch(self, items, on_text=None) -> list:
+        """
+        批量处理图像推理
+
+        Args:
+            items: [(图像, 提示词[, 视觉缓存键]), ...]
+            on_text: 流式文本回调（仅支持单条请求）
+
+        Returns:
+            list: 与items等长的 [(结果文本, 统计信息), ...]
+        """
+        raise NotImplementedError
+
+    def process_image_session(self, image, prompt: str, vision_key=None, session_id: str = None,
+                              media_id: str = None, on_text=None):
+        """会话模式的图像推理（supports_sessions为True的后端实现）"""
+        raise NotImplementedError
+
+    def process_video(self, video_path: str, prompt: str, on_text=None, media_sha256: str = None,
+                      session_id: str = None):
+        """处理视频推理"""
+        raise NotImplementedError
+
+    def prepare_video_frames(self, payload, frames_info):
+        """
+        解码帧序列视频（在I/O线程池中调用）
+
+        Returns:
+            list: PIL图像列表
+        """
+        return [self.decode_image(bytes(frame)) for frame in split_video_frames(payload, frames_info)]
+
+    def process_video_frames(self, frames, prompt: str, fps: float, on_text=None, media_sha256: str = None,
+                             session_id: str = None):
+        """处理客户端抽取的帧序列视频（video_frame_budget不为None的后端实现）"""
+        raise NotImplementedError
+
+    def process_video_frames_batch(self, items, on_text=None) -> list:
+        """
+        批量处理帧序列视频（默认逐个处理，支持批量生成的后端覆盖）
+
+        Args:
+            items: [(帧列表, 提示词, 抽帧帧率, 帧序列SHA-256), ...]
+
+        Returns:
+            list: 与items等长的 [(结果文本, 统计信息), ...]
+        """
+        return [
+            self.process_video_frames(frames, prompt, fps, on_text=on_text, media_sha256=media_sha256)
+            for frames, prompt, fps, media_sha256 in items
+        ]
+
+    def process_text(self, prompt: str, on_text=None):
+        """处理纯文本推理（如长视频分段描述的汇总）"""
+        raise NotImplementedError
+
+    def process_video_from_data(self, video_data, video_filename: str, prompt: str, on_text=None):
+        """
+        从客户端传输的视频数据处理视频推理（base64字符串或原始字节）
+
+        视频写入内存文件后直接解码，不经过磁盘；不支持memfd的平台写入临时目录
+        """
+        spool = None
+        try:
+            spool_stats = {}
+            with timed(spool_stats, "spool"):
+                if isinstance(video_data, str):
+                    video_data = base64.b64decode(video_data)
+                suffix = os.path.splitext(video_filename)[1]
+                if hasattr(os, "memfd_create"):
+                    spool = MemorySpool(None, len(video_data), suffix=suffix)
+                else:
+                    spool = UploadSpool(tempfile.gettempdir(), suffix=suffix)
+                spool.write(video_data)
+                spool.finish()
+                del video_data
+
+            print(f"视频数据已暂存: {spool.path} ({spool.bytes_written / 1024 ** 2:.1f} MB)")
+
+            result, stats = self.process_video(spool.path, prompt, on_text=on_text, media_sha256=spool.sha256)
+            return result, dict(stats, **spool_stats)
+
+        except Exception as e:
+            logger.error(f"视频处理错误: {e}")
+            return f"处理错误: {str(e)}", {"error": type(e).__name__}
+        finally:
+            if spool is not None:
+                spool.cleanup()
+
+
+def create_backend(name, **kwargs):
+    """
+    按名称创建推理后端（模型依赖只在选择对应后端时导入）
+
+    Args:
+        name: "qwen" 或 "stub"
+        **kwargs: 传给后端构造函数的参数
+    """
+    if name == "qwen":
+        from server.qwen_backend import QwenVLBackend
+        return QwenVLBackend(**kwargs)
+    if name == "stub":
+        from server.stub_backend import StubBackend
+        return StubBackend(**kwargs)
+    raise ValueError(f"未知的推理后端: {name}")
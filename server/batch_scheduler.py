@@ -0,0 +1,239 @@
+"""
+动态批处理调度器 - 将短时间窗口内到达的图像请求合并为一次generate调用
+"""
+import asyncio
+import logging
+import threading
+import time
+
+from server.admission import DeadlineExceededError
+
+
+logger = logging.getLogger(__name__)
+
+
+class BatchItem:
+    """批处理条目 - 单个请求的输入及其结果future"""
+
+    def __init__(self, payload, pixels, future, deadline=None, on_text=None):
+        self.payload = payload
+        self.pixels = pixels
+        self.future = future
+        self.deadline = deadline
+        self.on_text = on_text
+        self.enqueue_time = time.time()
+
+
+class BatchScheduler:
+    """
+    动态批处理调度器
+
+    收集等待中的请求，直到满足以下任一条件即作为一个批次提交给推理执行器:
+    - 首个请求已等待超过window_ms
+    - 批次达到max_batch_size
+    - 批次像素总数达到max_batch_pixels（0表示不限制）
+
+    GPU忙碌期间到达的请求会继续累积，GPU空闲后立即以更大的批次执行。
+    执行器有多个副本时（executor.concurrency > 1）最多同时执行同样数量的批次。
+    """
+
+    def __init__(self, executor, batch_fn, window_ms=20, max_batch_size=4, max_batch_pixels=0,
+                 name="image"):
+        """
+        Args:
+            executor: 推理执行器（InferenceExecutor）
+            batch_fn: 批处理函数，接收payload列表，返回等长的结果列表
+            window_ms: 批次收集窗口（毫秒）
+            max_batch_size: 最大批次大小
+            max_batch_pixels: 每批最大像素总数，0表示不限制
+            name: 调度器名称（用于日志）
+        """
+        self.executor = executor
+        self.batch_fn = batch_fn
+        self.window_ms = window_ms
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_batch_pixels = max_batch_pixels
+        self.name = name
+
+        self._queue = None
+        self._carry = None
+        self._task = None
+        self._batches = set()  # 执行中的批次任务
+
+        # 累计统计 - 用于调整收集窗口
+        self.stats = {
+            "batches": 0,
+            "items": 0,
+            "total_queue_wait_ms": 0.0,
+            "total_compute_ms": 0.0,
+        }
+
+    def start(self):
+        """启动批次收集任务（需在事件循环中调用）"""
+        if self._task is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._collect_loop())
+
+    async def stop(self):
+        """停止批次收集任务"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        for batch_task in list(self._batches):
+            batch_task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def submit(self, payload, pixels=0, deadline=None, on_text=None):
+        """
+        提交单个请求并等待其所在批次完成
+
+        Args:
+            deadline: 最晚开始时间（time.time()），所在批次开始时已过期则抛出DeadlineExceededError
+            on_text: 流式文本回调 - 批次中只有这一个请求时逐段输出，与其他请求组批时不调用（只返回完整结果）
+
+        Returns:
+            tuple: (result, timing)，timing包含queue_wait_ms、compute_ms、batch_size
+        """
+        if self._task is None:
+            raise RuntimeError("批处理调度器未启动")
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(BatchItem(payload, pixels, future, deadline, on_text))
+        return await future
+
+    @property
+    def queue_depth(self):
+        """等待组批的请求数"""
+        pending = self._queue.qsize() if self._queue is not None else 0
+        return pending + (1 if self._carry is not None else 0)
+
+    def get_stats(self):
+        """获取累计统计（平均批次大小、平均排队等待、平均计算时间）"""
+        batches = self.stats["batches"]
+        items = self.stats["items"]
+        return {
+            "batches": batches,
+            "items": items,
+            "avg_batch_size": items / batches if batches else 0.0,
+            "avg_queue_wait_ms": self.stats["total_queue_wait_ms"] / items if items else 0.0,
+            "avg_compute_ms": self.stats["total_compute_ms"] / batches if batches else 0.0,
+        }
+
+    async def _next_item(self, timeout=None):
+        """取下一个请求，优先返回上一批因像素预算溢出的请求"""
+        if self._carry is not None:
+            item, self._carry = self._carry, None
+            return item
+        if timeout is None:
+            return await self._queue.get()
+        if timeout <= 0:
+            # 窗口已过，只取已在队列中的请求
+            return self._queue.get_nowait()
+        return await asyncio.wait_for(self._queue.get(), timeout)
+
+    async def _collect_loop(self):
+        """批次收集主循环"""
+        slots = asyncio.Semaphore(self.executor.concurrency)
+        while True:
+            # 等待空闲的执行槽位，期间到达的请求继续累积
+            await slots.acquire()
+            first = await self._next_item()
+            while first.future.cancelled():
+                first = await self._next_item()
+
+            batch = [first]
+            batch_pixels = first.pixels
+            deadline = first.enqueue_time + self.window_ms / 1000.0
+
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = await self._next_item(deadline - time.time())
+                except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                    break
+                if item.future.cancelled():
+                    continue
+                if self.max_batch_pixels and batch_pixels + item.pixels > self.max_batch_pixels:
+                    self._carry = item
+                    break
+                batch.append(item)
+                batch_pixels += item.pixels
+
+            batch_task = asyncio.create_task(self._run_batch(batch))
+            self._batches.add(batch_task)
+            batch_task.add_done_callback(lambda done: (self._batches.discard(done), slots.release()))
+
+    async def _run_batch(self, batch):
+        """
+        在推理执行器中执行一个批次并将结果分发给各请求
+
+        开始执行前已取消或已过截止时间的请求从批次中移除；批次内所有请求都取消时停止整个批次的生成
+        """
+        cancel_flags = [threading.Event() for _ in batch]
+        batch_cancel = threading.Event()
+
+        def _on_item_done(flag, future):
+            if future.cancelled():
+                flag.set()
+                if all(f.is_set() for f in cancel_flags):
+                    batch_cancel.set()
+
+        for item, flag in zip(batch, cancel_flags):
+            item.future.add_done_callback(lambda future, flag=flag: _on_item_done(flag, future))
+
+        if all(item.future.cancelled() for item in batch):
+            # 开始执行前批次内的请求已全部取消，不提交也不计入统计
+            return
+
+        def _timed_batch():
+            start = time.time()
+            expired = {i for i, item in enumerate(batch) if item.deadline is not None and start > item.deadline}
+            live = [i for i, flag in enumerate(cancel_flags) if not flag.is_set() and i not in expired]
+            results = [None] * len(batch)
+            if live:
+                # streamer仅支持batch为1，只有单个请求时才流式输出
+                on_text = batch[live[0]].on_text if len(live) == 1 else None
+                kwargs = {"on_text": on_text} if on_text is not None else {}
+                for i, result in zip(live, self.batch_fn([batch[i].payload for i in live], **kwargs)):
+                    results[i] = result
+            return results, start, time.time(), expired
+
+        try:
+            results, start, end, expired = await self.executor.submit(_timed_batch, cancel_event=batch_cancel)
+        except Exception as e:
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            return
+
+        compute_ms = (end - start) * 1000
+        batch_size = sum(result is not None for result in results)
+        if batch_size:
+            self.stats["batches"] += 1
+            self.stats["total_compute_ms"] += compute_ms
+
+        for i, (item, result) in enumerate(zip(batch, results)):
+            if item.future.done():
+                continue
+            if i in expired:
+                item.future.set_exception(DeadlineExceededError("请求未能在截止时间前开始执行"))
+                continue
+            queue_wait_ms = (start - item.enqueue_time) * 1000
+            self.stats["items"] += 1
+            self.stats["total_queue_wait_ms"] += queue_wait_ms
+            item.future.set_result((result, {
+                "queue_wait_ms": queue_wait_ms,
+                "compute_ms": compute_ms,
+                "batch_size": batch_size,
+            }))
+
+        if not batch_size:
+            return
+        logger.info(
+            f"[{self.name}] 批次完成: 大小={batch_size}, 计算={compute_ms:.0f}ms, "
+            f"等待组批={self.queue_depth}"
+        )
@@ -0,0 +1,35 @@
+"""
+请求取消 - GPU工作线程执行作业时绑定该作业的取消标志，推理后端在每个decode步检查
+客户端发送cancel消息或断开连接时设置标志，generate在下一步停止，GPU立即转去执行下一个排队作业
+"""
+import contextlib
+import threading
+
+
+_local = threading.local()
+
+
+class JobCancelledError(Exception):
+    """作业在开始执行前已被取消"""
+
+
+@contextlib.contextmanager
+def bind_cancel_event(cancel_event):
+    """在当前线程中绑定正在执行的作业的取消标志（由推理执行器调用）"""
+    previous = getattr(_local, "cancel_event", None)
+    _local.cancel_event = cancel_event
+    try:
+        yield cancel_event
+    finally:
+        _local.cancel_event = previous
+
+
+def current_cancel_event():
+    """当前线程正在执行的作业的取消标志（threading.Event），不在作业中时为None"""
+    return getattr(_local, "cancel_event", None)
+
+
+def is_cancelled():
+    """当前作业是否已被取消"""
+    cancel_event = current_cancel_event()
+    return cancel_event is not None and cancel_event.is_set()
@@ -0,0 +1,156 @@
+"""
+推理执行器 - 在专用GPU工作线程中执行阻塞的模型推理
+asyncio事件循环只负责网络I/O，推理任务通过异步作业队列提交给工作线程
+"""
+import asyncio
+import logging
+import queue
+import threading
+import time
+
+from server.admission import DeadlineExceededError
+from server.cancellation import JobCancelledError, bind_cancel_event
+
+
+logger = logging.getLogger(__name__)
+
+
+class InferenceJob:
+    """推理作业 - 记录待执行函数及其结果回传所需的事件循环和future"""
+
+    def __init__(self, fn, args, kwargs, loop, future, cancel_event, deadline=None, affinity=None):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.loop = loop
+        self.future = future
+        self.cancel_event = cancel_event
+        self.deadline = deadline
+        self.affinity = affinity
+        self.enqueue_time = time.time()
+        self.start_time = None
+
+
+class InferenceExecutor:
+    """推理执行器 - 单个GPU工作线程按提交顺序串行执行推理作业"""
+
+    def __init__(self, name="vlm-gpu-worker"):
+        self.name = name
+        self._jobs = queue.Queue()
+        self._thread = None
+        self._running = False
+        self._current_job = None
+
+    def start(self):
+        """启动GPU工作线程"""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._worker_loop, name=self.name, daemon=True)
+        self._thread.start()
+        print(f"推理工作线程已启动: {self.name}")
+
+    def stop(self, timeout=None):
+        """停止GPU工作线程（等待当前作业完成）"""
+        if not self._running:
+            return
+        self._running = False
+        self._jobs.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    async def submit(self, fn, *args, cancel_event=None, deadline=None, affinity=None, **kwargs):
+        """
+        提交推理作业并等待结果
+
+        调用方任务被取消时设置作业的取消标志：排队中的作业直接跳过，执行中的作业由推理后端在下一个decode步停止
+
+        Args:
+            fn: 在GPU工作线程中执行的阻塞函数
+            *args, **kwargs: 传给fn的参数
+            cancel_event: 作业的取消标志（threading.Event），不提供时自动创建；
+                fn执行期间可通过server.cancellation.current_cancel_event()获取
+            deadline: 最晚开始时间（time.time()），轮到执行时已过期则抛出DeadlineExceededError
+            affinity: 亲和键（如会话ID），多副本执行器把同一键的作业交给同一副本；单线程执行器忽略
+
+        Returns:
+            fn的返回值；fn抛出的异常会在调用方重新抛出
+        """
+        if not self._running:
+            raise RuntimeError("推理执行器未启动")
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if cancel_event is None:
+            cancel_event = threading.Event()
+        future.add_done_callback(lambda f: cancel_event.set() if f.cancelled() else None)
+        self._enqueue(InferenceJob(fn, args, kwargs, loop, future, cancel_event, deadline, affinity))
+        return await future
+
+    def _enqueue(self, job):
+        self._jobs.put(job)
+
+    @property
+    def concurrency(self):
+        """可同时执行的作业数"""
+        return 1
+
+    @property
+    def queue_depth(self):
+        """排队中（尚未开始执行）的作业数"""
+        return self._jobs.qsize()
+
+    @property
+    def is_busy(self):
+        """工作线程是否正在执行作业"""
+        return self._current_job is not None
+
+    def _worker_loop(self):
+        """GPU工作线程主循环"""
+        while self._running:
+            job = self._jobs.get()
+            if job is None:
+                break
+            self._current_job = job
+            try:
+                self._run_job(job)
+            finally:
+                self._current_job = None
+
+    def _run_job(self, job):
+        """在当前工作线程中执行一个作业并回传结果"""
+        # 调用方已放弃（取消请求或连接断开）的作业直接跳过
+        if job.cancel_event.is_set():
+            self._resolve(job, exception=JobCancelledError("作业已取消"))
+            return
+        if job.deadline is not None and time.time() > job.deadline:
+            self._resolve(job, exception=DeadlineExceededError("请求未能在截止时间前开始执行"))
+            return
+
+        job.start_time = time.time()
+        try:
+            with bind_cancel_event(job.cancel_event):
+                result = job.fn(*job.args, **job.kwargs)
+        except BaseException as e:
+            logger.error(f"推理作业执行错误: {e}")
+            self._resolve(job, exception=e)
+        else:
+            self._resolve(job, result=result)
+
+    @staticmethod
+    def _resolve(job, result=None, exception=None):
+        """在事件循环线程中设置作业结果"""
+        def _set():
+            if job.future.cancelled():
+                return
+            if exception is not None:
+                job.future.set_exception(exception)
+            else:
+                job.future.set_result(result)
+
+        try:
+            job.loop.call_soon_threadsafe(_set)
+        except RuntimeError:
+            # 事件循环已关闭
+            pass
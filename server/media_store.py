@@ -0,0 +1,185 @@
+"""
+内容寻址媒体存储 - 以SHA-256为键保存客户端上传过的媒体文件
+客户端先询问服务器是否已有该文件，命中时无需重复上传；按磁盘预算LRU淘汰
+"""
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+class MediaStore:
+    """内容寻址媒体存储（仅在事件循环线程中访问）"""
+
+    def __init__(self, root_dir, max_bytes):
+        """
+        Args:
+            root_dir: 存储目录
+            max_bytes: 磁盘预算（字节）
+        """
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # sha256 -> (路径, 字节数)，按最近使用排序
+        self._pins = {}                # sha256 -> 正在使用该文件的请求数
+        self._persisting = set()       # 正在后台写入的sha256
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(root_dir, exist_ok=True)
+        self._load_existing()
+
+    def _load_existing(self):
+        """扫描存储目录，恢复服务器重启前的条目（按修改时间排序）"""
+        files = []
+        for name in os.listdir(self.root_dir):
+            sha256 = name.split('.', 1)[0]
+            path = os.path.join(self.root_dir, name)
+            if name.startswith('.tmp_'):
+                # 上次运行中断时未完成的后台写入
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                continue
+            if len(sha256) != 64 or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, sha256, path, stat.st_size))
+
+        for _, sha256, path, size in sorted(files):
+            self._entries[sha256] = (path, size)
+            self.total_bytes += size
+
+        if files:
+            print(f"媒体存储已恢复 {len(files)} 个文件 ({self.total_bytes / 1024 ** 2:.1f} MB)")
+        self._evict()
+
+    def contains(self, sha256):
+        """是否已有该媒体（不计入命中统计）"""
+        return sha256 in self._entries
+
+    def acquire(self, sha256):
+        """
+        获取媒体文件路径并标记为使用中（使用期间不会被淘汰）
+
+        Returns:
+            str: 文件路径；未命中时返回None
+        """
+        entry = self._entries.get(sha256)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(sha256)
+        self._pins[sha256] = self._pins.get(sha256, 0) + 1
+        try:
+            os.utime(entry[0])
+        except OSError:
+            pass
+        return entry[0]
+
+    def release(self, sha256):
+        """释放acquire的使用标记"""
+        count = self._pins.get(sha256, 0) - 1
+        if count > 0:
+            self._pins[sha256] = count
+        else:
+            self._pins.pop(sha256, None)
+        self._evict()
+
+    def put(self, src_path, sha256, suffix=""):
+        """
+        将已校验哈希的文件移入存储，并与acquire一样标记为使用中（用完需release）
+
+        Args:
+            src_path: 源文件路径（移动后源文件不再存在）
+            sha256: 文件内容的SHA-256
+            suffix: 文件扩展名
+
+        Returns:
+            str: 存储中的文件路径
+        """
+        if sha256 in self._entries:
+            os.unlink(src_path)
+        else:
+            path = os.path.join(self.root_dir, sha256 + suffix)
+            shutil.move(src_path, path)
+            self._add(sha256, path)
+
+        self._entries.move_to_end(sha256)
+        self._pins[sha256] = self._pins.get(sha256, 0) + 1
+        self._evict()
+        return self._entries[sha256][0]
+
+    async def persist(self, src_path, sha256, suffix=""):
+        """
+        在I/O线程池中把文件复制进存储（源文件保留，由调用方删除），复制期间不阻塞事件循环
+
+        用于内存暂存的上传: 请求直接从内存文件解码，处理完成后再写入存储；
+        先写临时文件再原子重命名，复制完成前该媒体视为不在存储中
+
+        Args:
+            src_path: 源文件路径
+            sha256: 文件内容的SHA-256（已校验）
+            suffix: 文件扩展名
+        """
+        if sha256 in self._entries or sha256 in self._persisting:
+            return
+        self._persisting.add(sha256)
+        path = os.path.join(self.root_dir, sha256 + suffix)
+        try:
+            await asyncio.to_thread(self._copy_atomic, src_path, path)
+        finally:
+            self._persisting.discard(sha256)
+        if sha256 not in self._entries:
+            self._add(sha256, path)
+        self._evict()
+
+    def _copy_atomic(self, src_path, path):
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp_', suffix=os.path.basename(path), dir=self.root_dir)
+        try:
+            with os.fdopen(fd, 'wb') as dst, open(src_path, 'rb') as src:
+                shutil.copyfileobj(src, dst, 1024 ** 2)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _add(self, sha256, path):
+        size = os.path.getsize(path)
+        self._entries[sha256] = (path, size)
+        self.total_bytes += size
+
+    def _evict(self):
+        """按LRU淘汰未被使用的条目直到不超过磁盘预算"""
+        for sha256 in list(self._entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if sha256 in self._pins:
+                continue
+            path, size = self._entries.pop(sha256)
+            self.total_bytes -= size
+            try:
+                os.unlink(path)
+            except OSError as e:
+                logger.warning(f"删除媒体文件失败: {path}: {e}")
+            print(f"媒体存储淘汰: {sha256[:12]} ({size / 1024 ** 2:.1f} MB)")
+
+    def get_stats(self):
+        """存储统计"""
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,272 @@
+"""
+服务器指标 - 计数器、仪表和直方图，按Prometheus文本格式通过本地HTTP端点导出
+不依赖prometheus_client；指标可在事件循环线程和GPU工作线程中并发更新
+"""
+import asyncio
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# 默认直方图分桶
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+TOKENS_PER_S_BUCKETS = (1, 5, 10, 20, 40, 80, 160, 320)
+MEMORY_BUCKETS = tuple(gb * 1024 ** 3 for gb in (1, 2, 4, 8, 16, 24, 32, 48, 64, 80))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """指标基类 - 按标签值分组保存样本"""
+    kind = ""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"指标 {self.name} 的标签应为 {self.label_names}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            lines.extend(self._render_samples())
+        return lines
+
+    def _render_samples(self):
+        return [
+            f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+            for key, value in sorted(self._values.items())
+        ]
+
+
+class Counter(_Metric):
+    """单调递增计数器"""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """仪表 - 可增可减；设置了回调时在导出时读取当前值"""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=(), callback=None):
+        """
+        Args:
+            callback: 无标签仪表导出时调用的取值函数；有标签时返回 {标签值元组: 数值}
+        """
+        super().__init__(name, help_text, labels)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def _render_samples(self):
+        if self.callback is not None:
+            try:
+                value = self.callback()
+            except Exception as e:
+                logger.warning(f"读取指标 {self.name} 失败: {e}")
+                return []
+            values = value if isinstance(value, dict) else {(): value}
+            return [
+                f"{self.name}{_format_labels(self.label_names, key)} {_format_value(v)}"
+                for key, v in sorted(values.items())
+            ]
+        return super()._render_samples()
+
+
+class Histogram(_Metric):
+    """直方图 - 累积分桶计数、总和与样本数"""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def _render_samples(self):
+        lines = []
+        for key, (counts, total) in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, counts):
+                le = _format_labels(self.label_names, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{le} {count}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {counts[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=(), callback=None):
+        return self.register(Gauge(name, help_text, labels, callback))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def render(self):
+        """导出Prometheus文本格式"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class ServerMetrics:
+    """VLM服务器指标集合"""
+
+    def __init__(self, queue_depths=None):
+        """
+        Args:
+            queue_depths: 返回 {队列名: 排队数} 的函数，导出时调用
+        """
+        self.registry = MetricsRegistry()
+        r = self.registry
+        self.requests = r.counter("vlm_requests_total", "处理完成的请求数", ("type", "status"))
+        self.latency = r.histogram("vlm_request_latency_seconds", "请求端到端延迟", ("type",))
+        self.stage_latency = r.histogram(
+            "vlm_stage_latency_seconds", "请求各阶段耗时", ("type", "stage"), buckets=STAGE_BUCKETS
+        )
+        self.queue_depth = r.gauge(
+            "vlm_queue_depth", "排队中的作业数", ("queue",),
+            callback=(lambda: {(name,): depth for name, depth in queue_depths().items()}) if queue_depths else None,
+        )
+        self.connections = r.gauge("vlm_active_connections", "当前websocket连接数")
+        self.bytes_received = r.counter("vlm_received_bytes_total", "接收的字节数", ("kind",))
+        self.tokens = r.counter("vlm_generated_tokens_total", "生成的token数", ("type",))
+        self.tokens_per_s = r.histogram(
+            "vlm_generation_tokens_per_second", "单次请求的生成速度", ("type",), buckets=TOKENS_PER_S_BUCKETS
+        )
+        self.peak_memory = r.histogram(
+            "vlm_peak_device_memory_bytes", "单次推理的设备显存峰值", ("type",), buckets=MEMORY_BUCKETS
+        )
+        self.errors = r.counter("vlm_errors_total", "错误数（按异常类型）", ("type", "error"))
+        self.result_cache = r.counter("vlm_result_cache_total", "结果缓存查询数", ("type", "outcome"))
+        self.rejected = r.counter("vlm_rejected_requests_total", "准入控制拒绝的请求数", ("type", "reason"))
+
+    def observe_request(self, request_type, timing, stats):
+        """记录一个成功请求的延迟、各阶段耗时、token数和显存峰值"""
+        request_type = request_type or "unknown"
+        self.requests.inc(type=request_type, status="ok")
+        if "total" in timing:
+            self.latency.observe(timing["total"] / 1000, type=request_type)
+        for stage, ms in timing.items():
+            if stage != "total":
+                self.stage_latency.observe(ms / 1000, type=request_type, stage=stage)
+        if stats.get("output_tokens"):
+            self.tokens.inc(stats["output_tokens"], type=request_type)
+            self.tokens_per_s.observe(stats.get("tokens_per_s", 0.0), type=request_type)
+        if stats.get("peak_memory_bytes"):
+            self.peak_memory.observe(stats["peak_memory_bytes"], type=request_type)
+        if "result_cache_hit" in stats:
+            outcome = "shared" if stats.get("result_cache_shared") else "hit" if stats["result_cache_hit"] else "miss"
+            self.result_cache.inc(type=request_type, outcome=outcome)
+
+    def record_error(self, request_type, error):
+        """记录一个失败请求（error为异常对象或错误类名）"""
+        request_type = request_type or "unknown"
+        error_class = error if isinstance(error, str) else type(error).__name__
+        self.requests.inc(type=request_type, status="error")
+        self.errors.inc(type=request_type, error=error_class)
+
+    def record_rejection(self, request_type, reason):
+        """记录一个被准入控制拒绝（或未能在截止时间前开始）的请求"""
+        request_type = request_type or "unknown"
+        self.requests.inc(type=request_type, status="rejected")
+        self.rejected.inc(type=request_type, reason=reason)
+
+    def record_cancel(self, request_type):
+        """记录一个被客户端取消（或因断开连接而取消）的请求"""
+        self.requests.inc(type=request_type or "unknown", status="cancelled")
+
+    def render(self):
+        return self.registry.render()
+
+
+async def serve_metrics(metrics, host="127.0.0.1", port=9100):
+    """
+    启动指标HTTP端点（GET /metrics），返回asyncio服务器
+
+    只实现导出指标所需的最小HTTP/1.0响应，不引入额外的Web框架
+    """
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            # 丢弃请求头
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/metrics", "/"):
+                body = metrics.render().encode("utf-8")
+                status = "200 OK"
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            else:
+                body = b"not found\n"
+                status = "404 Not Found"
+                content_type = "text/plain"
+            writer.write(
+                f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    metrics_server = await asyncio.start_server(handle, host, port)
+    print(f"指标端点: http://{host}:{port}/metrics")
+    return metrics_server
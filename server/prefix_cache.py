@@ -0,0 +1,128 @@
+"""
+会话前缀KV缓存 - 按会话保存(系统提示词 + 媒体)前缀的past_key_values
+同一会话对同一媒体的后续提问只需prefill新增文本，视觉token不再重复计算
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+# 会话保留的最大历史轮数（超出后丢弃最早的问答）
+MAX_HISTORY_TURNS = 8
+
+
+def cache_nbytes(past_key_values):
+    """统计KV缓存占用的字节数"""
+    total = 0
+    for layer in past_key_values:
+        for tensor in layer[:2]:
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class SessionPrefix:
+    """会话前缀 - 前缀token、对应的KV缓存以及对话历史"""
+
+    def __init__(self, media_id, prefix_ids, past_key_values, rope_deltas, pad_token, grid_thw):
+        """
+        Args:
+            media_id: 媒体标识，会话中媒体变化时前缀失效
+            prefix_ids: 前缀token序列（系统提示词 + 用户轮开头 + 展开后的视觉token）
+            past_key_values: 前缀的KV缓存（每轮生成后裁剪回前缀长度）
+            rope_deltas: 前缀计算得到的多模态位置编码偏移
+            pad_token: 视觉占位token（图像或视频）
+            grid_thw: 视觉网格，用于后续轮次展开占位token
+        """
+        self.media_id = media_id
+        self.prefix_ids = prefix_ids
+        self.past_key_values = past_key_values
+        self.rope_deltas = rope_deltas
+        self.pad_token = pad_token
+        self.grid_thw = grid_thw
+        self.history = []  # [(提示词, 回答), ...]
+        self.nbytes = cache_nbytes(past_key_values)
+        self.last_used = time.time()
+
+    @property
+    def prefix_len(self):
+        return len(self.prefix_ids)
+
+    def add_turn(self, prompt, answer):
+        """记录一轮问答"""
+        self.history.append((prompt, answer))
+        del self.history[:-MAX_HISTORY_TURNS]
+
+
+class PrefixCacheStore:
+    """会话前缀缓存 - 按显存预算和会话数LRU淘汰，超过TTL未使用的会话过期"""
+
+    def __init__(self, max_bytes, max_sessions=16, ttl_s=600):
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self.ttl_s = ttl_s
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes_held = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_id, media_id):
+        """
+        获取会话前缀；会话不存在、已过期或媒体已变化时返回None
+
+        Returns:
+            SessionPrefix或None
+        """
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(session_id)
+            if session is not None and session.media_id != media_id:
+                self._remove(session_id)
+                session = None
+            if session is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            session.last_used = time.time()
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def put(self, session_id, session):
+        """保存会话前缀并按预算淘汰"""
+        with self._lock:
+            self._remove(session_id)
+            self._sessions[session_id] = session
+            self.bytes_held += session.nbytes
+            while self._sessions and (
+                self.bytes_held > self.max_bytes or len(self._sessions) > self.max_sessions
+            ):
+                oldest = next(iter(self._sessions))
+                if oldest == session_id and len(self._sessions) == 1:
+                    break
+                self._remove(oldest)
+
+    def drop(self, session_id):
+        """删除会话"""
+        with self._lock:
+            self._remove(session_id)
+
+    def _remove(self, session_id):
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self.bytes_held -= session.nbytes
+
+    def _expire(self):
+        now = time.time()
+        for session_id in [sid for sid, s in self._sessions.items() if now - s.last_used > self.ttl_s]:
+            self._remove(session_id)
+
+    def get_stats(self):
+        """缓存统计"""
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "bytes_held": self.bytes_held,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
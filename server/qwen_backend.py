@@ -0,0 +1,743 @@
+"""
+Qwen2.5-VL推理后端 - 模型加载、输入预处理、视觉编码缓存、会话前缀缓存和生成
+"""
+import base64
+import hashlib
+import inspect
+import logging
+import os
+import time
+
+import torch
+from transformers import (
+    Qwen2_5_VLForConditionalGeneration, AutoProcessor, BatchFeature, DynamicCache, StoppingCriteriaList
+)
+from qwen_vl_utils import process_vision_info
+from PIL import Image
+
+from server.backend import InferenceBackend
+from server.cancellation import current_cancel_event
+from server.streaming import CallbackStreamer, CancelStoppingCriteria, TokenTimer
+from server.vision_cache import VisionEncoderCache, install_vision_cache
+from server.prefix_cache import PrefixCacheStore, SessionPrefix
+from server.timing import timed
+
+logger = logging.getLogger(__name__)
+
+# 视频像素预算 - 按照cookbook配置
+VIDEO_TOTAL_PIXELS = 20480 * 28 * 28
+VIDEO_MIN_PIXELS = 16 * 28 * 28
+
+# 最大生成token数
+IMAGE_MAX_NEW_TOKENS = 512
+VIDEO_MAX_NEW_TOKENS = 2048
+
+
+class QwenVLBackend(InferenceBackend):
+    """Qwen2.5-VL推理后端"""
+    
+    name = "qwen"
+    
+    def __init__(self, model_path: str = "Qwen/Qwen2.5-VL-7B-Instruct", vision_cache_mb: float = 1024,
+                 session_cache_mb: float = 2048, max_sessions: int = 16, session_ttl_s: float = 600):
+        self.model_path = model_path
+        self.model = None
+        self.processor = None
+        
+        # 视觉编码缓存 - 同一媒体换提示词时跳过解码和视觉编码
+        self.vision_cache = VisionEncoderCache(int(vision_cache_mb * 1024 ** 2)) if vision_cache_mb > 0 else None
+        self.visual_encoder = None
+        
+        # 会话前缀KV缓存 - 同一会话对同一媒体追问时只prefill新增文本
+        self.session_cache = None
+        if session_cache_mb > 0:
+            self.session_cache = PrefixCacheStore(
+                int(session_cache_mb * 1024 ** 2), max_sessions=max_sessions, ttl_s=session_ttl_s
+            )
+    
+    @property
+    def device(self):
+        return str(self.model.device) if self.model else "未加载"
+    
+    @property
+    def supports_sessions(self):
+        return self.session_cache is not None
+    
+    def get_stats(self):
+        return {
+            "vision_cache": self.vision_cache.get_stats() if self.vision_cache is not None else None,
+            "session_cache": self.session_cache.get_stats() if self.session_cache is not None else None,
+        }
+    
+    def generation_params(self, request_type):
+        params = {"backend": self.name, "model": self.model_path}
+        if request_type == "video":
+            params.update(
+                max_new_tokens=VIDEO_MAX_NEW_TOKENS, total_pixels=VIDEO_TOTAL_PIXELS, min_pixels=VIDEO_MIN_PIXELS
+            )
+        else:
+            params["max_new_tokens"] = IMAGE_MAX_NEW_TOKENS
+        return params
+    
+    def load(self):
+        """加载VLM模型"""
+        print(f"正在加载模型: {self.model_path}")
+        
+        # 检查GPU
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        print(f"使用设备: {device}")
+        
+        if device == "cuda":
+            gpu_count = torch.cuda.device_count()
+            print(f"可用GPU数量: {gpu_count}")
+            for i in range(gpu_count):
+                gpu_name = torch.cuda.get_device_name(i)
+                gpu_memory = torch.cuda.get_device_properties(i).total_memory / 1024**3
+                print(f"GPU {i}: {gpu_name} ({gpu_memory:.1f} GB)")
+        
+        # 加载模型 - 使用服务器的全部GPU内存
+        load_kwargs = {
+            "torch_dtype": torch.bfloat16,
+            "device_map": "auto",  # 自动分配到多个GPU
+            "trust_remote_code": True,
+        }
+        
+        # 尝试使用Flash Attention 2
+        try:
+            import flash_attn
+            load_kwargs["attn_implementation"] = "flash_attention_2"
+            print("使用Flash Attention 2优化")
+        except ImportError:
+            print("Flash Attention 2不可用，使用标准attention")
+        
+        print(f"模型加载配置: {load_kwargs}")
+        
+        self.model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
+            self.model_path, **load_kwargs
+        )
+        self.processor = AutoProcessor.from_pretrained(self.model_path)
+        # 批量生成需要左侧padding，保证各序列的生成起点对齐
+        self.processor.tokenizer.padding_side = "left"
+        
+        if self.vision_cache is not None:
+            self.visual_encoder = install_vision_cache(self.model, self.vision_cache)
+            print(f"视觉编码缓存已启用: {self.vision_cache.max_bytes / 1024 ** 2:.0f} MB")
+        
+        print("VLM模型加载完成!")
+    
+    def prepare_image(self, image_data):
+        """
+        准备图像输入（在I/O线程池中调用）
+        
+        预计命中视觉编码缓存的图像保持未解码的原始字节，其余图像解码为PIL图像
+        
+        Returns:
+            tuple: (图像或原始字节, 视觉缓存键, 像素数, 图像SHA-256)
+        """
+        image_bytes = base64.b64decode(image_data) if isinstance(image_data, str) else image_data
+        image_sha256 = hashlib.sha256(image_bytes).hexdigest()
+        vision_key = None
+        if self.visual_encoder is not None:
+            vision_key = self.image_vision_key(image_sha256)
+            if self.vision_cache.contains(vision_key):
+                return image_bytes, vision_key, 0, image_sha256
+        image = self.decode_image(image_bytes)
+        return image, vision_key, image.width * image.height, image_sha256
+    
+    def process_image_batch(self, items, on_text=None) -> list:
+        """
+        批量处理图像推理 - 多个请求合并为一次padding后的generate调用
+        
+        Args:
+            items: [(图像, 提示词[, 视觉缓存键]), ...]
+                图像为PIL图像；预计命中视觉编码缓存时可为未解码的原始字节
+            on_text: 流式文本回调（仅支持单条请求）
+            
+        Returns:
+            list: 与items等长的 [(结果文本, 统计信息), ...]
+        """
+        try:
+            items = [tuple(item) + (None,) * (3 - len(item)) for item in items]
+            prep_stats = {}
+            
+            # 构建消息
+            batch_messages = [
+                [
+                    {"role": "system", "content": "You are a helpful assistant."},
+                    {"role": "user", "content": [
+                        {"type": "text", "text": prompt},
+                        {"type": "image", "image": image},
+                    ]}
+                ]
+                for image, prompt, _ in items
+            ]
+            
+            # 处理输入
+            with timed(prep_stats, "preprocess"):
+                texts = [
+                    self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+                    for messages in batch_messages
+                ]
+            
+            if self.visual_encoder is not None:
+                inputs, cache_hits = self._build_cached_image_inputs(items, texts, prep_stats)
+            else:
+                with timed(prep_stats, "vision_info"):
+                    image_inputs, video_inputs = process_vision_info(batch_messages)
+                with timed(prep_stats, "preprocess"):
+                    inputs = self.processor(
+                        text=texts,
+                        images=image_inputs,
+                        videos=video_inputs,
+                        padding=True,
+                        return_tensors="pt"
+                    )
+                cache_hits = [False] * len(items)
+            with timed(prep_stats, "to_device"):
+                inputs = inputs.to(self.model.device)
+            
+            # 生成回复
+            try:
+                output_text, stats = self._generate(
+                    inputs, max_new_tokens=IMAGE_MAX_NEW_TOKENS, clean_up_tokenization_spaces=False, on_text=on_text
+                )
+            finally:
+                if self.visual_encoder is not None:
+                    self.visual_encoder.plan = None
+            stats.update(prep_stats)
+            return [
+                (text.strip(), dict(stats, vision_cache_hit=hit))
+                for text, hit in zip(output_text, cache_hits)
+            ]
+            
+        except Exception as e:
+            logger.error(f"图像处理错误: {e}")
+            return [(f"处理错误: {str(e)}", {"error": type(e).__name__})] * len(items)
+    
+    def image_vision_key(self, image_sha256: str):
+        """图像的视觉编码缓存键（媒体哈希 + 图像缩放参数）"""
+        image_processor = self.processor.image_processor
+        return self.vision_cache.make_key(
+            image_sha256, "image",
+            min_pixels=image_processor.min_pixels,
+            max_pixels=image_processor.max_pixels,
+        )
+    
+    def video_vision_key(self, video_sha256: str):
+        """视频的视觉编码缓存键（媒体哈希 + 视频像素预算）"""
+        return self.vision_cache.make_key(
+            video_sha256, "video",
+            total_pixels=VIDEO_TOTAL_PIXELS,
+            min_pixels=VIDEO_MIN_PIXELS,
+        )
+    
+    def _expand_visual_tokens(self, text: str, pad_token: str, grids) -> str:
+        """按视觉网格大小展开chat模板中的视觉占位token（与processor的展开规则一致）"""
+        merge_length = self.processor.image_processor.merge_size ** 2
+        for grid in grids:
+            num_tokens = int(grid.prod()) // merge_length
+            text = text.replace(pad_token, "<|placeholder|>" * num_tokens, 1)
+        return text.replace("<|placeholder|>", pad_token)
+    
+    def _empty_pixel_values(self):
+        """全部命中视觉编码缓存时传给模型的空像素输入（仍需触发视觉编码器调用）"""
+        image_processor = self.processor.image_processor
+        channels = 3 * image_processor.temporal_patch_size * image_processor.patch_size ** 2
+        return torch.empty((0, channels))
+    
+    def _build_cached_image_inputs(self, items, texts, stats):
+        """
+        构建批量图像输入 - 命中视觉编码缓存的图像不解码、不缩放，只对未命中的图像做预处理
+        
+        Args:
+            stats: 分阶段耗时累加到该字典
+        
+        Returns:
+            tuple: (模型输入BatchFeature, 每条请求是否命中缓存)
+        """
+        plan = []
+        miss_images = []
+        for image, _, key in items:
+            entry = self.vision_cache.get(key) if key is not None else None
+            if entry is None:
+                if not isinstance(image, Image.Image):
+                    # 预计命中但已被淘汰，现场解码
+                    with timed(stats, "media_decode"):
+                        image = self.decode_image(image)
+                miss_images.append(image)
+            plan.append((key, entry, None))
+        
+        if miss_images:
+            with timed(stats, "vision_info"):
+                image_inputs, _ = process_vision_info([
+                    [{"role": "user", "content": [{"type": "image", "image": image}]}] for image in miss_images
+                ])
+            with timed(stats, "preprocess"):
+                miss_features = self.processor.image_processor(images=image_inputs, return_tensors="pt")
+            pixel_values = miss_features["pixel_values"]
+            miss_grids = iter(miss_features["image_grid_thw"])
+        else:
+            pixel_values = self._empty_pixel_values()
+            miss_grids = iter(())
+        
+        grids = [entry.grid_thw if entry is not None else next(miss_grids) for _, entry, _ in plan]
+        image_token = getattr(self.processor, "image_token", "<|image_pad|>")
+        with timed(stats, "preprocess"):
+            texts = [self._expand_visual_tokens(text, image_token, [grid]) for text, grid in zip(texts, grids)]
+            text_inputs = self.processor.tokenizer(texts, padding=True, return_tensors="pt")
+        inputs = BatchFeature(data={
+            **text_inputs,
+            "pixel_values": pixel_values,
+            "image_grid_thw": torch.stack(grids),
+        })
+        self.visual_encoder.plan = plan
+        return inputs, [entry is not None for _, entry, _ in plan]
+    
+    def process_video(self, video_path: str, prompt: str, on_text=None, media_sha256: str = None,
+                      session_id: str = None):
+        """
+        处理视频推理（兼容旧接口）
+        
+        Args:
+            media_sha256: 视频内容哈希，提供时启用视觉编码缓存
+            session_id: 会话ID，提供时复用会话的前缀KV缓存并携带对话历史
+        """
+        video_content = {"video": video_path, "total_pixels": VIDEO_TOTAL_PIXELS, "min_pixels": VIDEO_MIN_PIXELS}
+        return self._process_video_content(
+            video_content, prompt, on_text, media_sha256, session_id, media_sha256 or os.path.abspath(video_path)
+        )
+    
+    def video_frame_budget(self):
+        return {"total_pixels": VIDEO_TOTAL_PIXELS, "min_pixels": VIDEO_MIN_PIXELS}
+    
+    def process_video_frames(self, frames, prompt: str, fps: float, on_text=None, media_sha256: str = None,
+                             session_id: str = None):
+        """
+        处理客户端抽取的帧序列 - 帧已按像素预算缩放到28的倍数，跳过视频解码和缩放
+        
+        Args:
+            frames: PIL图像列表
+            fps: 抽帧帧率（决定时间位置编码）
+            media_sha256: 帧序列负载的哈希，提供时启用视觉编码缓存
+        """
+        width, height = frames[0].size
+        video_content = {"video": frames, "fps": fps, "resized_height": height, "resized_width": width}
+        return self._process_video_content(video_content, prompt, on_text, media_sha256, session_id, media_sha256)
+    
+    def process_video_frames_batch(self, items, on_text=None) -> list:
+        """
+        批量处理帧序列视频 - 多个请求合并为一次padding后的generate调用（如长视频的各分段）
+        
+        单个请求走process_video_frames以使用视觉编码缓存；批量时各视频的视觉token数不同，不使用视觉编码缓存
+        
+        Args:
+            items: [(帧列表, 提示词, 抽帧帧率, 帧序列SHA-256), ...]
+            on_text: 流式文本回调（仅支持单条请求）
+            
+        Returns:
+            list: 与items等长的 [(结果文本, 统计信息), ...]
+        """
+        if len(items) == 1:
+            frames, prompt, fps, media_sha256 = items[0]
+            return [self.process_video_frames(frames, prompt, fps, on_text=on_text, media_sha256=media_sha256)]
+        
+        try:
+            batch_messages = []
+            for frames, prompt, fps, _ in items:
+                width, height = frames[0].size
+                batch_messages.append([
+                    {"role": "system", "content": "You are a helpful assistant."},
+                    {"role": "user", "content": [
+                        {"type": "text", "text": prompt},
+                        {"video": frames, "fps": fps, "resized_height": height, "resized_width": width},
+                    ]}
+                ])
+            
+            prep_stats = {}
+            with timed(prep_stats, "preprocess"):
+                texts = [
+                    self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+                    for messages in batch_messages
+                ]
+            with timed(prep_stats, "vision_info"):
+                image_inputs, video_inputs, video_kwargs = process_vision_info(batch_messages, return_video_kwargs=True)
+            with timed(prep_stats, "preprocess"):
+                inputs = self.processor(
+                    text=texts,
+                    images=image_inputs,
+                    videos=video_inputs,
+                    fps=video_kwargs['fps'],
+                    padding=True,
+                    return_tensors="pt"
+                )
+            with timed(prep_stats, "to_device"):
+                inputs = inputs.to(self.model.device)
+            
+            output_text, stats = self._generate(
+                inputs, max_new_tokens=VIDEO_MAX_NEW_TOKENS, clean_up_tokenization_spaces=True
+            )
+            stats.update(prep_stats, vision_cache_hit=False)
+            return [(text.strip(), dict(stats)) for text in output_text]
+            
+        except Exception as e:
+            logger.error(f"视频批量处理错误: {e}")
+            return [(f"处理错误: {str(e)}", {"error": type(e).__name__})] * len(items)
+    
+    def process_text(self, prompt: str, on_text=None):
+        """纯文本推理（不含视觉输入）"""
+        try:
+            messages = [
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": [{"type": "text", "text": prompt}]},
+            ]
+            prep_stats = {}
+            with timed(prep_stats, "preprocess"):
+                text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+                inputs = self.processor(text=[text], padding=True, return_tensors="pt")
+            with timed(prep_stats, "to_device"):
+                inputs = inputs.to(self.model.device)
+            
+            output_text, stats = self._generate(
+                inputs, max_new_tokens=VIDEO_MAX_NEW_TOKENS, clean_up_tokenization_spaces=True, on_text=on_text
+            )
+            stats.update(prep_stats)
+            return output_text[0].strip(), stats
+            
+        except Exception as e:
+            logger.error(f"文本处理错误: {e}")
+            return f"处理错误: {str(e)}", {"error": type(e).__name__}
+    
+    def _process_video_content(self, video_content, prompt, on_text, media_sha256, session_id, media_id):
+        """视频推理（视频文件和帧序列共用）"""
+        vision_key = None
+        if self.visual_encoder is not None and media_sha256:
+            vision_key = self.video_vision_key(media_sha256)
+        
+        try:
+            if session_id:
+                video_token = getattr(self.processor, "video_token", "<|video_pad|>")
+                return self._generate_in_session(
+                    session_id, media_id, video_content, video_token, prompt,
+                    lambda messages, text, stats: self._build_video_inputs(messages, text, vision_key, stats),
+                    max_new_tokens=VIDEO_MAX_NEW_TOKENS, clean_up_tokenization_spaces=True, on_text=on_text,
+                )
+            
+            # 构建消息 - 按照cookbook格式
+            messages = [
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": [
+                    {"type": "text", "text": prompt},
+                    video_content,
+                ]}
+            ]
+            
+            # 处理输入
+            prep_stats = {}
+            with timed(prep_stats, "preprocess"):
+                text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+            inputs, cache_hit = self._build_video_inputs(messages, text, vision_key, prep_stats)
+            with timed(prep_stats, "to_device"):
+                inputs = inputs.to(self.model.device)
+
+            # 生成回复
+            output_text, stats = self._generate(
+                inputs, max_new_tokens=VIDEO_MAX_NEW_TOKENS, clean_up_tokenization_spaces=True, on_text=on_text
+            )
+            stats.update(prep_stats, vision_cache_hit=cache_hit)
+            return output_text[0].strip(), stats
+            
+        except Exception as e:
+            logger.error(f"视频处理错误: {e}")
+            return f"处理错误: {str(e)}", {"error": type(e).__name__}
+        finally:
+            if self.visual_encoder is not None:
+                self.visual_encoder.plan = None
+    
+    def _build_video_inputs(self, messages, text, vision_key, stats):
+        """
+        构建视频模型输入 - 命中视觉编码缓存时跳过帧解码、缩放和视觉编码
+        
+        Args:
+            vision_key: 视觉编码缓存键，None表示不使用缓存
+            stats: 分阶段耗时累加到该字典
+        
+        Returns:
+            tuple: (模型输入BatchFeature, 是否命中视觉编码缓存)
+        """
+        entry = self.vision_cache.get(vision_key) if vision_key is not None else None
+        
+        if entry is not None:
+            video_token = getattr(self.processor, "video_token", "<|video_pad|>")
+            with timed(stats, "preprocess"):
+                text = self._expand_visual_tokens(text, video_token, [entry.grid_thw])
+                text_inputs = self.processor.tokenizer([text], return_tensors="pt")
+            inputs = BatchFeature(data={
+                **text_inputs,
+                "pixel_values_videos": self._empty_pixel_values(),
+                "video_grid_thw": entry.grid_thw.unsqueeze(0),
+                "second_per_grid_ts": torch.tensor([entry.second_per_grid_ts]),
+            })
+            self.visual_encoder.plan = [(vision_key, entry, None)]
+            return inputs, True
+        
+        # 帧解码和缩放
+        with timed(stats, "vision_info"):
+            image_inputs, video_inputs, video_kwargs = process_vision_info([messages], return_video_kwargs=True)
+        fps_inputs = video_kwargs['fps']
+        
+        with timed(stats, "preprocess"):
+            inputs = self.processor(
+                text=[text], 
+                images=image_inputs, 
+                videos=video_inputs, 
+                fps=fps_inputs, 
+                padding=True, 
+                return_tensors="pt"
+            )
+        if vision_key is not None:
+            second_per_grid_ts = float(inputs["second_per_grid_ts"][0])
+            self.visual_encoder.plan = [(vision_key, None, {"second_per_grid_ts": second_per_grid_ts})]
+        return inputs, False
+    
+    def process_image_session(self, image, prompt: str, vision_key=None, session_id: str = None,
+                              media_id: str = None, on_text=None):
+        """
+        会话模式的图像推理 - 同一会话对同一图像的后续提问复用前缀KV缓存
+        
+        Args:
+            image: PIL图像或未解码的原始字节
+            media_id: 图像标识（内容哈希），图像变化时会话前缀失效
+        """
+        def build_inputs(messages, text, stats):
+            if self.visual_encoder is not None:
+                inputs, hits = self._build_cached_image_inputs([(image, prompt, vision_key)], [text], stats)
+                return inputs, hits[0]
+            messages[1]["content"][0]["image"] = image
+            with timed(stats, "vision_info"):
+                image_inputs, video_inputs = process_vision_info(messages)
+            with timed(stats, "preprocess"):
+                inputs = self.processor(text=[text], images=image_inputs, videos=video_inputs,
+                                        padding=True, return_tensors="pt")
+            return inputs, False
+        
+        try:
+            image_token = getattr(self.processor, "image_token", "<|image_pad|>")
+            return self._generate_in_session(
+                session_id, media_id, {"type": "image", "image": image}, image_token, prompt, build_inputs,
+                max_new_tokens=IMAGE_MAX_NEW_TOKENS, clean_up_tokenization_spaces=False, on_text=on_text,
+            )
+        except Exception as e:
+            logger.error(f"图像处理错误: {e}")
+            return f"处理错误: {str(e)}", {"error": type(e).__name__}
+        finally:
+            if self.visual_encoder is not None:
+                self.visual_encoder.plan = None
+    
+    def _session_messages(self, media_content, history, prompt):
+        """构建会话消息 - 媒体放在首个用户轮的开头，使(系统提示词 + 媒体)成为各轮共享的前缀"""
+        first_prompt = history[0][0] if history else prompt
+        messages = [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": [dict(media_content), {"type": "text", "text": first_prompt}]},
+        ]
+        for i, (_, answer) in enumerate(history):
+            next_prompt = history[i + 1][0] if i + 1 < len(history) else prompt
+            messages.append({"role": "assistant", "content": [{"type": "text", "text": answer}]})
+            messages.append({"role": "user", "content": [{"type": "text", "text": next_prompt}]})
+        return messages
+    
+    def _rope_state(self):
+        """持有rope_deltas的模块（transformers 4.51在顶层模型，更新的版本在model.model）"""
+        inner = getattr(self.model, "model", None)
+        return inner if hasattr(inner, "rope_deltas") else self.model
+    
+    def _prefill_prefix(self, inputs, prefix_len):
+        """
+        单独prefill(系统提示词 + 媒体)前缀，返回其KV缓存和位置编码偏移
+        
+        Returns:
+            tuple: (DynamicCache, rope_deltas)
+        """
+        visual_inputs = {k: v for k, v in inputs.items() if k not in ("input_ids", "attention_mask")}
+        forward_kwargs = {}
+        if "logits_to_keep" in inspect.signature(self.model.forward).parameters:
+            forward_kwargs["logits_to_keep"] = 1
+        
+        past_key_values = DynamicCache()
+        with torch.no_grad():
+            self.model(
+                input_ids=inputs.input_ids[:, :prefix_len],
+                attention_mask=inputs.attention_mask[:, :prefix_len],
+                past_key_values=past_key_values,
+                use_cache=True,
+                # cache_position从0开始，模型据此重新计算多模态位置编码
+                cache_position=torch.arange(prefix_len, device=inputs.input_ids.device),
+                **visual_inputs,
+                **forward_kwargs,
+            )
+        return past_key_values, self._rope_state().rope_deltas
+    
+    def _generate_in_session(self, session_id, media_id, media_content, pad_token, prompt, build_inputs,
+                             max_new_tokens, clean_up_tokenization_spaces, on_text=None):
+        """
+        会话内生成 - 首轮prefill并保存(系统提示词 + 媒体)前缀的KV缓存，后续轮次只prefill新增文本
+        
+        Args:
+            session_id: 会话ID
+            media_id: 媒体标识，媒体变化时会话前缀失效
+            media_content: 消息中的媒体条目
+            pad_token: 视觉占位token
+            prompt: 本轮提示词
+            build_inputs: 首轮构建完整模型输入的函数 (messages, text, stats) -> (inputs, 是否命中视觉编码缓存)
+            
+        Returns:
+            tuple: (结果文本, 统计信息)
+        """
+        session = self.session_cache.get(session_id, media_id)
+        vision_cache_hit = None
+        prep_stats = {}
+        
+        if session is not None:
+            messages = self._session_messages(media_content, session.history, prompt)
+            with timed(prep_stats, "preprocess"):
+                text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+                text = self._expand_visual_tokens(text, pad_token, [session.grid_thw])
+                input_ids = self.processor.tokenizer([text], return_tensors="pt").input_ids
+            if not torch.equal(input_ids[0, :session.prefix_len], session.prefix_ids):
+                # 前缀token不一致（如对话模板变化），重建会话
+                self.session_cache.drop(session_id)
+                session = None
+        
+        if session is None:
+            messages = self._session_messages(media_content, [], prompt)
+            with timed(prep_stats, "preprocess"):
+                text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+            inputs, vision_cache_hit = build_inputs(messages, text, prep_stats)
+            with timed(prep_stats, "to_device"):
+                inputs = inputs.to(self.model.device)
+            
+            # 前缀截止到最后一个视觉结束token
+            vision_end_id = self.processor.tokenizer.convert_tokens_to_ids("<|vision_end|>")
+            prefix_len = int((inputs.input_ids[0] == vision_end_id).nonzero()[-1]) + 1
+            with timed(prep_stats, "prefix_prefill"):
+                past_key_values, rope_deltas = self._prefill_prefix(inputs, prefix_len)
+            grid_key = "image_grid_thw" if "image_grid_thw" in inputs else "video_grid_thw"
+            session = SessionPrefix(
+                media_id, inputs.input_ids[0, :prefix_len].cpu(), past_key_values, rope_deltas,
+                pad_token, inputs[grid_key][0].cpu(),
+            )
+            self.session_cache.put(session_id, session)
+            input_ids = inputs.input_ids.cpu()
+            prefix_hit = False
+        else:
+            prefix_hit = True
+        
+        # 只有前缀之后的新增文本需要prefill
+        gen_inputs = BatchFeature(data={
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+        }).to(self.model.device)
+        self._rope_state().rope_deltas = session.rope_deltas
+        try:
+            output_text, stats = self._generate(
+                gen_inputs, max_new_tokens=max_new_tokens,
+                clean_up_tokenization_spaces=clean_up_tokenization_spaces, on_text=on_text,
+                past_key_values=session.past_key_values,
+            )
+        finally:
+            # 丢弃本轮新增的KV，恢复为共享前缀
+            session.past_key_values.crop(session.prefix_len)
+        
+        result = output_text[0].strip()
+        if not stats.get("cancelled"):
+            # 被取消的轮次输出不完整，不计入对话历史
+            session.add_turn(prompt, result)
+        stats.update(
+            prep_stats,
+            prefix_cache_hit=prefix_hit,
+            prefix_tokens=session.prefix_len,
+            prefill_tokens=int(input_ids.shape[1]) - session.prefix_len,
+        )
+        if vision_cache_hit is not None:
+            stats["vision_cache_hit"] = vision_cache_hit
+        return result, stats
+    
+    def _generate(self, inputs, max_new_tokens: int, clean_up_tokenization_spaces: bool, on_text=None,
+                  **generate_kwargs):
+        """
+        执行generate并解码输出
+        
+        Args:
+            inputs: processor输出（已移动到模型设备）
+            max_new_tokens: 最大生成token数
+            clean_up_tokenization_spaces: 解码时是否清理空格
+            on_text: 流式文本回调，提供时通过streamer逐段输出（仅支持batch为1）
+            **generate_kwargs: 传给model.generate的其他参数（如past_key_values）
+            
+        Returns:
+            tuple: (输出文本列表, 生成统计)
+                统计包含prefill/decode耗时（按首个生成token的时间拆分）、输入/视觉/输出token数和生成速度；
+                请求在生成过程中被取消时cancelled为True，输出为已生成的部分
+        """
+        if on_text is not None:
+            streamer = CallbackStreamer(
+                self.processor.tokenizer,
+                on_text=on_text,
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=clean_up_tokenization_spaces,
+            )
+        else:
+            streamer = TokenTimer()
+        
+        cuda_devices = range(torch.cuda.device_count()) if torch.cuda.is_available() else ()
+        for device in cuda_devices:
+            torch.cuda.reset_peak_memory_stats(device)
+        
+        # 每个decode步检查作业的取消标志，取消后GPU立即转去执行下一个排队作业
+        cancel_event = current_cancel_event()
+        if cancel_event is not None:
+            generate_kwargs["stopping_criteria"] = StoppingCriteriaList([CancelStoppingCriteria(cancel_event)])
+        
+        generate_start = time.time()
+        with torch.no_grad():
+            output_ids = self.model.generate(
+                **inputs, max_new_tokens=max_new_tokens, streamer=streamer, **generate_kwargs
+            )
+            generate_end = time.time()
+            generated_ids = [out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, output_ids)]
+            output_text = self.processor.batch_decode(
+                generated_ids,
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=clean_up_tokenization_spaces
+            )
+        detokenize_end = time.time()
+        
+        # 批量生成时较短的输出以pad token补齐，不计入输出token数
+        pad_token_id = self.processor.tokenizer.pad_token_id
+        output_tokens = sum(int((ids != pad_token_id).sum()) for ids in generated_ids)
+        visual_token_ids = [self.model.config.image_token_id, self.model.config.video_token_id]
+        
+        generate_time = generate_end - generate_start
+        first_token_time = streamer.first_token_time or generate_end
+        prefill_time = first_token_time - generate_start
+        decode_time = generate_end - first_token_time
+        stats = {
+            "generate_ms": generate_time * 1000,
+            "prefill_ms": prefill_time * 1000,
+            "decode_ms": decode_time * 1000,
+            "detokenize_ms": (detokenize_end - generate_end) * 1000,
+            "input_tokens": int(inputs.attention_mask.sum()),
+            "visual_tokens": int(torch.isin(inputs.input_ids, inputs.input_ids.new_tensor(visual_token_ids)).sum()),
+            "output_tokens": output_tokens,
+            "tokens_per_s": output_tokens / generate_time if generate_time > 0 else 0.0,
+            # 首个token由prefill产生，decode阶段生成其余token
+            "decode_tokens_per_s": (output_tokens - len(generated_ids)) / decode_time if decode_time > 0 else 0.0,
+        }
+        if cuda_devices:
+            # generate期间（含视觉编码）各GPU显存峰值之和
+            stats["peak_memory_bytes"] = sum(torch.cuda.max_memory_allocated(device) for device in cuda_devices)
+        if on_text is not None:
+            stats["ttft_ms"] = streamer.ttft_ms
+        if cancel_event is not None and cancel_event.is_set():
+            stats["cancelled"] = True
+        return output_text, stats
@@ -0,0 +1,504 @@
+"""
+多副本推理 - 在N个工作进程中各加载一份模型，websocket前端把推理作业路由给空闲的副本
+- 所有副本共享一个作业队列，空闲副本立即取下一个作业（即分派给负载最低的副本）
+- 会话作业按会话ID固定到同一副本（前缀KV缓存在副本进程内）
+- 副本进程崩溃时，正在执行的作业返回错误，副本按指数退避自动重启
+
+用stub后端可在CPU上测试: python vlm_server.py --backend stub --replicas 4
+"""
+import base64
+import collections
+import hashlib
+import io
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import zlib
+
+from PIL import Image
+
+from backend.vlm_protocol import split_video_frames
+from server.backend import InferenceBackend
+from server.cancellation import bind_cancel_event, current_cancel_event
+from server.inference_executor import InferenceExecutor
+
+
+logger = logging.getLogger(__name__)
+
+# 副本执行作业时检查取消标志和进程存活的间隔（秒）
+POLL_INTERVAL_S = 0.05
+# 等待副本加载模型的最长时间（秒）
+READY_TIMEOUT_S = 900
+# 副本重启的等待时间（秒），连续失败时指数增长
+RESTART_DELAY_S = 1
+MAX_RESTART_DELAY_S = 60
+
+_local = threading.local()
+
+
+class ReplicaCrashedError(RuntimeError):
+    """副本进程在执行作业时退出"""
+
+
+class ReplicaError(RuntimeError):
+    """副本进程中的作业抛出异常"""
+
+
+def _prepare_image_item(backend, item):
+    """副本内准备图像（前端传来的是未解码的原始字节），视觉编码缓存键由副本计算"""
+    image_data, prompt = item[0], item[1]
+    if isinstance(image_data, (bytes, bytearray, str)):
+        image, vision_key, _, _ = backend.prepare_image(image_data)
+        return image, prompt, vision_key
+    return tuple(item)
+
+
+def _call_backend(backend, method, args, kwargs):
+    """在副本进程中调用后端方法"""
+    if method == "process_image_batch":
+        items = [_prepare_image_item(backend, item) for item in args[0]]
+        return backend.process_image_batch(items, **kwargs)
+    if method == "process_video_frames":
+        frames = [backend.decode_image(frame) if isinstance(frame, bytes) else frame for frame in args[0]]
+        return backend.process_video_frames(frames, *args[1:], **kwargs)
+    if method == "process_video_frames_batch":
+        items = [
+            ([backend.decode_image(frame) if isinstance(frame, bytes) else frame for frame in frames], *rest)
+            for frames, *rest in args[0]
+        ]
+        return backend.process_video_frames_batch(items, **kwargs)
+    if method == "process_image_session":
+        image, prompt, _, session_id, media_id = args
+        image, prompt, vision_key = _prepare_image_item(backend, (image, prompt))
+        return backend.process_image_session(image, prompt, vision_key, session_id, media_id, **kwargs)
+    return getattr(backend, method)(*args, **kwargs)
+
+
+def _replica_main(conn, index, backend_name, backend_options, env):
+    """
+    副本进程入口 - 加载后端后循环接收作业
+
+    主线程读取管道消息（作业、取消、停止），作业在单独线程中串行执行，执行期间仍可接收取消消息
+    """
+    # 在导入torch之前设置（如CUDA_VISIBLE_DEVICES）
+    os.environ.update(env)
+    logging.basicConfig(level=logging.INFO)
+    from server.backend import create_backend
+
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    try:
+        backend = create_backend(backend_name, **backend_options)
+        backend.load()
+    except Exception as e:
+        logger.error(f"副本 {index} 加载失败: {e}")
+        send(("failed", None, f"{type(e).__name__}: {e}"))
+        return
+
+    send(("ready", None, {
+        "pid": os.getpid(),
+        "device": backend.device,
+        "supports_sessions": backend.supports_sessions,
+        "generation_params": {t: backend.generation_params(t) for t in ("image", "video")},
+        "video_frame_budget": backend.video_frame_budget(),
+    }))
+
+    jobs = queue.Queue()
+    cancel_events = {}
+
+    def run_jobs():
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            job_id, method, args, kwargs, stream = job
+            if stream:
+                kwargs = dict(kwargs, on_text=lambda text: send(("delta", job_id, text)))
+            try:
+                with bind_cancel_event(cancel_events[job_id]):
+                    result = _call_backend(backend, method, args, kwargs)
+                send(("result", job_id, result))
+            except Exception as e:
+                logger.error(f"副本 {index} 作业执行错误: {e}")
+                send(("error", job_id, f"{type(e).__name__}: {e}"))
+            finally:
+                cancel_events.pop(job_id, None)
+
+    worker = threading.Thread(target=run_jobs, name=f"vlm-replica-{index}", daemon=True)
+    worker.start()
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        kind, job_id = message[0], message[1]
+        if kind == "call":
+            cancel_events[job_id] = threading.Event()
+            jobs.put(message[1:])
+        elif kind == "cancel":
+            event = cancel_events.get(job_id)
+            if event is not None:
+                event.set()
+        elif kind == "stop":
+            break
+    jobs.put(None)
+
+
+class Replica:
+    """副本进程句柄（只由该副本的调度线程访问管道）"""
+
+    def __init__(self, index, backend_name, backend_options, env=None):
+        self.index = index
+        self.backend_name = backend_name
+        self.backend_options = backend_options
+        self.env = env or {}
+        self.process = None
+        self.conn = None
+        self.info = {}
+        self.busy = False
+        self.jobs_done = 0
+        self.restarts = 0
+        self._ids = itertools.count(1)
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def spawn(self):
+        """启动副本进程（不等待加载完成）"""
+        # CUDA不能在fork出的子进程中重新初始化，使用spawn
+        context = multiprocessing.get_context("spawn")
+        parent_conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_replica_main,
+            args=(child_conn, self.index, self.backend_name, self.backend_options, self.env),
+            name=f"vlm-replica-{self.index}",
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+
+    def wait_ready(self, timeout=READY_TIMEOUT_S):
+        """等待副本加载完成"""
+        deadline = time.time() + timeout
+        while not self.conn.poll(POLL_INTERVAL_S):
+            if not self.alive:
+                raise ReplicaCrashedError(f"副本 {self.index} 在加载时退出 (exitcode={self.process.exitcode})")
+            if time.time() > deadline:
+                raise ReplicaCrashedError(f"副本 {self.index} 加载超时")
+        try:
+            kind, _, value = self.conn.recv()
+        except (EOFError, OSError):
+            raise ReplicaCrashedError(f"副本 {self.index} 在加载时退出")
+        if kind != "ready":
+            raise ReplicaCrashedError(f"副本 {self.index} 加载失败: {value}")
+        self.info = value
+        print(f"推理副本 {self.index} 已就绪: pid={value['pid']}, 设备={value['device']}")
+
+    def terminate(self):
+        if self.conn is not None:
+            try:
+                self.conn.send(("stop", None))
+            except (OSError, ValueError):
+                pass
+        if self.process is not None:
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join(5)
+        if self.conn is not None:
+            self.conn.close()
+
+    def call(self, method, args, kwargs, on_text=None, cancel_event=None):
+        """
+        在副本进程中执行后端方法并等待结果（在该副本的调度线程中调用）
+
+        执行期间转发文本增量；取消标志置位时通知副本，副本在下一个decode步停止
+        """
+        job_id = next(self._ids)
+        try:
+            self.conn.send(("call", job_id, method, args, kwargs, on_text is not None))
+        except (OSError, ValueError) as e:
+            raise ReplicaCrashedError(f"副本 {self.index} 不可用: {e}")
+
+        cancel_sent = False
+        while True:
+            try:
+                if cancel_event is not None and cancel_event.is_set() and not cancel_sent:
+                    self.conn.send(("cancel", job_id))
+                    cancel_sent = True
+                if not self.conn.poll(POLL_INTERVAL_S):
+                    if not self.alive:
+                        raise ReplicaCrashedError(
+                            f"副本 {self.index} 进程已退出 (exitcode={self.process.exitcode})"
+                        )
+                    continue
+                kind, message_job_id, value = self.conn.recv()
+            except (EOFError, OSError, ValueError):
+                raise ReplicaCrashedError(f"副本 {self.index} 进程已退出")
+            if message_job_id != job_id:
+                continue
+            if kind == "delta":
+                if on_text is not None:
+                    on_text(value)
+            elif kind == "result":
+                return value
+            elif kind == "error":
+                raise ReplicaError(value)
+
+    def get_stats(self):
+        return {
+            "index": self.index,
+            "pid": self.info.get("pid"),
+            "device": self.info.get("device"),
+            "alive": self.alive,
+            "busy": self.busy,
+            "jobs_done": self.jobs_done,
+            "restarts": self.restarts,
+        }
+
+
+def current_replica():
+    """当前调度线程绑定的副本"""
+    replica = getattr(_local, "replica", None)
+    if replica is None:
+        raise RuntimeError("不在副本调度线程中")
+    return replica
+
+
+class ReplicaPool(InferenceExecutor):
+    """
+    多副本推理执行器 - 接口与InferenceExecutor相同，每个副本一个调度线程
+
+    作业函数在副本的调度线程中执行，其中对ReplicaBackend的调用转发给该线程绑定的副本进程
+    """
+
+    def __init__(self, backend_name, backend_options=None, replicas=2, devices=None, name="vlm-replica-pool"):
+        """
+        Args:
+            backend_name: 副本中创建的推理后端名称
+            backend_options: 推理后端构造参数（需可pickle）
+            replicas: 副本数
+            devices: 按副本轮流分配的CUDA设备列表（设置CUDA_VISIBLE_DEVICES），None表示不限制
+        """
+        super().__init__(name)
+        self.replicas = [
+            Replica(
+                i, backend_name, dict(backend_options or {}),
+                {"CUDA_VISIBLE_DEVICES": str(devices[i % len(devices)])} if devices else None,
+            )
+            for i in range(replicas)
+        ]
+        self._shared = collections.deque()
+        self._pinned = [collections.deque() for _ in self.replicas]
+        self._cond = threading.Condition()
+        self._threads = []
+        self._spawned = False
+
+    @property
+    def concurrency(self):
+        return len(self.replicas)
+
+    @property
+    def queue_depth(self):
+        with self._cond:
+            return len(self._shared) + sum(len(q) for q in self._pinned)
+
+    @property
+    def is_busy(self):
+        return any(replica.busy for replica in self.replicas)
+
+    @property
+    def info(self):
+        """首个就绪副本报告的后端信息"""
+        for replica in self.replicas:
+            if replica.info:
+                return replica.info
+        return {}
+
+    def load(self):
+        """启动所有副本进程并等待模型加载完成（并行加载）"""
+        if self._spawned:
+            return
+        self._spawned = True
+        for replica in self.replicas:
+            replica.spawn()
+        for replica in self.replicas:
+            replica.wait_ready()
+
+    def start(self):
+        """启动各副本的调度线程"""
+        if self._running:
+            return
+        self.load()
+        self._running = True
+        for replica in self.replicas:
+            thread = threading.Thread(
+                target=self._replica_loop, args=(replica,), name=f"{self.name}-{replica.index}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        print(f"推理副本池已启动: {len(self.replicas)} 个副本")
+
+    def stop(self, timeout=None):
+        """停止调度线程和副本进程"""
+        if not self._running:
+            return
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        for replica in self.replicas:
+            replica.terminate()
+
+    def _enqueue(self, job):
+        with self._cond:
+            if job.affinity is not None:
+                # 同一亲和键固定到同一副本（副本内保存会话前缀缓存）
+                index = zlib.crc32(str(job.affinity).encode("utf-8")) % len(self.replicas)
+                self._pinned[index].append(job)
+            else:
+                self._shared.append(job)
+            self._cond.notify_all()
+
+    def _requeue(self, index, job):
+        with self._cond:
+            (self._pinned[index] if job.affinity is not None else self._shared).appendleft(job)
+            self._cond.notify_all()
+
+    def _next_job(self, index, timeout):
+        """取该副本的下一个作业: 固定到该副本的作业和共享队列中先入队的一个"""
+        with self._cond:
+            if not self._pinned[index] and not self._shared:
+                self._cond.wait(timeout)
+            pinned, shared = self._pinned[index], self._shared
+            if pinned and (not shared or pinned[0].enqueue_time <= shared[0].enqueue_time):
+                return pinned.popleft()
+            if shared:
+                return shared.popleft()
+            return None
+
+    def _replica_loop(self, replica):
+        """副本调度线程 - 副本空闲时取作业执行，进程退出后自动重启"""
+        _local.replica = replica
+        delay = RESTART_DELAY_S
+        while self._running:
+            if not replica.alive:
+                logger.warning(f"推理副本 {replica.index} 已退出，{delay:.0f}秒后重启")
+                time.sleep(delay)
+                try:
+                    replica.terminate()
+                    replica.spawn()
+                    replica.wait_ready()
+                except ReplicaCrashedError as e:
+                    logger.error(f"推理副本 {replica.index} 重启失败: {e}")
+                    delay = min(delay * 2, MAX_RESTART_DELAY_S)
+                    continue
+                replica.restarts += 1
+                delay = RESTART_DELAY_S
+
+            job = self._next_job(replica.index, timeout=1.0)
+            if job is None:
+                continue
+            if not replica.alive:
+                # 作业尚未发给副本，放回队首等副本重启后执行
+                self._requeue(replica.index, job)
+                continue
+            replica.busy = True
+            try:
+                self._run_job(job)
+            finally:
+                replica.busy = False
+                replica.jobs_done += 1
+
+    def get_replica_stats(self):
+        return [replica.get_stats() for replica in self.replicas]
+
+
+class ReplicaBackend(InferenceBackend):
+    """
+    多副本推理后端 - 前端进程中的后端代理，推理调用转发给当前调度线程绑定的副本
+
+    图像以未解码的原始字节发送，由副本解码并使用副本内的视觉编码缓存
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.name = pool.replicas[0].backend_name
+
+    def load(self):
+        self.pool.load()
+
+    @property
+    def device(self):
+        return f"{len(self.pool.replicas)}个副本: " + ", ".join(
+            str(replica.info.get("device", "未就绪")) for replica in self.pool.replicas
+        )
+
+    @property
+    def supports_sessions(self):
+        return bool(self.pool.info.get("supports_sessions"))
+
+    def get_stats(self):
+        return {"replicas": self.pool.get_replica_stats()}
+
+    def generation_params(self, request_type):
+        return dict(self.pool.info.get("generation_params", {}).get(request_type, {"backend": self.name}))
+
+    def video_frame_budget(self):
+        return self.pool.info.get("video_frame_budget")
+
+    def prepare_video_frames(self, payload, frames_info):
+        """只切分帧序列，解码在副本中进行"""
+        return [bytes(frame) for frame in split_video_frames(payload, frames_info)]
+
+    def prepare_image(self, image_data):
+        """只读取图像头获取尺寸（用于组批像素预算），解码在副本中进行"""
+        image_bytes = base64.b64decode(image_data) if isinstance(image_data, str) else image_data
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            width, height = image.size
+        return image_bytes, None, width * height, hashlib.sha256(image_bytes).hexdigest()
+
+    @staticmethod
+    def _call(method, *args, on_text=None, **kwargs):
+        return current_replica().call(method, args, kwargs, on_text=on_text, cancel_event=current_cancel_event())
+
+    def process_image(self, image_data, prompt, on_text=None):
+        return self._call("process_image", image_data, prompt, on_text=on_text)
+
+    def process_image_batch(self, items, on_text=None) -> list:
+        return self._call("process_image_batch", [tuple(item) for item in items], on_text=on_text)
+
+    def process_image_session(self, image, prompt, vision_key=None, session_id=None, media_id=None, on_text=None):
+        return self._call("process_image_session", image, prompt, vision_key, session_id, media_id, on_text=on_text)
+
+    def process_video(self, video_path, prompt, on_text=None, media_sha256=None, session_id=None):
+        return self._call(
+            "process_video", video_path, prompt, on_text=on_text, media_sha256=media_sha256, session_id=session_id
+        )
+
+    def process_video_frames(self, frames, prompt, fps, on_text=None, media_sha256=None, session_id=None):
+        return self._call(
+            "process_video_frames", frames, prompt, fps, on_text=on_text, media_sha256=media_sha256,
+            session_id=session_id,
+        )
+
+    def process_video_frames_batch(self, items, on_text=None) -> list:
+        return self._call("process_video_frames_batch", [tuple(item) for item in items], on_text=on_text)
+
+    def process_text(self, prompt, on_text=None):
+        return self._call("process_text", prompt, on_text=on_text)
+
+    def process_video_from_data(self, video_data, video_filename, prompt, on_text=None):
+        return self._call("process_video_from_data", video_data, video_filename, prompt, on_text=on_text)
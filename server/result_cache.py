@@ -0,0 +1,135 @@
+"""
+结果缓存 - 以(媒体哈希, 规范化提示词, 生成参数)为键缓存推理结果，按TTL过期、按条目数LRU淘汰
+同一键的请求仍在执行时，后到的请求共享这次生成而不是再跑一遍（single-flight）
+"""
+import asyncio
+import logging
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_prompt(prompt):
+    """规范化提示词: Unicode NFKC（全角转半角等）并合并空白"""
+    return " ".join(unicodedata.normalize("NFKC", prompt or "").split())
+
+
+class _Flight:
+    """执行中的生成 - 由等待者共享，全部等待者取消后才取消生成"""
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class ResultCache:
+    """推理结果缓存（仅在事件循环线程中访问）"""
+
+    def __init__(self, max_entries=1024, ttl_s=600):
+        """
+        Args:
+            max_entries: 最多缓存的结果数
+            ttl_s: 结果过期时间（秒）
+        """
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._entries = OrderedDict()  # 键 -> (写入时间, 结果文本, 统计信息)，按最近使用排序
+        self._flights = {}
+        self.hits = 0
+        self.shared = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(request_type, media_sha256, prompt, **generation_params):
+        """由请求类型、媒体哈希、规范化提示词和生成参数构造缓存键"""
+        return (request_type, media_sha256, normalize_prompt(prompt)) + tuple(sorted(generation_params.items()))
+
+    def get(self, key):
+        """获取未过期的结果，未命中返回None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, result, stats = entry
+        if time.time() - stored_at > self.ttl_s:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return result, stats
+
+    def put(self, key, result, stats):
+        """写入结果（出错或被取消的结果不缓存）"""
+        if "error" in stats or stats.get("cancelled"):
+            return
+        self._entries[key] = (time.time(), result, stats)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def run(self, key, compute, share=True):
+        """
+        查询缓存，未命中时执行compute并缓存结果
+
+        Args:
+            key: 缓存键
+            compute: 无参函数，返回协程或任务，结果为 (结果文本, 统计信息)；共享时该任务在全部等待者离开后才取消，
+                因此任务须自行持有其输入，不依赖发起者的生命周期
+            share: 是否与同一键的进行中生成共享（流式请求的增量只发给发起者，不共享）
+
+        Returns:
+            tuple: ((结果文本, 统计信息), 来源) ，来源为 "hit"、"shared" 或 "miss"
+        """
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached, "hit"
+
+        if not share:
+            self.misses += 1
+            result, stats = await compute()
+            self.put(key, result, stats)
+            return (result, stats), "miss"
+
+        flight = self._flights.get(key)
+        if flight is None:
+            self.misses += 1
+            source = "miss"
+            flight = _Flight(asyncio.ensure_future(compute()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda task: self._finish(key, flight))
+        else:
+            self.shared += 1
+            source = "shared"
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task), source
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # 所有等待者都已取消（客户端取消或断开），停止生成
+                flight.task.cancel()
+
+    def _finish(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if flight.task.cancelled() or flight.task.exception() is not None:
+            return
+        result, stats = flight.task.result()
+        self.put(key, result, stats)
+
+    def get_stats(self):
+        """缓存统计: 条目数、命中、共享和未命中次数"""
+        lookups = self.hits + self.shared + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_s": self.ttl_s,
+            "in_flight": len(self._flights),
+            "hits": self.hits,
+            "shared": self.shared,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.shared) / lookups if lookups else 0.0,
+        }
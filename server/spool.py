@@ -0,0 +1,226 @@
+"""
+上传暂存 - 客户端分块上传的媒体文件边收边写入暂存文件
+
+内存预算允许时写入匿名内存文件（memfd），视频解码器通过/proc路径直接读取，不经过磁盘；
+超出预算时写入磁盘暂存目录。暂存文件名包含进程号，启动时清理已退出进程遗留的文件
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+SPOOL_PREFIX = "vlm_upload_"
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def sweep_spool_dir(spool_dir):
+    """
+    清理暂存目录中已退出进程遗留的暂存文件（服务器启动时调用）
+
+    Returns:
+        int: 删除的文件数
+    """
+    removed = 0
+    try:
+        names = os.listdir(spool_dir)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        if not name.startswith(SPOOL_PREFIX):
+            continue
+        owner = name[len(SPOOL_PREFIX):].split("_", 1)[0]
+        if owner.isdigit() and (int(owner) == os.getpid() or _pid_alive(int(owner))):
+            continue
+        try:
+            os.unlink(os.path.join(spool_dir, name))
+            removed += 1
+        except OSError as e:
+            logger.warning(f"删除遗留暂存文件失败: {name}: {e}")
+    return removed
+
+
+class MemoryBudget:
+    """内存暂存预算 - 统计内存暂存文件占用的字节数（线程安全）"""
+
+    def __init__(self, max_bytes):
+        """
+        Args:
+            max_bytes: 内存暂存总字节数上限，0表示不使用内存暂存
+        """
+        self.max_bytes = max_bytes if hasattr(os, "memfd_create") else 0
+        self.used_bytes = 0
+        self.peak_bytes = 0
+        self.fallbacks = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, nbytes):
+        """预留内存，预算不足时返回False（调用方改用磁盘暂存）"""
+        with self._lock:
+            if self.used_bytes + nbytes > self.max_bytes:
+                if self.max_bytes:
+                    self.fallbacks += 1
+                return False
+            self.used_bytes += nbytes
+            self.peak_bytes = max(self.peak_bytes, self.used_bytes)
+            return True
+
+    def release(self, nbytes):
+        with self._lock:
+            self.used_bytes -= nbytes
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "max_bytes": self.max_bytes,
+                "used_bytes": self.used_bytes,
+                "peak_bytes": self.peak_bytes,
+                "disk_fallbacks": self.fallbacks,
+            }
+
+
+class UploadTooLargeError(ValueError):
+    """上传数据超出服务器大小上限"""
+
+
+class UploadSpool:
+    """上传暂存文件 - 按块追加写入，超过大小上限时立即中止"""
+
+    in_memory = False
+
+    def __init__(self, spool_dir, max_bytes=0, suffix=""):
+        """
+        Args:
+            spool_dir: 暂存目录
+            max_bytes: 最大字节数，0表示不限制
+            suffix: 暂存文件后缀（保留原始扩展名，便于视频解码器识别格式）
+        """
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self._file = os.fdopen(self._open(spool_dir), 'wb')
+        self._hash = hashlib.sha256()
+        self.bytes_written = 0
+        self.start_time = time.time()
+        self.end_time = None
+
+    def _open(self, spool_dir):
+        """创建暂存文件，返回写入用的文件描述符并设置self.path"""
+        os.makedirs(spool_dir, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(prefix=f"{SPOOL_PREFIX}{os.getpid()}_", suffix=self.suffix, dir=spool_dir)
+        return fd
+
+    def write(self, chunk):
+        """追加一块数据"""
+        if self.max_bytes and self.bytes_written + len(chunk) > self.max_bytes:
+            raise UploadTooLargeError(f"上传数据超过上限 {self.max_bytes / 1024 ** 2:.0f} MB")
+        self._file.write(chunk)
+        self._hash.update(chunk)
+        self.bytes_written += len(chunk)
+
+    @property
+    def sha256(self):
+        """已写入内容的SHA-256（边写边计算）"""
+        return self._hash.hexdigest()
+
+    def finish(self):
+        """完成写入并关闭文件"""
+        if not self._file.closed:
+            self._file.close()
+        self.end_time = time.time()
+
+    def cleanup(self):
+        """关闭并删除暂存文件"""
+        if not self._file.closed:
+            self._file.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def get_stats(self):
+        """上传统计: 字节数、耗时、吞吐量"""
+        end_time = self.end_time or time.time()
+        upload_time = end_time - self.start_time
+        return {
+            "upload_bytes": self.bytes_written,
+            "upload_ms": upload_time * 1000,
+            "upload_mbps": self.bytes_written * 8 / 1e6 / upload_time if upload_time > 0 else 0.0,
+            "upload_in_memory": self.in_memory,
+        }
+
+
+class MemorySpool(UploadSpool):
+    """
+    内存暂存文件 - 写入memfd匿名内存文件，path为/proc下的文件描述符路径
+
+    同一用户的其他进程（推理副本）也可以通过该路径读取；删除时释放内存并归还预算
+    """
+
+    in_memory = True
+
+    def __init__(self, budget, reserved_bytes, max_bytes=0, suffix=""):
+        """
+        Args:
+            budget: MemoryBudget，调用方已预留reserved_bytes
+            reserved_bytes: 已预留的字节数（写入超出预留时中止）
+            max_bytes: 最大字节数，0表示不限制
+            suffix: 原始扩展名（内存文件路径没有扩展名，移入媒体存储时使用）
+        """
+        self.budget = budget
+        self.reserved_bytes = reserved_bytes
+        self._fd = None
+        try:
+            super().__init__(None, min(max_bytes, reserved_bytes) if max_bytes else reserved_bytes, suffix)
+        except BaseException:
+            self._release()
+            raise
+
+    def _open(self, spool_dir):
+        # 保留一个描述符维持文件存在，写入用的描述符在finish时关闭
+        self._fd = os.memfd_create(f"{SPOOL_PREFIX}{os.getpid()}", os.MFD_CLOEXEC)
+        self.path = f"/proc/{os.getpid()}/fd/{self._fd}"
+        return os.dup(self._fd)
+
+    def cleanup(self):
+        """关闭内存文件并归还预算"""
+        if not self._file.closed:
+            self._file.close()
+        self._release()
+
+    def _release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if self.budget is not None:
+            self.budget.release(self.reserved_bytes)
+            self.budget = None
+
+
+def open_spool(spool_dir, length, max_bytes=0, suffix="", budget=None):
+    """
+    按内存预算选择暂存方式
+
+    Args:
+        spool_dir: 磁盘暂存目录
+        length: 上传数据的字节数
+        budget: MemoryBudget，None或预算不足时写入磁盘
+
+    Returns:
+        UploadSpool或MemorySpool
+    """
+    if budget is not None and budget.reserve(length):
+        return MemorySpool(budget, length, max_bytes, suffix)
+    return UploadSpool(spool_dir, max_bytes, suffix)
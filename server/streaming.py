@@ -0,0 +1,71 @@
+"""
+流式输出 - 将generate过程中解码出的文本增量回调给调用方，并记录首token时间（用于拆分prefill和decode）
+以及在每个decode步检查请求是否已取消的停止条件
+"""
+import time
+
+import torch
+from transformers import StoppingCriteria, TextStreamer
+from transformers.generation.streamers import BaseStreamer
+
+
+class CallbackStreamer(TextStreamer):
+    """回调式文本流 - 每产生一段完整文本即调用on_text（在GPU工作线程中调用）"""
+
+    def __init__(self, tokenizer, on_text=None, **decode_kwargs):
+        super().__init__(tokenizer, skip_prompt=True, **decode_kwargs)
+        self.on_text = on_text
+        self.start_time = time.time()
+        self.first_token_time = None
+        self.num_tokens = 0
+
+    def put(self, value):
+        """接收新生成的token"""
+        if not (self.skip_prompt and self.next_tokens_are_prompt):
+            if self.first_token_time is None:
+                self.first_token_time = time.time()
+            self.num_tokens += value.numel()
+        super().put(value)
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        """输出文本增量"""
+        if text and self.on_text is not None:
+            self.on_text(text)
+
+    @property
+    def ttft_ms(self):
+        """首token延迟（毫秒），尚未生成时为None"""
+        if self.first_token_time is None:
+            return None
+        return (self.first_token_time - self.start_time) * 1000
+
+
+class TokenTimer(BaseStreamer):
+    """生成计时 - 不解码文本，只记录首个生成token的时间，用于拆分prefill和decode耗时（支持批量）"""
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.first_token_time = None
+        self._prompt_seen = False
+
+    def put(self, value):
+        """generate首次传入的是提示词，之后每次是新生成的token"""
+        if not self._prompt_seen:
+            self._prompt_seen = True
+        elif self.first_token_time is None:
+            self.first_token_time = time.time()
+
+    def end(self):
+        pass
+
+
+class CancelStoppingCriteria(StoppingCriteria):
+    """取消停止条件 - 每生成一步检查取消标志，已取消时结束整个批次的生成"""
+
+    def __init__(self, cancel_event):
+        self.cancel_event = cancel_event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full(
+            (input_ids.shape[0],), self.cancel_event.is_set(), dtype=torch.bool, device=input_ids.device
+        )
@@ -0,0 +1,171 @@
+"""
+模拟推理后端 - 不加载模型权重，按配置的prefill/decode速度休眠并生成确定性文本
+用于在没有GPU的机器（CI、笔记本）上测试和压测服务器的网络、排队和组批
+"""
+import hashlib
+import os
+import random
+import time
+
+from server.backend import InferenceBackend
+from server.cancellation import is_cancelled
+
+
+# 视觉token按Qwen2.5-VL的规则估算: 每28x28像素一个token，视频每2帧合并为一组
+PIXELS_PER_VISUAL_TOKEN = 28 * 28
+FRAMES_PER_VISUAL_TOKEN = 2
+
+# 声明给客户端的视频像素预算（与Qwen后端相同）
+VIDEO_TOTAL_PIXELS = 20480 * 28 * 28
+VIDEO_MIN_PIXELS = 16 * 28 * 28
+
+_WORDS = (
+    "画面", "中", "有", "一个", "人", "正在", "桌子", "旁边", "看", "屏幕", "背景", "是",
+    "房间", "光线", "明亮", "左侧", "右侧", "物体", "颜色", "场景", "，", "。",
+)
+
+
+class StubBackend(InferenceBackend):
+    """
+    确定性模拟后端
+
+    - prefill耗时 = prefill_ms + 批内输入token总数 / prefill_tokens_per_s
+    - decode每步耗时 = 1 / decode_tokens_per_s，批内各请求同步生成（与真实批量生成一致）
+    - 相同的(媒体, 提示词)总是得到相同的输出
+    - 与真实后端一样在每个decode步检查取消标志（prefill不可中断）
+    """
+
+    name = "stub"
+
+    def __init__(self, prefill_ms: float = 50, prefill_tokens_per_s: float = 5000,
+                 decode_tokens_per_s: float = 30, output_tokens: int = 64,
+                 prompt_tokens: int = 32, video_tokens: int = 2048):
+        """
+        Args:
+            prefill_ms: 每次prefill的固定耗时（毫秒）
+            prefill_tokens_per_s: prefill速度（输入token/秒）
+            decode_tokens_per_s: 每个请求的decode速度（token/秒）
+            output_tokens: 每个请求生成的token数
+            prompt_tokens: 系统提示词和模板的token数（另加提示词字符数）
+            video_tokens: 每个视频的视觉token数
+        """
+        self.prefill_ms = prefill_ms
+        self.prefill_tokens_per_s = prefill_tokens_per_s
+        self.decode_tokens_per_s = decode_tokens_per_s
+        self.output_tokens = max(1, output_tokens)
+        self.prompt_tokens = prompt_tokens
+        self.video_tokens = video_tokens
+
+    @property
+    def device(self):
+        return "stub"
+
+    def generation_params(self, request_type):
+        return {"backend": self.name, "output_tokens": self.output_tokens}
+
+    def load(self):
+        print(f"使用模拟推理后端: prefill={self.prefill_ms}ms + {self.prefill_tokens_per_s} token/s, "
+              f"decode={self.decode_tokens_per_s} token/s, 输出={self.output_tokens} token")
+
+    def prepare_image(self, image_data):
+        """解码图像，并以图像SHA-256代替视觉缓存键传给process_image_batch作为媒体标识"""
+        image, _, pixels, image_sha256 = super().prepare_image(image_data)
+        return image, image_sha256, pixels, image_sha256
+
+    def process_image_batch(self, items, on_text=None) -> list:
+        requests = []
+        for item in items:
+            image, prompt = item[0], item[1]
+            media_id = item[2] if len(item) > 2 and item[2] else f"{image.width}x{image.height}"
+            requests.append((media_id, prompt, image.width * image.height // PIXELS_PER_VISUAL_TOKEN))
+        return self._generate(requests, on_text)
+
+    def process_video(self, video_path: str, prompt: str, on_text=None, media_sha256: str = None,
+                      session_id: str = None):
+        try:
+            media_id = media_sha256 or f"{os.path.basename(video_path)}:{os.path.getsize(video_path)}"
+        except OSError as e:
+            return f"处理错误: {str(e)}", {"error": type(e).__name__}
+        return self._generate([(media_id, prompt, self.video_tokens)], on_text)[0]
+
+    def video_frame_budget(self):
+        return {"total_pixels": VIDEO_TOTAL_PIXELS, "min_pixels": VIDEO_MIN_PIXELS}
+
+    def process_video_frames(self, frames, prompt: str, fps: float, on_text=None, media_sha256: str = None,
+                             session_id: str = None):
+        width, height = frames[0].size
+        visual_tokens = -(-len(frames) // FRAMES_PER_VISUAL_TOKEN) * (width * height // PIXELS_PER_VISUAL_TOKEN)
+        media_id = media_sha256 or f"{len(frames)}x{width}x{height}"
+        return self._generate([(media_id, prompt, visual_tokens)], on_text)[0]
+
+    def process_video_frames_batch(self, items, on_text=None) -> list:
+        requests = []
+        for frames, prompt, _, media_sha256 in items:
+            width, height = frames[0].size
+            visual_tokens = -(-len(frames) // FRAMES_PER_VISUAL_TOKEN) * (width * height // PIXELS_PER_VISUAL_TOKEN)
+            requests.append((media_sha256 or f"{len(frames)}x{width}x{height}", prompt, visual_tokens))
+        return self._generate(requests, on_text)
+
+    def process_text(self, prompt: str, on_text=None):
+        return self._generate([("text", prompt, 0)], on_text)[0]
+
+    def _generate(self, requests, on_text=None):
+        """
+        模拟一次批量generate
+
+        Args:
+            requests: [(媒体标识, 提示词, 视觉token数), ...]
+            on_text: 流式文本回调（仅支持单条请求）
+
+        Returns:
+            list: [(结果文本, 统计信息), ...]
+        """
+        input_tokens = [self.prompt_tokens + len(prompt) + visual for _, prompt, visual in requests]
+        outputs = [
+            self._output_words(media_id, prompt)
+            for media_id, prompt, _ in requests
+        ]
+
+        generate_start = time.time()
+        time.sleep(self.prefill_ms / 1000 + sum(input_tokens) / self.prefill_tokens_per_s)
+        first_token_time = time.time()
+        if on_text is not None:
+            on_text(outputs[0][0])
+        output_tokens = 1
+        cancelled = False
+        for step in range(1, self.output_tokens):
+            if is_cancelled():
+                cancelled = True
+                break
+            time.sleep(1 / self.decode_tokens_per_s)
+            output_tokens += 1
+            if on_text is not None:
+                on_text(outputs[0][step])
+        generate_end = time.time()
+
+        generate_time = generate_end - generate_start
+        decode_time = generate_end - first_token_time
+        results = []
+        for words, tokens, (_, _, visual) in zip(outputs, input_tokens, requests):
+            stats = {
+                "generate_ms": generate_time * 1000,
+                "prefill_ms": (first_token_time - generate_start) * 1000,
+                "decode_ms": decode_time * 1000,
+                "input_tokens": tokens,
+                "visual_tokens": visual,
+                "output_tokens": output_tokens,
+                "tokens_per_s": output_tokens / generate_time if generate_time > 0 else 0.0,
+                "decode_tokens_per_s": (output_tokens - 1) / decode_time if decode_time > 0 else 0.0,
+            }
+            if on_text is not None:
+                stats["ttft_ms"] = stats["prefill_ms"]
+            if cancelled:
+                stats["cancelled"] = True
+            results.append(("".join(words[:output_tokens]), stats))
+        return results
+
+    def _output_words(self, media_id, prompt):
+        """由(媒体, 提示词)确定的输出token序列"""
+        seed = hashlib.sha256(f"{media_id}\n{prompt}".encode("utf-8")).digest()
+        rng = random.Random(seed)
+        return [rng.choice(_WORDS) for _ in range(self.output_tokens)]
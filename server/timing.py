@@ -0,0 +1,35 @@
+"""
+分阶段计时 - 把请求各阶段（解码、预处理、prefill、decode等）的耗时累加到统计字典
+响应中按阶段拆分返回，便于定位时间花在哪里
+"""
+import time
+from contextlib import contextmanager
+
+
+@contextmanager
+def timed(stats, stage):
+    """
+    统计代码块耗时，累加到stats[f"{stage}_ms"]
+
+    Args:
+        stats: 统计字典
+        stage: 阶段名
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        key = f"{stage}_ms"
+        stats[key] = stats.get(key, 0.0) + (time.perf_counter() - start) * 1000
+
+
+def split_timing(stats):
+    """
+    将统计信息拆分为分阶段耗时和其余统计
+
+    Returns:
+        tuple: ({阶段名: 毫秒}, 其余统计)
+    """
+    timing = {k[:-3]: v for k, v in stats.items() if k.endswith("_ms") and v is not None}
+    others = {k: v for k, v in stats.items() if not k.endswith("_ms")}
+    return timing, others
@@ -0,0 +1,152 @@
+"""
+视觉编码缓存 - 缓存视觉编码器(model.visual)对同一媒体的输出
+同一图像/视频换提示词再次提问时，跳过帧解码、缩放和视觉编码，直接复用视觉token嵌入
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+
+class VisionCacheEntry:
+    """视觉编码缓存条目"""
+
+    def __init__(self, embeds, grid_thw, second_per_grid_ts=None):
+        self.embeds = embeds                        # 视觉token嵌入 [num_tokens, hidden]
+        self.grid_thw = grid_thw                    # 视觉网格 [3]，用于展开占位token和计算位置编码
+        self.second_per_grid_ts = second_per_grid_ts  # 视频每个时间网格对应的秒数（图像为None）
+        self.nbytes = embeds.numel() * embeds.element_size()
+
+
+class VisionEncoderCache:
+    """视觉编码缓存 - 按内存预算LRU淘汰（线程安全）"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes_held = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(media_sha256, kind, **resize_params):
+        """由媒体哈希、媒体类型和缩放参数构造缓存键"""
+        return (media_sha256, kind) + tuple(sorted(resize_params.items()))
+
+    def contains(self, key):
+        """是否已缓存（不计入命中统计）"""
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key):
+        """获取缓存条目，未命中返回None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, embeds, grid_thw, second_per_grid_ts=None):
+        """写入缓存条目，超过预算时淘汰最久未使用的条目"""
+        entry = VisionCacheEntry(embeds.detach(), grid_thw.detach().cpu(), second_per_grid_ts)
+        if entry.nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes_held -= old.nbytes
+            self._entries[key] = entry
+            self.bytes_held += entry.nbytes
+
+            while self.bytes_held > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes_held -= evicted.nbytes
+
+    def get_stats(self):
+        """缓存统计: 命中率和占用内存"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes_held": self.bytes_held,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class CachingVisionEncoder(torch.nn.Module):
+    """
+    视觉编码器缓存包装 - 替换model.visual
+
+    调用generate前由服务器设置plan: 与grid_thw逐行对应的 [(缓存键, 命中条目或None, 附加信息), ...]
+    - 命中的媒体直接使用缓存嵌入，pixel_values中不包含其像素
+    - 未命中的媒体正常编码，并按缓存键写入缓存
+    未设置plan时行为与原视觉编码器完全一致
+    """
+
+    def __init__(self, visual, cache, spatial_merge_size):
+        super().__init__()
+        self.visual = visual
+        self.cache = cache
+        self.merge_length = spatial_merge_size ** 2
+        self.plan = None
+
+    @property
+    def dtype(self):
+        return self.visual.dtype
+
+    @property
+    def device(self):
+        return self.visual.device
+
+    def forward(self, hidden_states, grid_thw=None, **kwargs):
+        plan = self.plan
+        if not plan or grid_thw is None or len(plan) != len(grid_thw):
+            return self.visual(hidden_states, grid_thw=grid_thw, **kwargs)
+
+        # 只编码未命中的媒体
+        miss_rows = [i for i, (_, entry, _) in enumerate(plan) if entry is None]
+        miss_chunks = iter(())
+        if miss_rows:
+            miss_grid = grid_thw[miss_rows]
+            miss_embeds = self.visual(hidden_states, grid_thw=miss_grid, **kwargs)
+            sizes = (miss_grid.prod(-1) // self.merge_length).tolist()
+            miss_chunks = iter(miss_embeds.split(sizes))
+
+        outputs = []
+        for i, (key, entry, extra) in enumerate(plan):
+            if entry is not None:
+                outputs.append(entry.embeds)
+                continue
+            embeds = next(miss_chunks)
+            if key is not None:
+                self.cache.put(key, embeds, grid_thw[i], **(extra or {}))
+            outputs.append(embeds)
+
+        device = outputs[-1].device
+        return torch.cat([embeds.to(device) for embeds in outputs], dim=0)
+
+
+def install_vision_cache(model, cache):
+    """
+    用CachingVisionEncoder替换模型的视觉编码器
+
+    Returns:
+        CachingVisionEncoder: 安装后的包装模块
+    """
+    # transformers 4.51中visual位于顶层模型，更新的版本移到了model.model下
+    parent = model if hasattr(model, "visual") else model.model
+    wrapper = CachingVisionEncoder(parent.visual, cache, model.config.vision_config.spatial_merge_size)
+    parent.visual = wrapper
+    return wrapper
@@ -0,0 +1,60 @@
+"""
+准入控制测试 - 在途上限、每客户端上限、截止时间和凭证引用计数
+
+运行（在项目根目录）:
+    python -m pytest -q tests
+"""
+import pytest
+
+from backend.vlm_protocol import ERROR_CLIENT_LIMIT, ERROR_DEADLINE_EXCEEDED, ERROR_OVERLOADED
+from server.admission import AdmissionController, AdmissionRejected
+
+
+def test_queue_limit_rejects_until_release():
+    admission = AdmissionController(max_queue=2, max_per_client=0)
+    tickets = [admission.admit(f"client{i}", "image") for i in range(2)]
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.admit("client3", "image")
+    assert rejected.value.error_code == ERROR_OVERLOADED
+    admission.release(tickets[0])
+    admission.admit("client3", "image")
+    assert admission.stats["rejected"] == 1 and admission.in_flight == 2
+
+
+def test_per_client_limit():
+    admission = AdmissionController(max_queue=0, max_per_client=1)
+    admission.admit("a", "video")
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.admit("a", "video")
+    assert rejected.value.error_code == ERROR_CLIENT_LIMIT
+    admission.admit("b", "video")
+
+
+def test_deadline_rejects_when_estimated_wait_is_too_long():
+    admission = AdmissionController(max_queue=0, max_per_client=0, default_service_ms={"video": 1000.0})
+    admission.admit("a", "video")
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.admit("b", "video", deadline_ms=500)
+    assert rejected.value.error_code == ERROR_DEADLINE_EXCEEDED
+    assert rejected.value.retry_after_ms == pytest.approx(500)
+    assert admission.admit("b", "video", deadline_ms=2000).deadline is not None
+
+
+def test_retained_ticket_keeps_slot_until_every_holder_releases():
+    admission = AdmissionController(max_queue=1, max_per_client=0)
+    ticket = admission.admit("a", "image")
+    admission.retain(ticket)
+    admission.release(ticket)
+    # 发起者已交还，共享生成仍持有名额
+    assert admission.in_flight == 1
+    with pytest.raises(AdmissionRejected):
+        admission.admit("b", "image")
+    admission.release(ticket)
+    assert admission.in_flight == 0
+    admission.admit("b", "image")
+
+
+def test_service_time_is_amortized_over_batch():
+    admission = AdmissionController(default_service_ms={"image": 1000.0})
+    admission.observe_service("image", 400, batch_size=4)
+    assert admission.service_ms("image") == pytest.approx(0.8 * 1000 + 0.2 * 100)
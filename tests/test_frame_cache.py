@@ -0,0 +1,139 @@
+"""
+帧存储和帧缓存测试 - 各编码的读写往返、不完整文件、缓存命中/未命中和按磁盘预算淘汰
+
+运行（在项目根目录）:
+    python -m pytest -q tests
+"""
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("PIL")
+
+from backend.frame_cache import FrameCache
+from backend.frame_store import (
+    CODEC_JPEG, CODEC_PNG, CODEC_RAW, FrameStore, FrameStoreError, FrameStoreWriter, write_frame_store
+)
+
+
+def make_frames(n=4, height=24, width=32, seed=0):
+    """平滑渐变加少量噪声的帧（接近真实画面，JPEG误差较小）"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    return np.stack([
+        np.clip(base + rng.integers(-4, 4, base.shape) + i, 0, 255).astype(np.uint8) for i in range(n)
+    ])
+
+
+@pytest.mark.parametrize("codec", [CODEC_RAW, CODEC_PNG])
+def test_lossless_round_trip(tmp_path, codec):
+    frames = make_frames()
+    path = str(tmp_path / "a.frames")
+    write_frame_store(path, frames, timestamps=np.arange(len(frames)) * 0.5, codec=codec, meta={"fps": 2})
+    with FrameStore(path) as store:
+        assert len(store) == len(frames)
+        assert store.shape == frames.shape
+        assert store.meta == {"fps": 2}
+        assert store.timestamps.tolist() == [0.0, 0.5, 1.0, 1.5]
+        assert np.array_equal(store[2], frames[2])
+        assert np.array_equal(store[-1], frames[-1])
+        assert np.array_equal(store[1:3], frames[1:3])
+        assert np.array_equal(np.asarray(store), frames)
+
+
+def test_jpeg_round_trip_is_close(tmp_path):
+    frames = make_frames()
+    path = str(tmp_path / "a.frames")
+    write_frame_store(path, frames, codec=CODEC_JPEG)
+    with FrameStore(path) as store:
+        decoded = np.asarray(store)
+    assert decoded.shape == frames.shape
+    assert np.abs(decoded.astype(int) - frames).mean() < 4
+
+
+def test_raw_frames_are_memory_mapped(tmp_path):
+    frames = make_frames()
+    path = str(tmp_path / "a.frames")
+    write_frame_store(path, frames, codec=CODEC_RAW)
+    store = FrameStore(path)
+    array = np.asarray(store)
+    store.close()
+    # 映射数组只读，关闭存储后仍可使用
+    assert not array.flags.writeable
+    assert np.array_equal(array, frames)
+
+
+def test_raw_requires_equal_frame_sizes(tmp_path):
+    path = str(tmp_path / "a.frames")
+    with pytest.raises(ValueError):
+        write_frame_store(path, [make_frames(1)[0], make_frames(1, height=16)[0]], codec=CODEC_RAW)
+    assert not os.path.exists(path)
+
+
+def test_unfinished_and_truncated_files_are_rejected(tmp_path):
+    path = str(tmp_path / "a.frames")
+    writer = FrameStoreWriter(path, codec=CODEC_RAW)
+    writer.append(make_frames(1)[0])
+    writer._file.flush()
+    # 未close的文件没有有效文件头
+    with pytest.raises(FrameStoreError):
+        FrameStore(path)
+    writer.close()
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:-10])
+    with pytest.raises(FrameStoreError):
+        FrameStore(path)
+
+
+def test_cache_hit_returns_same_frames(tmp_path):
+    cache = FrameCache(str(tmp_path), max_bytes=0)
+    frames, timestamps = make_frames(), np.arange(4.0)
+    assert cache.get("k") is None
+    cache.put("k", frames, timestamps)
+    store, cached_timestamps = cache.get("k")
+    assert np.array_equal(np.asarray(store), frames)
+    assert np.array_equal(cached_timestamps, timestamps)
+    store.close()
+
+
+def test_corrupt_entry_is_a_miss(tmp_path):
+    cache = FrameCache(str(tmp_path), max_bytes=0)
+    cache.put("k", make_frames(), np.arange(4.0))
+    with open(cache._path("k"), 'r+b') as f:
+        f.write(b"\0" * 8)
+    assert cache.get("k") is None
+
+
+def test_key_depends_on_file_and_params(tmp_path):
+    video = tmp_path / "v.mp4"
+    video.write_bytes(b"a" * 100)
+    cache = FrameCache(str(tmp_path / "cache"), max_bytes=0)
+    key = cache.make_key(str(video), num_frames=8)
+    assert key == cache.make_key(str(video), num_frames=8)
+    assert key != cache.make_key(str(video), num_frames=16)
+    assert key != FrameCache(str(tmp_path / "cache"), 0, codec=CODEC_PNG).make_key(str(video), num_frames=8)
+    video.write_bytes(b"b" * 100)
+    assert key != cache.make_key(str(video), num_frames=8)
+
+
+def test_eviction_keeps_recently_used_entries(tmp_path):
+    frames = make_frames()
+    entry_bytes = FrameCache(str(tmp_path / "probe"), 0)
+    entry_bytes.put("k", frames, np.arange(4.0))
+    size = entry_bytes.get_stats()["total_bytes"]
+
+    cache = FrameCache(str(tmp_path / "cache"), max_bytes=int(size * 2.5))
+    for i, key in enumerate(["a", "b"]):
+        cache.put(key, frames, np.arange(4.0))
+        os.utime(cache._path(key), (1000 + i, 1000 + i))
+    # 命中更新最近使用时间，之后写入c时淘汰最久未用的b
+    store, _ = cache.get("a")
+    store.close()
+    cache.put("c", frames, np.arange(4.0))
+    assert cache.get_stats()["entries"] == 2
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
@@ -0,0 +1,45 @@
+"""
+关键帧选取测试 - select_keyframes在扫描帧极少时的边界情况
+
+运行（在项目根目录）:
+    python -m pytest -q tests
+"""
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("decord")
+
+from backend.video_utils import FRAME_FACTOR, select_keyframes
+
+
+def scores(n, change=0.0):
+    """n个扫描帧的场景得分（首帧距离为0，其余为change）"""
+    hist_dist = np.full(n, change)
+    hist_dist[0] = 0.0
+    return hist_dist, np.full(n, change)
+
+
+def test_single_frame_is_duplicated():
+    picks = select_keyframes(*scores(1), max_frames=64)
+    assert picks.tolist() == [0] * FRAME_FACTOR
+
+
+def test_two_frames_are_both_selected():
+    for min_frames in (1, 4):
+        picks = select_keyframes(*scores(2), max_frames=64, min_frames=min_frames)
+        assert picks.tolist() == [0, 1]
+
+
+def test_two_frames_with_scene_cut():
+    picks = select_keyframes(*scores(2, change=1.0), max_frames=1)
+    assert picks.tolist() == [0, 1]
+
+
+def test_picks_are_even_and_within_budget():
+    rng = np.random.default_rng(0)
+    for n in range(3, 40):
+        hist_dist, pixel_diff = rng.random(n) * 0.3, rng.random(n) * 0.1
+        picks = select_keyframes(hist_dist, pixel_diff, max_frames=8, min_frames=1)
+        assert len(picks) % FRAME_FACTOR == 0
+        assert 0 < len(picks) <= 8
+        assert np.all(np.diff(picks) > 0) and picks[-1] < n
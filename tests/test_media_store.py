@@ -0,0 +1,72 @@
+"""
+媒体存储测试 - 移入、引用、按磁盘预算淘汰（使用中的条目不淘汰）和后台写入
+
+运行（在项目根目录）:
+    python -m pytest -q tests
+"""
+import asyncio
+import os
+
+from server.media_store import MediaStore
+
+
+def sha(c):
+    return c * 64
+
+
+def write(path, nbytes):
+    path.write_bytes(b"x" * nbytes)
+    return str(path)
+
+
+def test_put_acquire_release(tmp_path):
+    store = MediaStore(str(tmp_path / "store"), max_bytes=100)
+    path = store.put(write(tmp_path / "a", 10), sha("a"), ".mp4")
+    assert path.endswith(".mp4") and os.path.exists(path)
+    assert not os.path.exists(tmp_path / "a")
+    store.release(sha("a"))
+    assert store.contains(sha("a"))
+    assert store.acquire(sha("a")) == path
+    assert store.acquire(sha("b")) is None
+    assert (store.hits, store.misses) == (1, 1)
+    # 已有的媒体再次移入时删除源文件
+    store.put(write(tmp_path / "a2", 10), sha("a"), ".mp4")
+    assert not os.path.exists(tmp_path / "a2") and store.total_bytes == 10
+
+
+def test_eviction_skips_pinned_entries(tmp_path):
+    store = MediaStore(str(tmp_path / "store"), max_bytes=25)
+    store.put(write(tmp_path / "a", 10), sha("a"))
+    store.put(write(tmp_path / "b", 10), sha("b"))
+    store.release(sha("b"))
+    store.put(write(tmp_path / "c", 10), sha("c"))
+    # a仍在使用中，淘汰最久未用且未被使用的b
+    assert store.contains(sha("a")) and not store.contains(sha("b")) and store.contains(sha("c"))
+    assert store.total_bytes == 20
+
+
+def test_persist_copies_in_background_and_keeps_source(tmp_path):
+    store = MediaStore(str(tmp_path / "store"), max_bytes=100)
+    source = write(tmp_path / "memfd", 10)
+
+    async def scenario():
+        await asyncio.gather(store.persist(source, sha("a"), ".mp4"), store.persist(source, sha("a"), ".mp4"))
+
+    asyncio.run(scenario())
+    assert os.path.exists(source)
+    assert store.contains(sha("a")) and store.total_bytes == 10
+    assert sorted(os.listdir(tmp_path / "store")) == [sha("a") + ".mp4"]
+    # 未被使用，可直接淘汰
+    store.max_bytes = 0
+    store.release(sha("a"))
+    assert not store.contains(sha("a"))
+
+
+def test_restart_restores_entries_and_removes_partial_writes(tmp_path):
+    root = tmp_path / "store"
+    store = MediaStore(str(root), max_bytes=100)
+    store.put(write(tmp_path / "a", 10), sha("a"), ".mp4")
+    (root / ".tmp_partial").write_bytes(b"x")
+    restored = MediaStore(str(root), max_bytes=100)
+    assert restored.contains(sha("a")) and restored.total_bytes == 10
+    assert not (root / ".tmp_partial").exists()
@@ -0,0 +1,125 @@
+"""
+结果缓存测试 - 命中、过期、LRU淘汰和进行中生成的共享（single-flight）
+
+运行（在项目根目录）:
+    python -m pytest -q tests
+"""
+import asyncio
+
+from server.result_cache import ResultCache, normalize_prompt
+
+
+def test_key_normalizes_prompt():
+    assert normalize_prompt("  描述　这张\n图片 ") == "描述 这张 图片"
+    key = ResultCache.make_key("image", "abc", "描述  图片", max_new_tokens=128, temperature=0)
+    assert key == ResultCache.make_key("image", "abc", " 描述 图片", temperature=0, max_new_tokens=128)
+    assert key != ResultCache.make_key("image", "abc", "描述 图片", max_new_tokens=256, temperature=0)
+
+
+def test_ttl_and_lru_eviction(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("server.result_cache.time.time", lambda: now[0])
+    cache = ResultCache(max_entries=2, ttl_s=10)
+    cache.put("a", "A", {})
+    cache.put("b", "B", {})
+    assert cache.get("a") == ("A", {})
+    cache.put("c", "C", {})
+    # a刚被使用，淘汰最久未用的b
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    now[0] += 11
+    assert cache.get("a") is None
+
+
+def test_errors_are_not_cached():
+    cache = ResultCache()
+    cache.put("a", "处理错误", {"error": "ValueError"})
+    cache.put("b", "", {"cancelled": True})
+    assert cache.get("a") is None and cache.get("b") is None
+
+
+def test_concurrent_requests_share_one_computation():
+    async def scenario():
+        cache = ResultCache()
+        calls = 0
+
+        async def compute():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            return "结果", {"tokens": 3}
+
+        results = await asyncio.gather(*(cache.run("k", compute) for _ in range(3)))
+        again = await cache.run("k", compute)
+        return calls, results, again, cache.get_stats()
+
+    calls, results, again, stats = asyncio.run(scenario())
+    assert calls == 1
+    assert sorted(source for _, source in results) == ["miss", "shared", "shared"]
+    assert all(value == ("结果", {"tokens": 3}) for value, _ in results)
+    assert again == (("结果", {"tokens": 3}), "hit")
+    assert (stats["misses"], stats["shared"], stats["hits"], stats["in_flight"]) == (1, 2, 1, 0)
+
+
+def test_cancelled_first_waiter_does_not_cancel_shared_computation():
+    async def scenario():
+        cache = ResultCache()
+        started = asyncio.Event()
+
+        async def compute():
+            started.set()
+            await asyncio.sleep(0.05)
+            return "结果", {}
+
+        first = asyncio.ensure_future(cache.run("k", compute))
+        await started.wait()
+        second = asyncio.ensure_future(cache.run("k", compute))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second, cache.get("k")
+
+    (value, source), cached = asyncio.run(scenario())
+    assert value == ("结果", {}) and source == "shared"
+    assert cached == ("结果", {})
+
+
+def test_computation_cancelled_when_last_waiter_leaves():
+    async def scenario():
+        cache = ResultCache()
+        cancelled = asyncio.Event()
+
+        async def compute():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+            return "结果", {}
+
+        waiters = [asyncio.ensure_future(cache.run("k", compute)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0)
+        return cache.get_stats()["in_flight"], cache.get("k")
+
+    in_flight, cached = asyncio.run(scenario())
+    assert in_flight == 0 and cached is None
+
+
+def test_streaming_requests_do_not_share():
+    async def scenario():
+        cache = ResultCache()
+        calls = 0
+
+        async def compute():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "结果", {}
+
+        await asyncio.gather(cache.run("k", compute, share=False), cache.run("k", compute, share=False))
+        return calls
+
+    assert asyncio.run(scenario()) == 2
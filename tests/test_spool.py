@@ -0,0 +1,78 @@
+"""
+上传暂存测试 - 内存预算、内存/磁盘暂存文件、大小上限和遗留文件清理
+
+运行（在项目根目录）:
+    python -m pytest -q tests
+"""
+import hashlib
+import os
+
+import pytest
+
+from server.spool import (
+    SPOOL_PREFIX, MemoryBudget, MemorySpool, UploadSpool, UploadTooLargeError, open_spool, sweep_spool_dir
+)
+
+
+def test_disk_spool_writes_hashes_and_cleans_up(tmp_path):
+    spool = UploadSpool(str(tmp_path), suffix=".mp4")
+    for chunk in (b"abc", b"def"):
+        spool.write(chunk)
+    spool.finish()
+    assert spool.path.endswith(".mp4") and os.path.basename(spool.path).startswith(f"{SPOOL_PREFIX}{os.getpid()}_")
+    with open(spool.path, 'rb') as f:
+        assert f.read() == b"abcdef"
+    assert spool.sha256 == hashlib.sha256(b"abcdef").hexdigest()
+    assert spool.get_stats()["upload_bytes"] == 6
+    spool.cleanup()
+    assert not os.path.exists(spool.path)
+
+
+def test_upload_limit(tmp_path):
+    spool = UploadSpool(str(tmp_path), max_bytes=4)
+    spool.write(b"abcd")
+    with pytest.raises(UploadTooLargeError):
+        spool.write(b"e")
+    spool.cleanup()
+
+
+@pytest.mark.skipif(not hasattr(os, "memfd_create"), reason="需要memfd_create")
+def test_memory_spool_is_readable_by_path_and_returns_budget(tmp_path):
+    budget = MemoryBudget(10)
+    spool = open_spool(str(tmp_path), 6, budget=budget)
+    assert isinstance(spool, MemorySpool) and spool.in_memory
+    spool.write(b"abcdef")
+    spool.finish()
+    with open(spool.path, 'rb') as f:
+        assert f.read() == b"abcdef"
+    assert os.listdir(tmp_path) == []
+    # 预算不足时改用磁盘暂存
+    fallback = open_spool(str(tmp_path), 6, budget=budget)
+    assert not fallback.in_memory
+    fallback.cleanup()
+    spool.cleanup()
+    spool.cleanup()
+    stats = budget.get_stats()
+    assert stats["used_bytes"] == 0 and stats["peak_bytes"] == 6 and stats["disk_fallbacks"] == 1
+
+
+@pytest.mark.skipif(not hasattr(os, "memfd_create"), reason="需要memfd_create")
+def test_memory_spool_rejects_writes_beyond_reservation():
+    budget = MemoryBudget(10)
+    spool = open_spool(None, 3, budget=budget)
+    with pytest.raises(UploadTooLargeError):
+        spool.write(b"abcd")
+    spool.cleanup()
+    assert budget.used_bytes == 0
+
+
+def test_sweep_removes_files_of_exited_processes(tmp_path):
+    # 假定pid 2**22+1不存在（超过Linux默认pid上限）
+    stale = tmp_path / f"{SPOOL_PREFIX}{2 ** 22 + 1}_x.mp4"
+    own = tmp_path / f"{SPOOL_PREFIX}{os.getpid()}_y.mp4"
+    other = tmp_path / "unrelated.mp4"
+    for path in (stale, own, other):
+        path.write_bytes(b"x")
+    assert sweep_spool_dir(str(tmp_path)) == 1
+    assert sorted(os.listdir(tmp_path)) == sorted([own.name, other.name])
+    assert sweep_spool_dir(str(tmp_path / "missing")) == 0
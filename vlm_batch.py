@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+VLM批量推理 - 无界面地为目录或清单中的视频批量生成描述，结果逐行写入JSONL
+- 视频解码和抽帧在进程池中进行（video_utils.get_video_frames，抽取的帧写入帧缓存）
+- 远程模式按服务器声明的像素预算在本地抽帧，以帧序列上传，同时保持N个请求在途；
+  本地模式（--local）加载模型，进程池预取下一批视频的帧，GPU依次推理
+- 分段模式（--segment-seconds）按时间窗口分段描述后汇总（backend/video_summary.py），提示词作为最终问题，
+  分段描述缓存在磁盘上，对同一批视频换一个问题重新运行时只执行汇总
+- 输出文件即检查点: 重新运行时跳过已成功的作业（按视频标识、提示词和抽帧模式区分），失败的作业重试；
+  换了提示词或模式的视频会重新处理
+
+用法（在项目根目录）:
+    python vlm_batch.py data/videos --output captions.jsonl --server localhost:8000 --in-flight 4
+    python vlm_batch.py manifest.jsonl --output captions.jsonl --local --model-path Qwen/Qwen2.5-VL-3B-Instruct
+    python vlm_batch.py data/long_videos --output answers.jsonl --segment-seconds 60 --prompt "视频里一共出现了几个人？"
+
+清单格式: 每行一个视频路径（.txt），或每行一个JSON {"video": 路径, "prompt": 提示词, "id": 标识}（.jsonl）
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import sys
+import time
+from datetime import datetime
+
+from backend.vlm_protocol import (
+    PROTOCOL_BINARY, RETRYABLE_ERRORS, build_video_frames_request, build_video_request, choose_protocol
+)
+
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm', '.flv', '.m4v')
+DEFAULT_PROMPT = "请描述这个视频的内容"
+
+# 服务器繁忙时的重试次数和单次最长等待（毫秒）
+MAX_BUSY_RETRIES = 5
+MAX_RETRY_DELAY_MS = 30000
+
+
+def collect_jobs(source, prompt=DEFAULT_PROMPT):
+    """
+    收集批处理作业
+
+    Args:
+        source: 视频目录（递归查找视频文件）或清单文件
+        prompt: 清单未指定提示词时使用的提示词
+
+    Returns:
+        list: [{"id", "video", "prompt"}, ...]，id默认为视频的绝对路径
+    """
+    jobs = []
+    if os.path.isdir(source):
+        for root, _, filenames in os.walk(source):
+            for filename in sorted(filenames):
+                if filename.lower().endswith(VIDEO_EXTENSIONS):
+                    path = os.path.abspath(os.path.join(root, filename))
+                    jobs.append({"id": path, "video": path, "prompt": prompt})
+        jobs.sort(key=lambda job: job["id"])
+        return jobs
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            entry = json.loads(line) if line.startswith('{') else {"video": line}
+            path = os.path.abspath(os.path.join(base_dir, entry["video"]))
+            jobs.append({"id": entry.get("id", path), "video": path, "prompt": entry.get("prompt", prompt)})
+    return jobs
+
+
+def run_mode(args):
+    """
+    本次运行的抽帧模式，写入每条结果，检查点据此区分不同模式的结果
+
+    Returns:
+        str: "segments:<秒数>"（分段模式）、"adaptive"（关键帧）或"uniform"（均匀抽帧）
+    """
+    if args.segment_seconds:
+        return f"segments:{args.segment_seconds:g}"
+    return "adaptive" if args.adaptive_frames else "uniform"
+
+
+def checkpoint_key(job_id, prompt, mode):
+    """检查点键 - 同一视频换提示词或抽帧模式视为不同作业"""
+    return (job_id, prompt, mode)
+
+
+def load_checkpoint(output_path):
+    """
+    读取已有输出，返回已成功处理的作业的检查点键（同一作业以最后一条记录为准）
+
+    Returns:
+        set: {(标识, 提示词, 模式), ...}，没有mode字段的旧记录按均匀抽帧处理
+    """
+    status = {}
+    if not os.path.exists(output_path):
+        return set()
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 上次中断时写了一半的行
+                continue
+            key = checkpoint_key(record.get("id"), record.get("prompt"), record.get("mode", "uniform"))
+            status[key] = record.get("status")
+    return {key for key, job_status in status.items() if job_status == "ok"}
+
+
+class ResultWriter:
+    """结果写入器 - 每条结果写入后立即落盘，中断时已完成的结果不会丢失"""
+
+    def __init__(self, output_path):
+        directory = os.path.dirname(os.path.abspath(output_path))
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(output_path, 'a', encoding='utf-8')
+
+    def write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def prepare_frames_request(job, frame_budget, cache_dir, adaptive=False):
+    """
+    在进程池中解码视频并抽帧（远程模式），adaptive为True时按场景变化选取关键帧
+
+    Returns:
+        tuple: (请求字典, 帧序列负载, 准备统计)
+    """
+    from backend.video_utils import estimate_video_tokens, sample_video_frames
+
+    start = time.time()
+    frames, timestamps, fps = sample_video_frames(
+        job["video"], frame_budget["total_pixels"], frame_budget["min_pixels"], cache_dir=cache_dir,
+        adaptive=adaptive,
+    )
+    request, payload = build_video_frames_request(
+        frames, timestamps, fps, job["prompt"], os.path.basename(job["video"])
+    )
+    stats = {
+        "frames": len(frames),
+        "frame_size": [frames[0].width, frames[0].height],
+        "video_tokens": estimate_video_tokens(
+            len(frames), frames[0].height, frames[0].width, frame_budget["total_pixels"], frame_budget["min_pixels"]
+        ),
+        "upload_bytes": len(payload),
+        "video_bytes": os.path.getsize(job["video"]),
+        "prepare_ms": (time.time() - start) * 1000,
+    }
+    return request, bytes(payload), stats
+
+
+def prefetch_frames(job, num_frames, cache_dir, adaptive=False):
+    """在进程池中解码视频并把抽取的帧写入帧缓存（本地模式，推理时直接命中缓存）"""
+    from backend.video_utils import get_keyframes, get_video_frames
+
+    start = time.time()
+    if adaptive:
+        get_keyframes(job["video"], num_frames, cache_dir)
+    else:
+        get_video_frames(job["video"], num_frames, cache_dir)
+    return {"prepare_ms": (time.time() - start) * 1000}
+
+
+class BatchRunner:
+    """批处理调度 - 进程池准备输入，最多in_flight个请求同时推理"""
+
+    def __init__(self, args):
+        self.args = args
+        self.mode = run_mode(args)
+        self.writer = None
+        self.pool = None
+        self.connection = None
+        self.local = None
+        self.summarizer = None
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+
+    async def run(self, jobs):
+        args = self.args
+        self.total = len(jobs)
+        # spawn启动解码进程，避免fork已初始化CUDA或已启动连接线程的进程
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self.writer = ResultWriter(args.output)
+        try:
+            if args.local:
+                await asyncio.to_thread(self._load_local)
+                infer = self._infer_local
+            else:
+                await asyncio.to_thread(self._connect)
+                infer = self._infer_remote
+            if args.segment_seconds:
+                self._create_summarizer()
+
+            # 准备中和推理中的作业总数有上限（预取workers个），推理并发为in_flight
+            pipeline = asyncio.Semaphore(args.in_flight + args.workers)
+            inference = asyncio.Semaphore(1 if args.local else args.in_flight)
+
+            async def process(job):
+                async with pipeline:
+                    await self._process(job, infer, inference)
+
+            await asyncio.gather(*(process(job) for job in jobs))
+        finally:
+            self.writer.close()
+            self.pool.shutdown(cancel_futures=True)
+            if self.connection is not None:
+                self.connection.stop()
+
+    def _connect(self):
+        from backend.vlm_connection import VLMConnection
+
+        host, _, port = self.args.server.rpartition(":")
+        self.connection = VLMConnection(host or "localhost", int(port))
+        self.connection.start()
+        metadata = self.connection.wait_ready()
+        self.protocol = choose_protocol(metadata)
+        self.frame_budget = metadata.get("video_frames") if self.protocol == PROTOCOL_BINARY else None
+        if self.frame_budget is None:
+            print("服务器不接受帧序列视频，上传视频文件")
+        print(f"已连接服务器: {self.connection.uri} (后端={metadata.get('backend')}, 设备={metadata.get('device')})")
+
+    def _create_summarizer(self):
+        from backend.video_summary import LocalSegmentRunner, RemoteSegmentRunner, VideoSummarizer
+
+        if self.args.local:
+            runner = LocalSegmentRunner(self.local.model, self.local.processor, self.args.model_path)
+        else:
+            runner = RemoteSegmentRunner(self.connection)
+        self.summarizer = VideoSummarizer(
+            runner, self.args.segment_seconds, cache_dir=self.args.cache_dir, workers=self.args.workers
+        )
+
+    def _load_local(self):
+        from backend.video_utils import inference_video_with_frames
+        from backend.vlm_processor import VLMProcessor
+
+        self.local = VLMProcessor(self.args.model_path)
+        self.local.load_model()
+        if not self.local.is_model_loaded:
+            raise RuntimeError(f"模型加载失败: {self.args.model_path}")
+        self.inference_video = inference_video_with_frames
+
+    async def _prepare(self, job):
+        """在进程池中准备推理输入（远程模式为请求和负载，本地模式预取帧到帧缓存）"""
+        loop = asyncio.get_running_loop()
+        if self.args.local:
+            stats = await loop.run_in_executor(
+                self.pool, prefetch_frames, job, self.args.num_frames, self.args.cache_dir, self.args.adaptive_frames
+            )
+            return None, stats
+        if self.frame_budget is not None:
+            request, payload, stats = await loop.run_in_executor(
+                self.pool, prepare_frames_request, job, self.frame_budget, self.args.cache_dir,
+                self.args.adaptive_frames,
+            )
+            return (request, payload, None), stats
+        request, file_path = build_video_request(
+            job["video"], job["prompt"], self.protocol, self.connection.metadata.get("max_upload_bytes", 0)
+        )
+        return (request, None, file_path), {}
+
+    async def _process(self, job, infer, inference):
+        record = {"id": job["id"], "video": job["video"], "prompt": job["prompt"], "mode": self.mode}
+        start = time.time()
+        try:
+            if self.summarizer is not None:
+                # 分段模式: 分段抽帧在线程中进行，各分段请求同时在途
+                async with inference:
+                    result, segments, stats = await asyncio.to_thread(
+                        self.summarizer.summarize, job["video"], job["prompt"]
+                    )
+                record["segments"] = segments
+            else:
+                prepared, stats = await self._prepare(job)
+                async with inference:
+                    result, infer_stats = await infer(job, prepared)
+                stats.update(infer_stats)
+            record.update(status="ok", result=result)
+            self.done += 1
+        except Exception as e:
+            record.update(status="error", error=f"{type(e).__name__}: {e}")
+            stats = {}
+            self.failed += 1
+        record.update(stats, total_ms=(time.time() - start) * 1000, finished_at=datetime.now().isoformat())
+        self.writer.write(record)
+        summary = record.get("result", record.get("error", ""))[:40].replace("\n", " ")
+        print(f"[{self.done + self.failed}/{self.total}] {record['status']} {os.path.basename(job['video'])}: {summary}")
+
+    async def _infer_remote(self, job, prepared):
+        request, payload, file_path = prepared
+        for attempt in range(MAX_BUSY_RETRIES + 1):
+            response = await asyncio.wrap_future(
+                self.connection.submit(self.connection.request(request, payload, file_path))
+            )
+            if response.get("error_code") not in RETRYABLE_ERRORS or attempt == MAX_BUSY_RETRIES:
+                break
+            delay_ms = min(response.get("retry_after_ms") or 1000, MAX_RETRY_DELAY_MS)
+            await asyncio.sleep(delay_ms / 1000)
+        if "error" in response:
+            raise RuntimeError(f"服务器错误: {response['error']}")
+        if "error" in response.get("stats", {}):
+            # 推理函数内部捕获的错误以错误文本作为结果返回，记为失败，重新运行时重试
+            raise RuntimeError(f"推理失败: {response['stats']['error']}")
+        stats = {"timing": response.get("timing", {}), "client_timing": response.get("client_timing", {})}
+        return response["result"], stats
+
+    async def _infer_local(self, job, prepared):
+        start = time.time()
+        result = await asyncio.to_thread(
+            self.inference_video, self.local.model, self.local.processor, job["video"], job["prompt"],
+            num_frames=self.args.num_frames, adaptive=self.args.adaptive_frames, cache_dir=self.args.cache_dir,
+        )
+        return result, {"inference_ms": (time.time() - start) * 1000}
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="VLM批量视频推理")
+    parser.add_argument("source", help="视频目录或清单文件（.txt每行一个路径，.jsonl每行一个作业）")
+    parser.add_argument("--output", default="vlm_batch_results.jsonl", help="结果JSONL文件（兼作检查点）")
+    parser.add_argument("--prompt", default=DEFAULT_PROMPT, help="清单未指定时使用的提示词")
+    parser.add_argument("--server", default="localhost:8000", help="VLM服务器地址 host:port")
+    parser.add_argument("--local", action="store_true", help="在本进程加载模型推理，不连接服务器")
+    parser.add_argument("--model-path", default="Qwen/Qwen2.5-VL-3B-Instruct", help="本地模式的模型路径")
+    parser.add_argument("--num-frames", type=int, default=64, help="本地模式每个视频抽取的帧数")
+    parser.add_argument("--in-flight", type=int, default=4, help="同时在途的推理请求数（本地模式固定为1）")
+    parser.add_argument("--workers", type=int, default=max(1, min(4, (os.cpu_count() or 2) // 2)),
+                        help="解码抽帧进程数")
+    parser.add_argument("--cache-dir", default='.cache', help="帧缓存目录")
+    parser.add_argument("--adaptive-frames", action="store_true",
+                        help="按场景变化选取关键帧（静止画面用更少的帧和视觉token）")
+    parser.add_argument("--segment-seconds", type=float, default=0,
+                        help="分段模式的时间窗口长度（秒），0表示整段视频一次推理")
+    parser.add_argument("--limit", type=int, default=0, help="最多处理的视频数，0表示不限制")
+    args = parser.parse_args()
+
+    jobs = collect_jobs(args.source, args.prompt)
+    finished = load_checkpoint(args.output)
+    mode = run_mode(args)
+    pending = [job for job in jobs if checkpoint_key(job["id"], job["prompt"], mode) not in finished]
+    print(f"共 {len(jobs)} 个视频，已完成 {len(jobs) - len(pending)} 个，本次处理 {len(pending)} 个")
+    if args.limit:
+        pending = pending[:args.limit]
+    if not pending:
+        return
+
+    runner = BatchRunner(args)
+    start = time.time()
+    try:
+        asyncio.run(runner.run(pending))
+    except KeyboardInterrupt:
+        print("已中断，已完成的结果已写入，重新运行将从中断处继续")
+        sys.exit(130)
+    elapsed = time.time() - start
+    print(f"完成: 成功 {runner.done}，失败 {runner.failed}，耗时 {elapsed:.1f}s "
+          f"({runner.done / elapsed * 60:.1f} 个/分钟)")
+
+
+if __name__ == "__main__":
+    main()
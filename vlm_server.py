@@ -5,300 +5,845 @@ VLM模型服务器端
 """
 import asyncio
 import base64
-import io
+import functools
+import hashlib
 import json
 import logging
+import os
+import tempfile
 import time
 import traceback
-from typing import Dict, Any
+from typing import Dict, Any, List
 
-import torch
-from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor
-from qwen_vl_utils import process_vision_info
-from PIL import Image
 import websockets.asyncio.server as server
 import websockets.frames
 
+from server.backend import create_backend
+from server.inference_executor import InferenceExecutor
+from server.batch_scheduler import BatchScheduler
+from server.spool import MemoryBudget, UploadTooLargeError, open_spool, sweep_spool_dir
+from server.media_store import MediaStore
+from server.timing import timed, split_timing
+from server.metrics import ServerMetrics, serve_metrics
+from server.admission import AdmissionController, AdmissionRejected, DeadlineExceededError
+from server.result_cache import ResultCache
+from backend.vlm_protocol import (
+    ERROR_DEADLINE_EXCEEDED, ERROR_MEDIA_MISSING, ERROR_OVERLOADED, SUPPORTED_PROTOCOLS,
+    file_sha256, iter_binary_payload, receive_binary_payload, video_frames_fps
+)
 
 logger = logging.getLogger(__name__)
 
 
+class MediaMissingError(KeyError):
+    """请求引用的媒体不在服务器媒体存储中"""
+    
+    def __str__(self):
+        return str(self.args[0]) if self.args else ""
+
+
 class VLMServer:
     """VLM模型服务器"""
     
-    def __init__(self, model_path: str = "Qwen/Qwen2.5-VL-7B-Instruct", host: str = "0.0.0.0", port: int = 8000):
+    def __init__(self, model_path: str = "Qwen/Qwen2.5-VL-7B-Instruct", host: str = "0.0.0.0", port: int = 8000,
+                 batch_window_ms: float = 20, max_batch_size: int = 4, max_batch_pixels: int = 0,
+                 max_video_batch_size: int = 4,
+                 spool_dir: str = None, max_upload_mb: float = 1024, memory_spool_mb: float = 2048,
+                 media_store_dir: str = None, media_store_mb: float = 4096,
+                 vision_cache_mb: float = 1024,
+                 session_cache_mb: float = 2048, max_sessions: int = 16, session_ttl_s: float = 600,
+                 metrics_host: str = "127.0.0.1", metrics_port: int = 9100,
+                 backend: str = "qwen", backend_options: Dict[str, Any] = None,
+                 max_queue: int = 64, max_per_client: int = 8, max_connections: int = 0,
+                 result_cache_entries: int = 1024, result_cache_ttl_s: float = 600,
+                 replicas: int = 1, replica_devices: List[str] = None):
         self.model_path = model_path
         self.host = host
         self.port = port
-        self.model = None
-        self.processor = None
+        
+        # 推理后端 - 模型相关的预处理和生成（stub后端不加载权重，用于压测）
+        if backend == "qwen":
+            backend_options = dict(
+                model_path=model_path,
+                vision_cache_mb=vision_cache_mb,
+                session_cache_mb=session_cache_mb,
+                max_sessions=max_sessions,
+                session_ttl_s=session_ttl_s,
+                **(backend_options or {}),
+            )
+        if replicas > 1:
+            # 多副本 - 每个工作进程加载一份模型，空闲副本取下一个作业
+            from server.replica_pool import ReplicaBackend, ReplicaPool
+            self.executor = ReplicaPool(backend, backend_options, replicas, replica_devices)
+            self.backend = ReplicaBackend(self.executor)
+        else:
+            self.backend = create_backend(backend, **(backend_options or {}))
+            # 推理执行器 - 模型推理在专用GPU线程中执行，事件循环只处理I/O
+            self.executor = InferenceExecutor()
+        
+        # 上传暂存 - 分块上传的视频在内存预算内写入内存文件，超出预算时写入磁盘
+        self.spool_dir = spool_dir or os.path.join(tempfile.gettempdir(), "vlm_spool")
+        self.max_upload_bytes = int(max_upload_mb * 1024 ** 2)
+        self.memory_spool = MemoryBudget(int(memory_spool_mb * 1024 ** 2))
+        self._background_tasks = set()  # 后台写入媒体存储的任务（保持引用直到完成）
+        
+        # 内容寻址媒体存储 - 同一视频的后续请求无需重新上传
+        self.media_store = None
+        if media_store_mb > 0:
+            self.media_store = MediaStore(
+                media_store_dir or os.path.join(tempfile.gettempdir(), "vlm_media_store"),
+                int(media_store_mb * 1024 ** 2),
+            )
+        
+        # 结果缓存 - 相同(媒体, 提示词, 生成参数)的请求直接返回结果，进行中的相同请求共享一次生成
+        self.result_cache = None
+        if result_cache_entries > 0:
+            self.result_cache = ResultCache(result_cache_entries, result_cache_ttl_s)
+        
+        # 图像请求动态批处理
+        self.image_scheduler = BatchScheduler(
+            self.executor,
+            self.backend.process_image_batch,
+            window_ms=batch_window_ms,
+            max_batch_size=max_batch_size,
+            max_batch_pixels=max_batch_pixels,
+            name="image",
+        )
+        
+        # 帧序列视频请求动态批处理 - 长视频的各分段描述请求并发到达时合并为一次generate
+        self.video_scheduler = BatchScheduler(
+            self.executor,
+            self.backend.process_video_frames_batch,
+            window_ms=batch_window_ms,
+            max_batch_size=max_video_batch_size,
+            name="video",
+        )
+        
+        # 准入控制 - 有界在途请求、每客户端并发上限和客户端截止时间，过载时立即拒绝
+        self.admission = AdmissionController(
+            max_queue=max_queue, max_per_client=max_per_client, concurrency=self.executor.concurrency
+        )
+        self.max_connections = max_connections
+        self.active_connections = 0
+        
+        # 指标 - 在本地HTTP端点按Prometheus文本格式导出，metrics_port为0时不启动端点
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        self.metrics = ServerMetrics(queue_depths=lambda: {
+            "gpu": self.executor.queue_depth,
+            "image_batch": self.image_scheduler.queue_depth,
+            "video_batch": self.video_scheduler.queue_depth,
+            "admitted": self.admission.in_flight,
+        })
         
         # 设置日志
         logging.basicConfig(level=logging.INFO)
         logging.getLogger("websockets.server").setLevel(logging.INFO)
         
     def load_model(self):
-        """加载VLM模型"""
-        print(f"正在加载模型: {self.model_path}")
-        
-        # 检查GPU
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f"使用设备: {device}")
-        
-        if device == "cuda":
-            gpu_count = torch.cuda.device_count()
-            print(f"可用GPU数量: {gpu_count}")
-            for i in range(gpu_count):
-                gpu_name = torch.cuda.get_device_name(i)
-                gpu_memory = torch.cuda.get_device_properties(i).total_memory / 1024**3
-                print(f"GPU {i}: {gpu_name} ({gpu_memory:.1f} GB)")
-        
-        # 加载模型 - 使用服务器的全部GPU内存
-        load_kwargs = {
-            "torch_dtype": torch.bfloat16,
-            "device_map": "auto",  # 自动分配到多个GPU
-            "trust_remote_code": True,
-        }
+        """加载推理后端的模型"""
+        self.backend.load()
+    
+    async def _run_streaming(self, websocket, request_id, fn, *args, deadline=None, affinity=None):
+        """
+        在GPU线程中执行推理，同时将文本增量以delta消息推送给客户端
         
-        # 尝试使用Flash Attention 2
-        try:
-            import flash_attn
-            load_kwargs["attn_implementation"] = "flash_attention_2"
-            print("使用Flash Attention 2优化")
-        except ImportError:
-            print("Flash Attention 2不可用，使用标准attention")
+        Args:
+            request_id: 请求ID，随每条delta消息返回（客户端未提供时为None）
+            deadline: 最晚开始执行时间（time.time()），None表示不限
+            affinity: 亲和键（会话ID），多副本时同一会话固定到同一副本
         
-        print(f"模型加载配置: {load_kwargs}")
+        Returns:
+            tuple: (fn的返回值, {"first_delta_ms", "queue_wait_ms", "compute_ms"})
+        """
+        return await self._stream_deltas(
+            websocket, request_id,
+            lambda on_text: self._submit_timed(fn, *args, on_text=on_text, deadline=deadline, affinity=affinity),
+        )
+    
+    async def _run_batched_streaming(self, websocket, request_id, scheduler, payload, pixels=0, deadline=None):
+        """
+        流式请求参与组批 - 批次中只有该请求时逐段推送delta，与其他请求组批时完成后以一条delta发送完整结果
         
-        self.model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-            self.model_path, **load_kwargs
+        Returns:
+            tuple: ((结果文本, 统计信息), {"first_delta_ms", "queue_wait_ms", "compute_ms", "batch_size"})
+        """
+        (result, stats), timing = await self._stream_deltas(
+            websocket, request_id,
+            lambda on_text: scheduler.submit(payload, pixels=pixels, deadline=deadline, on_text=on_text),
         )
-        self.processor = AutoProcessor.from_pretrained(self.model_path)
+        if timing["first_delta_ms"] is None and result:
+            await self._send(websocket, request_id, {"type": "delta", "text": result})
+        return (result, stats), timing
+    
+    async def _stream_deltas(self, websocket, request_id, start_job):
+        """
+        执行作业并把文本增量以delta消息推送给客户端
+        
+        Args:
+            start_job: 接收on_text回调、返回 (结果, 耗时字典) 协程的函数
+        """
+        loop = asyncio.get_running_loop()
+        deltas = asyncio.Queue()
+        call_time = time.time()
+        first_delta_ms = None
         
-        print("VLM模型加载完成!")
+        def on_text(text):
+            loop.call_soon_threadsafe(deltas.put_nowait, text)
         
-    def process_image(self, image_data: str, prompt: str) -> str:
-        """处理图像推理"""
+        job = asyncio.ensure_future(start_job(on_text))
         try:
-            # 解码base64图像
-            image_bytes = base64.b64decode(image_data)
-            image = Image.open(io.BytesIO(image_bytes))
+            while True:
+                next_delta = asyncio.ensure_future(deltas.get())
+                done, _ = await asyncio.wait({next_delta, job}, return_when=asyncio.FIRST_COMPLETED)
+                if next_delta not in done:
+                    next_delta.cancel()
+                    break
+                if first_delta_ms is None:
+                    first_delta_ms = (time.time() - call_time) * 1000
+                await self._send(websocket, request_id, {"type": "delta", "text": next_delta.result()})
             
-            # 构建消息
-            messages = [
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": [
-                    {"type": "text", "text": prompt},
-                    {"type": "image", "image": image},
-                ]}
-            ]
-            
-            # 处理输入
-            text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-            image_inputs, video_inputs = process_vision_info(messages)
-            
-            inputs = self.processor(
-                text=[text],
-                images=image_inputs,
-                videos=video_inputs,
-                padding=True,
-                return_tensors="pt"
+            # 推理完成前已入队的增量
+            while not deltas.empty():
+                if first_delta_ms is None:
+                    first_delta_ms = (time.time() - call_time) * 1000
+                await self._send(websocket, request_id, {"type": "delta", "text": deltas.get_nowait()})
+        except BaseException:
+            job.cancel()
+            raise
+        
+        result, timing = job.result()
+        return result, dict(timing, first_delta_ms=first_delta_ms)
+    
+    async def _submit_timed(self, fn, *args, deadline=None, affinity=None, **kwargs):
+        """
+        提交到GPU线程执行并记录排队和执行耗时
+        
+        Args:
+            deadline: 最晚开始执行时间（time.time()），轮到执行时已过期则抛出DeadlineExceededError
+            affinity: 亲和键（会话ID），多副本时同一会话固定到同一副本
+        
+        Returns:
+            tuple: (fn的返回值, {"queue_wait_ms", "compute_ms"})
+        """
+        enqueue_time = time.time()
+        
+        def _timed():
+            start = time.time()
+            return fn(*args, **kwargs), start, time.time()
+        
+        result, start, end = await self.executor.submit(_timed, deadline=deadline, affinity=affinity)
+        return result, {"queue_wait_ms": (start - enqueue_time) * 1000, "compute_ms": (end - start) * 1000}
+    
+    async def _receive_payload(self, websocket, request):
+        """
+        接收二进制协议的负载帧
+        
+        视频负载边收边写入暂存文件（内存预算内为内存文件，否则为磁盘文件），其余负载接收到内存；
+        超出上限时丢弃剩余帧以保持协议同步
+        
+        Returns:
+            tuple: (内存负载或None, UploadSpool/MemorySpool或None)
+        """
+        payload_info = request["payload"]
+        length = int(payload_info["length"])
+        
+        if self.max_upload_bytes and length > self.max_upload_bytes:
+            await self._discard_payload(websocket, request)
+            raise UploadTooLargeError(
+                f"上传数据 {length / 1024 ** 2:.1f} MB 超过上限 {self.max_upload_bytes / 1024 ** 2:.0f} MB"
             )
-            inputs = inputs.to(self.model.device)
-            
-            # 生成回复
-            with torch.no_grad():
-                generated_ids = self.model.generate(**inputs, max_new_tokens=512)
-                generated_ids_trimmed = [
-                    out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-                ]
-                output_text = self.processor.batch_decode(
-                    generated_ids_trimmed, 
-                    skip_special_tokens=True, 
-                    clean_up_tokenization_spaces=False
-                )
-                
-            return output_text[0].strip()
-            
+        
+        if request.get("type") != "video" or "frames" in request:
+            # 图像和帧序列视频（已按像素预算缩放，体积小）接收到内存
+            return await receive_binary_payload(websocket, length), None
+        
+        suffix = os.path.splitext(request.get("video_filename", ""))[1]
+        spool = open_spool(self.spool_dir, length, self.max_upload_bytes, suffix=suffix, budget=self.memory_spool)
+        try:
+            async for chunk in iter_binary_payload(websocket, length):
+                spool.write(chunk)
+            spool.finish()
+        except BaseException:
+            spool.cleanup()
+            raise
+        return None, spool
+    
+    @staticmethod
+    async def _discard_payload(websocket, request):
+        """丢弃未接收的负载帧以保持协议同步"""
+        async for _ in iter_binary_payload(websocket, int(request["payload"]["length"])):
+            pass
+    
+    async def _prepare_image(self, image_data):
+        """
+        在I/O线程池中准备图像输入
+        
+        预计命中视觉编码缓存的图像保持未解码的原始字节，其余图像解码为PIL图像
+        
+        Returns:
+            tuple: (图像或原始字节, 视觉缓存键, 像素数, 图像SHA-256)
+        """
+        try:
+            return await asyncio.to_thread(self.backend.prepare_image, image_data)
         except Exception as e:
-            logger.error(f"图像处理错误: {e}")
-            return f"处理错误: {str(e)}"
+            raise ValueError(f"图像解码失败: {e}")
     
-    def process_video_from_data(self, video_data: str, video_filename: str, prompt: str) -> str:
-        """从base64数据处理视频推理"""
+    async def _prepare_video_frames(self, payload, frames_info):
+        """
+        在I/O线程池中解码帧序列视频并计算负载哈希（视觉编码缓存和会话的媒体标识）
+        
+        Returns:
+            tuple: (帧列表, 负载SHA-256)
+        """
+        def _prepare():
+            return self.backend.prepare_video_frames(payload, frames_info), hashlib.sha256(payload).hexdigest()
+        
         try:
-            # 保存视频文件到临时目录
-            import tempfile
-            import os
-            
-            temp_dir = tempfile.mkdtemp()
-            video_path = os.path.join(temp_dir, video_filename)
-            
-            # 解码并保存视频文件
-            video_bytes = base64.b64decode(video_data)
-            with open(video_path, 'wb') as f:
-                f.write(video_bytes)
-            
-            print(f"视频文件已保存到: {video_path}")
-            
-            # 构建消息 - 按照cookbook格式
-            messages = [
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": [
-                    {"type": "text", "text": prompt},
-                    {"video": video_path, "total_pixels": 20480 * 28 * 28, "min_pixels": 16 * 28 * 28},
-                ]}
-            ]
-            
-            # 处理输入
-            text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-            image_inputs, video_inputs, video_kwargs = process_vision_info([messages], return_video_kwargs=True)
-            fps_inputs = video_kwargs['fps']
-            
-            inputs = self.processor(
-                text=[text], 
-                images=image_inputs, 
-                videos=video_inputs, 
-                fps=fps_inputs, 
-                padding=True, 
-                return_tensors="pt"
-            )
-            inputs = inputs.to(self.model.device)
-            
-            # 生成回复
-            with torch.no_grad():
-                output_ids = self.model.generate(**inputs, max_new_tokens=2048)
-                generated_ids = [output_ids[len(input_ids):] for input_ids, output_ids in zip(inputs.input_ids, output_ids)]
-                output_text = self.processor.batch_decode(generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
-            
-            result = output_text[0].strip()
-            
-            # 清理临时文件
-            try:
-                import shutil
-                shutil.rmtree(temp_dir)
-                print(f"清理临时目录: {temp_dir}")
-            except:
-                pass
-                
-            return result
-            
+            return await asyncio.to_thread(_prepare)
         except Exception as e:
-            # 确保清理临时文件
-            try:
-                import shutil
-                if 'temp_dir' in locals():
-                    shutil.rmtree(temp_dir)
-            except:
-                pass
-            logger.error(f"视频处理错误: {e}")
-            return f"处理错误: {str(e)}"
+            raise ValueError(f"帧序列解码失败: {e}")
     
-    def process_video(self, video_path: str, prompt: str) -> str:
-        """处理视频推理（兼容旧接口）"""
+    async def _media_sha256(self, request, payload=None, spool=None):
+        """
+        请求媒体的SHA-256（结果缓存键），在I/O线程池中计算
+        
+        Returns:
+            str: 媒体哈希；无法确定时返回None（不使用结果缓存）
+        """
+        if request.get("type") == "image" or "frames" in request:
+            data = payload if payload is not None else request.get("image_data")
+        elif spool is not None:
+            return spool.sha256
+        elif request.get("media_sha256") and "video_data" not in request and "video_path" not in request:
+            return request["media_sha256"]
+        elif "video_data" in request:
+            data = request["video_data"]
+        elif "video_path" in request:
+            try:
+                return await asyncio.to_thread(file_sha256, request["video_path"])
+            except OSError:
+                return None
+        else:
+            return None
+        if data is None:
+            return None
+        
+        def _digest():
+            return hashlib.sha256(base64.b64decode(data) if isinstance(data, str) else data).hexdigest()
+        
         try:
-            # 构建消息 - 按照cookbook格式
-            messages = [
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": [
-                    {"type": "text", "text": prompt},
-                    {"video": video_path, "total_pixels": 20480 * 28 * 28, "min_pixels": 16 * 28 * 28},
-                ]}
-            ]
-            
-            # 处理输入
-            text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-            image_inputs, video_inputs, video_kwargs = process_vision_info([messages], return_video_kwargs=True)
-            fps_inputs = video_kwargs['fps']
-            
-            inputs = self.processor(
-                text=[text], 
-                images=image_inputs, 
-                videos=video_inputs, 
-                fps=fps_inputs, 
-                padding=True, 
-                return_tensors="pt"
+            return await asyncio.to_thread(_digest)
+        except ValueError:
+            return None
+    
+    def _discard_inputs(self, request, spool):
+        """请求由结果缓存应答时释放其上传暂存（带哈希的上传仍移入媒体存储，后续请求可直接引用）"""
+        if spool is None:
+            return
+        media_sha256 = request.get("media_sha256")
+        if media_sha256 and media_sha256 == spool.sha256 and self.media_store is not None:
+            if spool.in_memory:
+                self._persist_spool(spool, media_sha256)
+                return
+            self.media_store.put(spool.path, media_sha256, spool.suffix)
+            self.media_store.release(media_sha256)
+        spool.cleanup()
+    
+    def _persist_spool(self, spool, media_sha256):
+        """
+        在后台把内存暂存的上传写入媒体存储，写完后释放内存暂存
+        
+        复制在I/O线程池中进行，不阻塞事件循环，也不在请求的解码和推理之前写盘
+        """
+        async def _persist():
+            try:
+                await self.media_store.persist(spool.path, media_sha256, spool.suffix)
+            except Exception as e:
+                logger.warning(f"写入媒体存储失败: {media_sha256[:12]}: {e}")
+            finally:
+                spool.cleanup()
+        
+        task = asyncio.create_task(_persist())
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+    
+    async def _handle_cached(self, websocket, request, payload=None, spool=None, deadline=None, ticket=None):
+        """
+        经过结果缓存处理请求
+        
+        会话请求（结果依赖对话历史）和无法确定媒体哈希的请求直接处理；
+        流式请求命中时以一条delta发送完整结果，未命中时单独生成（增量只发给发起者）
+        
+        未命中时生成任务接管请求的输入（上传暂存）并持有准入凭证的一个引用：发起者取消或断开后，
+        共享同一生成的其他请求仍得到完整结果，生成期间仍计入在途请求；最后一个等待者离开时才取消生成
+        
+        Returns:
+            tuple: (结果文本, 统计信息)，统计信息中result_cache_hit表示是否由缓存或共享生成应答
+        """
+        request_type = request.get("type")
+        stream = bool(request.get("stream", False))
+        session = request.get("session_id") and self.backend.supports_sessions
+        if self.result_cache is None or request_type not in ("image", "video") or session:
+            return await self._handle_request(websocket, request, payload, spool, deadline)
+        
+        media_stats = {}
+        with timed(media_stats, "media_hash"):
+            media_sha256 = await self._media_sha256(request, payload, spool)
+        if media_sha256 is None:
+            return await self._handle_request(websocket, request, payload, spool, deadline)
+        
+        key = ResultCache.make_key(
+            request_type, media_sha256, request.get("prompt", ""), **self.backend.generation_params(request_type)
+        )
+        owned = False
+        
+        def compute():
+            nonlocal owned
+            owned = True
+            return self._start_owned(
+                websocket if stream else None, dict(request), payload, spool, deadline, ticket
             )
-            inputs = inputs.to(self.model.device)
-
-            # 生成回复
-            with torch.no_grad():
-                output_ids = self.model.generate(**inputs, max_new_tokens=2048)
-                generated_ids = [output_ids[len(input_ids):] for input_ids, output_ids in zip(inputs.input_ids, output_ids)]
-                output_text = self.processor.batch_decode(generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        
+        try:
+            (result, stats), source = await self.result_cache.run(key, compute, share=not stream)
+        finally:
+            if not owned:
+                self._discard_inputs(request, spool)
+        
+        if source == "miss":
+            return result, dict(stats, result_cache_hit=False, **media_stats)
+        if stream:
+            await self._send(websocket, request.get("request_id"), {"type": "delta", "text": result})
+        stats = dict(media_stats, result_cache_hit=True)
+        if source == "shared":
+            stats["result_cache_shared"] = True
+        return result, stats
+    
+    def _start_owned(self, websocket, request, payload, spool, deadline, ticket):
+        """
+        启动持有自身输入的处理任务（结果缓存未命中时的生成）
+        
+        任务持有准入凭证的一个引用，结束时交还；任务在开始运行前被取消时由完成回调释放上传暂存
+        
+        Args:
+            websocket: 流式请求发送增量的连接，共享的非流式生成为None
+        
+        Returns:
+            asyncio.Task: 结果为 (结果文本, 统计信息)
+        """
+        started = False
+        
+        async def _run():
+            nonlocal started
+            started = True
+            return await self._handle_request(websocket, request, payload, spool, deadline)
+        
+        if ticket is not None:
+            self.admission.retain(ticket)
+        task = asyncio.ensure_future(_run())
+        
+        def _on_done(_):
+            if not started:
+                self._discard_inputs(request, spool)
+            if ticket is not None:
+                self.admission.release(ticket)
+        
+        task.add_done_callback(_on_done)
+        return task
+    
+    async def _handle_request(self, websocket, request, payload=None, spool=None, deadline=None):
+        """
+        处理单个请求
+        
+        Args:
+            payload: 已接收到内存的二进制负载
+            spool: 已暂存的上传文件（处理完成后删除）
+            deadline: 最晚开始执行时间（time.time()），None表示不限
+        
+        Returns:
+            tuple: (结果文本, 统计信息)
+        """
+        request_type = request.get("type", "")
+        request_id = request.get("request_id")
+        stream = bool(request.get("stream", False))
+        # 会话请求复用前缀KV缓存（未启用会话缓存时按普通请求处理）
+        session_id = request.get("session_id") if self.backend.supports_sessions else None
+        stats = {}
+        acquired_sha256 = None
+        persist_sha256 = None
+        
+        try:
+            if request_type == "image":
+                # 图像处理
+                image_data = payload if payload is not None else request["image_data"]
+                prompt = request["prompt"]
+                with timed(stats, "media_decode"):
+                    image, vision_key, pixels, image_sha256 = await self._prepare_image(image_data)
+                if session_id:
+                    # 会话请求不参与组批（每个会话有各自的KV缓存）
+                    args = (self.backend.process_image_session, image, prompt, vision_key, session_id, image_sha256)
+                    if stream:
+                        (result, image_stats), timing = await self._run_streaming(
+                            websocket, request_id, *args, deadline=deadline, affinity=session_id
+                        )
+                    else:
+                        (result, image_stats), timing = await self._submit_timed(
+                            *args, deadline=deadline, affinity=session_id
+                        )
+                elif stream:
+                    # 流式请求同样参与组批（单独成批时逐段输出）
+                    (result, image_stats), timing = await self._run_batched_streaming(
+                        websocket, request_id, self.image_scheduler, (image, prompt, vision_key),
+                        pixels=pixels, deadline=deadline,
+                    )
+                else:
+                    (result, image_stats), timing = await self.image_scheduler.submit(
+                        (image, prompt, vision_key), pixels=pixels, deadline=deadline
+                    )
+                stats.update(image_stats, **timing)
                 
-            return output_text[0].strip()
-            
-        except Exception as e:
-            logger.error(f"视频处理错误: {e}")
-            return f"处理错误: {str(e)}"
+            elif request_type == "video":
+                # 视频处理 - 支持帧序列、分块上传、媒体存储引用、base64数据和路径五种方式
+                prompt = request["prompt"]
+                media_sha256 = request.get("media_sha256")
+                process_video = functools.partial(self.backend.process_video, session_id=session_id)
+                if "frames" in request:
+                    # 客户端抽取并缩放到像素预算内的帧序列，无需解码视频
+                    if self.backend.video_frame_budget() is None or payload is None:
+                        raise ValueError("服务器不接受帧序列视频")
+                    with timed(stats, "media_decode"):
+                        frames, frames_sha256 = await self._prepare_video_frames(payload, request["frames"])
+                    stats["input_frames"] = len(frames)
+                    fps = video_frames_fps(request["frames"])
+                    if not session_id:
+                        # 非会话的帧序列请求参与组批（流式请求单独成批时逐段输出）
+                        video_item = (frames, prompt, fps, frames_sha256)
+                        if stream:
+                            (result, video_stats), timing = await self._run_batched_streaming(
+                                websocket, request_id, self.video_scheduler, video_item, deadline=deadline
+                            )
+                        else:
+                            (result, video_stats), timing = await self.video_scheduler.submit(
+                                video_item, deadline=deadline
+                            )
+                        stats.update(video_stats, **timing)
+                        return result, stats
+                    args = (
+                        functools.partial(
+                            self.backend.process_video_frames, media_sha256=frames_sha256, session_id=session_id
+                        ),
+                        frames, prompt, fps,
+                    )
+                elif spool is not None:
+                    # 分块上传并已暂存的视频
+                    video_path = spool.path
+                    process_video = functools.partial(process_video, media_sha256=spool.sha256)
+                    if media_sha256 and self.media_store is not None:
+                        if spool.sha256 != media_sha256:
+                            raise ValueError("上传数据SHA-256校验失败")
+                        if spool.in_memory:
+                            # 内存暂存直接解码，处理完成后在后台写入媒体存储
+                            persist_sha256 = media_sha256
+                        else:
+                            video_path = self.media_store.put(spool.path, media_sha256, spool.suffix)
+                            acquired_sha256 = media_sha256
+                        stats["media_cache_hit"] = False
+                    args = (process_video, video_path, prompt)
+                elif media_sha256 and "video_data" not in request and "video_path" not in request:
+                    # 引用媒体存储中已有的视频
+                    video_path = self.media_store.acquire(media_sha256) if self.media_store else None
+                    if video_path is None:
+                        raise MediaMissingError(f"服务器上没有该媒体: {media_sha256}")
+                    acquired_sha256 = media_sha256
+                    stats["media_cache_hit"] = True
+                    process_video = functools.partial(process_video, media_sha256=media_sha256)
+                    args = (process_video, video_path, prompt)
+                elif "video_data" in request:
+                    # 旧协议: base64编码在JSON中的视频数据
+                    args = (self.backend.process_video_from_data, request["video_data"], request["video_filename"], prompt)
+                else:
+                    # 视频路径（保持兼容性）
+                    args = (process_video, request["video_path"], prompt)
+                
+                if stream:
+                    (result, video_stats), timing = await self._run_streaming(
+                        websocket, request_id, *args, deadline=deadline, affinity=session_id
+                    )
+                else:
+                    (result, video_stats), timing = await self._submit_timed(
+                        *args, deadline=deadline, affinity=session_id
+                    )
+                stats.update(video_stats, **timing)
+                
+            elif request_type == "text":
+                # 纯文本请求（如长视频分段描述的汇总）
+                if stream:
+                    (result, text_stats), timing = await self._run_streaming(
+                        websocket, request_id, self.backend.process_text, request["prompt"], deadline=deadline
+                    )
+                else:
+                    (result, text_stats), timing = await self._submit_timed(
+                        self.backend.process_text, request["prompt"], deadline=deadline
+                    )
+                stats.update(text_stats, **timing)
+                
+            else:
+                result = f"不支持的请求类型: {request_type}"
+        finally:
+            if acquired_sha256 is not None:
+                self.media_store.release(acquired_sha256)
+            if persist_sha256 is not None:
+                self._persist_spool(spool, persist_sha256)
+            elif spool is not None:
+                spool.cleanup()
+        
+        if spool is not None:
+            stats = dict(stats, **spool.get_stats())
+        return result, stats
+    
+    @staticmethod
+    async def _send(websocket, request_id, message):
+        """发送一条消息，请求带有request_id时原样返回以便客户端匹配响应"""
+        if request_id is not None:
+            message = dict(message, request_id=request_id)
+        await websocket.send(json.dumps(message))
     
     async def handle_client(self, websocket):
-        """处理客户端连接"""
+        """
+        处理客户端连接
+        
+        请求可携带request_id并在同一连接上连续发送，无需等待上一个响应：
+        读取循环按顺序接收头帧和负载帧，每个请求在独立任务中处理，响应按完成顺序返回
+        
+        cancel消息取消对应request_id的请求：排队中的作业直接跳过，生成中的作业在下一个decode步停止
+        
+        图像、视频和文本请求先经过准入控制，被拒绝的请求立即回复错误（负载帧直接丢弃）
+        """
         logger.info(f"客户端连接: {websocket.remote_address}")
+        client = websocket.remote_address[0] if websocket.remote_address else ""
+        
+        if self.max_connections and self.active_connections >= self.max_connections:
+            # 连接数已满 - 告知负载后以1013（稍后重试）关闭
+            load = self.admission.get_load()
+            await websocket.send(json.dumps({
+                "status": "busy",
+                "error": f"服务器连接数已达上限 {self.max_connections}",
+                "error_code": ERROR_OVERLOADED,
+                "retry_after_ms": load["estimated_wait_ms"],
+                "load": load,
+            }))
+            await websocket.close(1013, "server busy")
+            return
         
         # 发送服务器元数据
         metadata = {
             "model_path": self.model_path,
-            "device": str(self.model.device) if self.model else "未加载",
-            "status": "ready"
+            "backend": self.backend.name,
+            "device": self.backend.device,
+            "status": "ready",
+            "streaming": True,
+            "multiplex": True,
+            "cancel": True,
+            "protocols": SUPPORTED_PROTOCOLS,
+            "max_upload_bytes": self.max_upload_bytes,
+            "media_store": self.media_store is not None,
+            "memory_spool": self.memory_spool.get_stats(),
+            "video_frames": self.backend.video_frame_budget(),
+            "text": True,
+            "sessions": self.backend.supports_sessions,
+            "load": self.admission.get_load(),
+            "result_cache": self.result_cache.get_stats() if self.result_cache is not None else None,
+            **self.backend.get_stats(),
+            "batching": {
+                "window_ms": self.image_scheduler.window_ms,
+                "max_batch_size": self.image_scheduler.max_batch_size,
+                "max_batch_pixels": self.image_scheduler.max_batch_pixels,
+                "stats": self.image_scheduler.get_stats(),
+            },
+            "video_batching": {
+                "window_ms": self.video_scheduler.window_ms,
+                "max_batch_size": self.video_scheduler.max_batch_size,
+                "stats": self.video_scheduler.get_stats(),
+            },
         }
         await websocket.send(json.dumps(metadata))
         
+        tasks = {}  # 请求任务 -> request_id
+        self.active_connections += 1
+        self.metrics.connections.inc()
         try:
             async for message in websocket:
                 start_time = time.time()
+                request_id = None
+                request = {}
+                ticket = None
+                self.metrics.bytes_received.inc(len(message), kind="message")
                 
                 try:
                     # 解析请求
+                    if not isinstance(message, str):
+                        # 头帧解析失败后残留的负载帧
+                        logger.warning(f"忽略无头帧的二进制消息: {len(message)} 字节")
+                        continue
                     request = json.loads(message)
-                    request_type = request.get("type", "")
+                    request_id = request.get("request_id")
                     
-                    if request_type == "image":
-                        # 图像处理
-                        image_data = request["image_data"]
-                        prompt = request["prompt"]
-                        result = self.process_image(image_data, prompt)
-                        
-                    elif request_type == "video":
-                        # 视频处理 - 支持路径和数据两种方式
-                        if "video_data" in request:
-                            # 从客户端传输的视频数据
-                            video_data = request["video_data"]
-                            video_filename = request["video_filename"]
-                            prompt = request["prompt"]
-                            result = self.process_video_from_data(video_data, video_filename, prompt)
-                        else:
-                            # 视频路径（保持兼容性）
-                            video_path = request["video_path"]
-                            prompt = request["prompt"]
-                            result = self.process_video(video_path, prompt)
-                        
-                    else:
-                        result = f"不支持的请求类型: {request_type}"
+                    if request.get("type") == "cancel":
+                        # 取消同一连接上的进行中请求（请求已完成时忽略）
+                        for task, task_request_id in tasks.items():
+                            if task_request_id == request_id and not task.done():
+                                task.cancel()
+                                logger.info(f"客户端取消请求: {request_id}")
+                        continue
                     
-                    # 发送响应
-                    processing_time = time.time() - start_time
-                    response = {
-                        "result": result,
-                        "processing_time_ms": processing_time * 1000,
-                        "timestamp": time.time()
-                    }
+                    if request.get("type") == "media_probe":
+                        # 询问服务器是否已有某个媒体文件
+                        sha256 = request.get("sha256", "")
+                        present = self.media_store is not None and self.media_store.contains(sha256)
+                        await self._send(
+                            websocket, request_id, {"type": "media_status", "sha256": sha256, "present": present}
+                        )
+                        continue
                     
-                    await websocket.send(json.dumps(response))
-                    logger.info(f"处理请求完成: {processing_time:.2f}s")
+                    # 准入控制 - 在接收负载前判断，拒绝时不必等待上传完成
+                    if request.get("type") in ("image", "video", "text"):
+                        deadline_ms = request.get("deadline_ms")
+                        ticket = self.admission.admit(
+                            client, request["type"], float(deadline_ms) if deadline_ms is not None else None
+                        )
                     
-                except json.JSONDecodeError:
+                    # 二进制协议 - 头帧之后紧跟声明长度的原始负载帧，必须在读取下一条消息前收完
+                    payload, spool = None, None
+                    receive_stats = {}
+                    if "payload" in request:
+                        with timed(receive_stats, "receive"):
+                            payload, spool = await self._receive_payload(websocket, request)
+                        self.metrics.bytes_received.inc(int(request["payload"]["length"]), kind="payload")
+                    
+                except json.JSONDecodeError as e:
+                    self.metrics.record_error(None, e)
                     await websocket.send(json.dumps({"error": "Invalid JSON format"}))
+                    continue
+                except AdmissionRejected as e:
+                    self.metrics.record_rejection(request.get("type"), e.error_code)
+                    if "payload" in request:
+                        await self._discard_payload(websocket, request)
+                    logger.info(f"拒绝请求 {request_id}: {e}")
+                    await self._send(websocket, request_id, {
+                        "error": str(e),
+                        "error_code": e.error_code,
+                        "retry_after_ms": e.retry_after_ms,
+                        "load": self.admission.get_load(),
+                    })
+                    continue
                 except Exception as e:
+                    if ticket is not None:
+                        self.admission.release(ticket)
+                    self.metrics.record_error(request.get("type"), e)
                     error_msg = f"处理错误: {str(e)}"
                     logger.error(error_msg)
-                    await websocket.send(json.dumps({"error": error_msg}))
+                    await self._send(websocket, request_id, {"error": error_msg})
+                    continue
+                
+                task = asyncio.create_task(
+                    self._serve_request(websocket, request, payload, spool, start_time, receive_stats, ticket)
+                )
+                tasks[task] = request_id
+                
+                def _on_done(done, ticket=ticket):
+                    # 在完成回调中交还凭证（任务在开始运行前被取消时协程的finally不会执行）
+                    tasks.pop(done, None)
+                    if ticket is not None:
+                        self.admission.release(ticket)
+                
+                task.add_done_callback(_on_done)
                     
         except websockets.ConnectionClosed:
             logger.info(f"客户端断开连接: {websocket.remote_address}")
         except Exception as e:
             logger.error(f"连接错误: {e}")
+        finally:
+            self.active_connections -= 1
+            self.metrics.connections.dec()
+            # 连接断开后未完成的请求无人接收，取消以释放排队位置并停止生成
+            for task in list(tasks):
+                task.cancel()
+    
+    async def _serve_request(self, websocket, request, payload, spool, start_time, receive_stats, ticket=None):
+        """
+        处理一个请求并发送响应（每个请求一个任务）
+        
+        响应中timing为各阶段耗时（毫秒），stats为token数、吞吐量和缓存命中等其余统计
+        
+        Args:
+            ticket: 准入凭证（其截止时间为最晚开始执行时间），由调用方在任务结束时交还
+        """
+        request_id = request.get("request_id")
+        request_type = request.get("type")
+        stream = bool(request.get("stream", False))
+        deadline = ticket.deadline if ticket is not None else None
+        try:
+            result, stats = await self._handle_cached(websocket, request, payload, spool, deadline, ticket)
+            
+            # 发送响应
+            processing_time = time.time() - start_time
+            timing, stats = split_timing(dict(receive_stats, **stats))
+            timing["total"] = processing_time * 1000
+            response = {
+                "result": result,
+                "processing_time_ms": processing_time * 1000,
+                "timestamp": time.time(),
+                "timing": timing,
+                "stats": stats,
+            }
+            if stream:
+                response["type"] = "final"
+            
+            if "error" in stats:
+                # 推理函数内部捕获的错误以错误文本作为结果返回
+                self.metrics.record_error(request_type, stats["error"])
+            else:
+                self.metrics.observe_request(request_type, timing, stats)
+                if "compute" in timing:
+                    self.admission.observe_service(request_type, timing["compute"], stats.get("batch_size", 1))
+            await self._send(websocket, request_id, response)
+            logger.info(
+                f"处理请求完成: {processing_time:.2f}s (排队作业: {self.executor.queue_depth}) "
+                + " ".join(f"{stage}={ms:.0f}ms" for stage, ms in timing.items())
+            )
+            
+        except asyncio.CancelledError:
+            # 客户端取消或断开 - GPU作业已在下一个decode步停止，确认取消后结束任务
+            self.metrics.record_cancel(request_type)
+            try:
+                await self._send(websocket, request_id, {"type": "cancelled"})
+            except websockets.ConnectionClosed:
+                pass
+            raise
+        except websockets.ConnectionClosed:
+            logger.info(f"客户端已断开，丢弃响应: {request_id}")
+        except DeadlineExceededError as e:
+            # 排队期间截止时间已过，作业未执行
+            self.admission.record_deadline_exceeded()
+            self.metrics.record_rejection(request_type, ERROR_DEADLINE_EXCEEDED)
+            await self._send(websocket, request_id, {
+                "error": str(e),
+                "error_code": ERROR_DEADLINE_EXCEEDED,
+                "retry_after_ms": self.admission.estimated_wait_ms(),
+                "load": self.admission.get_load(),
+            })
+        except MediaMissingError as e:
+            self.metrics.record_error(request_type, e)
+            await self._send(websocket, request_id, {"error": str(e), "error_code": ERROR_MEDIA_MISSING})
+        except Exception as e:
+            self.metrics.record_error(request_type, e)
+            error_msg = f"处理错误: {str(e)}"
+            logger.error(error_msg)
+            try:
+                await self._send(websocket, request_id, {"error": error_msg})
+            except websockets.ConnectionClosed:
+                pass
     
     def serve_forever(self):
         """启动服务器"""
@@ -307,15 +852,37 @@ class VLMServer:
     
     async def _run_server(self):
         """运行服务器"""
+        removed = sweep_spool_dir(self.spool_dir)
+        if removed:
+            print(f"已清理遗留的上传暂存文件: {removed} 个")
+        self.executor.start()
+        self.image_scheduler.start()
+        self.video_scheduler.start()
+        metrics_server = None
+        if self.metrics_port:
+            metrics_server = await serve_metrics(self.metrics, self.metrics_host, self.metrics_port)
+        
+        # 单条消息大小上限 - 二进制分块帧远小于此值，旧协议的base64消息按上传上限的4/3计算
+        max_size = self.max_upload_bytes * 4 // 3 + 1024 ** 2 if self.max_upload_bytes else None
         async with server.serve(
             self.handle_client,
             self.host,
             self.port,
             compression=None,
-            max_size=None,
+            max_size=max_size,
         ) as ws_server:
             print(f"VLM服务器运行中: ws://{self.host}:{self.port}")
-            await ws_server.serve_forever()
+            try:
+                await ws_server.serve_forever()
+            finally:
+                if metrics_server is not None:
+                    metrics_server.close()
+                await self.image_scheduler.stop()
+                await self.video_scheduler.stop()
+                # 等待进行中的媒体存储写入完成
+                if self._background_tasks:
+                    await asyncio.gather(*self._background_tasks, return_exceptions=True)
+                self.executor.stop(timeout=5)
 
 
 def main():
@@ -326,11 +893,79 @@ def main():
     parser.add_argument("--model-path", default="Qwen/Qwen2.5-VL-7B-Instruct", help="模型路径")
     parser.add_argument("--host", default="0.0.0.0", help="服务器主机")
     parser.add_argument("--port", type=int, default=8000, help="服务器端口")
+    parser.add_argument("--batch-window-ms", type=float, default=20, help="图像请求组批等待窗口（毫秒）")
+    parser.add_argument("--max-batch-size", type=int, default=4, help="图像请求最大批次大小")
+    parser.add_argument("--max-batch-pixels", type=int, default=0, help="每批图像最大像素总数，0表示不限制")
+    parser.add_argument("--max-video-batch-size", type=int, default=4, help="帧序列视频请求最大批次大小")
+    parser.add_argument("--spool-dir", default=None, help="上传视频暂存目录（默认系统临时目录下的vlm_spool）")
+    parser.add_argument("--memory-spool-mb", type=float, default=2048,
+                        help="上传视频内存暂存总预算(MB)，超出时写入磁盘暂存目录，0表示全部写入磁盘")
+    parser.add_argument("--max-upload-mb", type=float, default=1024, help="单个上传文件大小上限（MB），0表示不限制")
+    parser.add_argument("--media-store-dir", default=None, help="内容寻址媒体存储目录（默认系统临时目录下的vlm_media_store）")
+    parser.add_argument("--media-store-mb", type=float, default=4096, help="媒体存储磁盘预算（MB），0表示禁用")
+    parser.add_argument("--vision-cache-mb", type=float, default=1024, help="视觉编码缓存显存预算（MB），0表示禁用")
+    parser.add_argument("--session-cache-mb", type=float, default=2048, help="会话前缀KV缓存显存预算（MB），0表示禁用")
+    parser.add_argument("--max-sessions", type=int, default=16, help="最多保留的会话数")
+    parser.add_argument("--session-ttl-s", type=float, default=600, help="会话闲置过期时间（秒）")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="指标HTTP端点监听地址")
+    parser.add_argument("--metrics-port", type=int, default=9100, help="指标HTTP端点端口（GET /metrics），0表示禁用")
+    parser.add_argument("--max-queue", type=int, default=64, help="在途请求上限（超出时立即拒绝），0表示不限制")
+    parser.add_argument("--max-per-client", type=int, default=8, help="每个客户端地址的在途请求上限，0表示不限制")
+    parser.add_argument("--max-connections", type=int, default=0, help="websocket连接数上限，0表示不限制")
+    parser.add_argument("--result-cache-entries", type=int, default=1024, help="结果缓存条目数，0表示禁用")
+    parser.add_argument("--result-cache-ttl-s", type=float, default=600, help="结果缓存过期时间（秒）")
+    parser.add_argument("--replicas", type=int, default=1,
+                        help="模型副本数，大于1时每个副本在独立工作进程中加载一份模型（适合3B等小模型）")
+    parser.add_argument("--replica-devices", default=None,
+                        help="按副本轮流分配的GPU编号，逗号分隔（如0,1），默认不限制")
+    parser.add_argument("--backend", choices=["qwen", "stub"], default="qwen",
+                        help="推理后端: qwen加载模型，stub为不加载权重的模拟后端（用于压测）")
+    parser.add_argument("--stub-prefill-ms", type=float, default=50, help="模拟后端每次prefill的固定耗时（毫秒）")
+    parser.add_argument("--stub-prefill-tokens-per-s", type=float, default=5000, help="模拟后端prefill速度（token/秒）")
+    parser.add_argument("--stub-decode-tokens-per-s", type=float, default=30, help="模拟后端decode速度（token/秒）")
+    parser.add_argument("--stub-output-tokens", type=int, default=64, help="模拟后端每个请求生成的token数")
+    parser.add_argument("--stub-video-tokens", type=int, default=2048, help="模拟后端每个视频的视觉token数")
     
     args = parser.parse_args()
     
+    backend_options = None
+    if args.backend == "stub":
+        backend_options = {
+            "prefill_ms": args.stub_prefill_ms,
+            "prefill_tokens_per_s": args.stub_prefill_tokens_per_s,
+            "decode_tokens_per_s": args.stub_decode_tokens_per_s,
+            "output_tokens": args.stub_output_tokens,
+            "video_tokens": args.stub_video_tokens,
+        }
+    
     # 创建并启动服务器
-    vlm_server = VLMServer(args.model_path, args.host, args.port)
+    vlm_server = VLMServer(
+        args.model_path, args.host, args.port,
+        batch_window_ms=args.batch_window_ms,
+        max_batch_size=args.max_batch_size,
+        max_batch_pixels=args.max_batch_pixels,
+        max_video_batch_size=args.max_video_batch_size,
+        spool_dir=args.spool_dir,
+        memory_spool_mb=args.memory_spool_mb,
+        max_upload_mb=args.max_upload_mb,
+        media_store_dir=args.media_store_dir,
+        media_store_mb=args.media_store_mb,
+        vision_cache_mb=args.vision_cache_mb,
+        session_cache_mb=args.session_cache_mb,
+        max_sessions=args.max_sessions,
+        session_ttl_s=args.session_ttl_s,
+        metrics_host=args.metrics_host,
+        metrics_port=args.metrics_port,
+        backend=args.backend,
+        backend_options=backend_options,
+        max_queue=args.max_queue,
+        max_per_client=args.max_per_client,
+        max_connections=args.max_connections,
+        result_cache_entries=args.result_cache_entries,
+        result_cache_ttl_s=args.result_cache_ttl_s,
+        replicas=args.replicas,
+        replica_devices=args.replica_devices.split(",") if args.replica_devices else None,
+    )
     vlm_server.load_model()
     vlm_server.serve_forever()
 